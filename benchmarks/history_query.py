@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from labshare import telemetry
+
+DAY = 24 * 60 * 60
+
+
+def build_store(directory: str, num_gpus: int, num_days: int, end: float) -> telemetry.TelemetryStore:
+    store = telemetry.TelemetryStore(directory, {resolution: num_days * DAY for resolution in telemetry.SEGMENT_LENGTHS})
+    bucket_length = telemetry.BUCKET_LENGTHS[telemetry.ONE_MINUTE]
+    timestamps = np.arange(end - num_days * DAY, end, bucket_length)
+    for i in range(num_gpus):
+        records = np.zeros(len(timestamps), dtype=telemetry.BUCKET_DTYPE)
+        records["timestamp"] = timestamps
+        records["used_memory_count"] = 12
+        records["utilization_count"] = 12
+        records["used_memory_sum"] = np.random.uniform(0, 40536, len(timestamps)) * 12
+        records["used_memory_max"] = 40536
+        records["total_memory"] = 40536
+        records["utilization_sum"] = np.random.uniform(0, 100, len(timestamps)) * 12
+        records["utilization_max"] = 100
+        gpu_directory = store.get_gpu_directory(f"GPU-benchmark-{i:04}")
+        os.makedirs(gpu_directory)
+        telemetry.append_records(gpu_directory, telemetry.ONE_MINUTE, records)
+        telemetry.append_records(gpu_directory, telemetry.ONE_HOUR, roll_up_hours(records))
+    return store
+
+
+def roll_up_hours(records: np.ndarray) -> np.ndarray:
+    minutes_per_hour = telemetry.BUCKET_LENGTHS[telemetry.ONE_HOUR] // telemetry.BUCKET_LENGTHS[telemetry.ONE_MINUTE]
+    minutes = records.reshape(-1, minutes_per_hour)
+    hours = np.zeros(len(minutes), dtype=telemetry.BUCKET_DTYPE)
+    hours["timestamp"] = minutes["timestamp"][:, 0]
+    hours["total_memory"] = minutes["total_memory"][:, -1]
+    for field in ("used_memory_count", "used_memory_sum", "utilization_count", "utilization_sum"):
+        hours[field] = minutes[field].sum(axis=1)
+    for field in ("used_memory_max", "utilization_max"):
+        hours[field] = minutes[field].max(axis=1)
+    return hours
+
+
+def query_all(store: telemetry.TelemetryStore, num_gpus: int, start: float, end: float, step: float):
+    # does the same as the device history view, including the encoding of the response
+    resolution = telemetry.get_history_resolution(step)
+    histories = [
+        telemetry.build_history(store.read(f"GPU-benchmark-{i:04}", resolution, start, end), resolution, start, step)
+        for i in range(num_gpus)
+    ]
+    return histories, json.dumps({"gpus": histories})
+
+
+def main(args: argparse.Namespace):
+    end = (time.time() // DAY) * DAY
+    start = end - args.days * DAY
+    with tempfile.TemporaryDirectory() as directory:
+        store = build_store(directory, args.num_gpus, args.days, end)
+        for step in args.steps:
+            durations = []
+            for _ in range(args.repeat):
+                query_start = time.perf_counter()
+                histories, response = query_all(store, args.num_gpus, start, end, step)
+                durations.append(time.perf_counter() - query_start)
+            print(f"{args.num_gpus} gpus, {args.days} days, step {step:>6}s ({histories[0]['resolution']}): "
+                  f"{len(histories[0]['timestamps']):>5} steps per gpu, {len(response) / 1024:.0f}KiB, "
+                  f"{min(durations) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how long a history query over the 1 minute rollups of "
+                                                 "many GPUs takes")
+    parser.add_argument("-n", "--num-gpus", type=int, default=64, help="number of gpus to query")
+    parser.add_argument("-d", "--days", type=int, default=30, help="length of the queried range in days")
+    parser.add_argument("-s", "--steps", type=int, nargs="+", default=[60 * 30, 60 * 60 * 6],
+                        help="step lengths in seconds to measure")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of measurements per step length")
+    main(parser.parse_args())
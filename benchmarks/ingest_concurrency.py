@@ -0,0 +1,168 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "labshare.settings")
+
+import django
+from django.conf import settings
+
+# (name, database settings, sqlite pragmas), the first configuration is the one LabShare used to ship with
+SQLITE_CONFIGURATIONS = [
+    ("sqlite, rollback journal", {"CONN_MAX_AGE": 0, "OPTIONS": {"timeout": 5}}, {"journal_mode": "delete"}),
+    ("sqlite, wal", {"CONN_MAX_AGE": 60, "OPTIONS": {"timeout": 20}}, {"journal_mode": "wal", "synchronous": "normal"}),
+]
+SERVER_CONFIGURATIONS = [
+    ("new connection per request", {"CONN_MAX_AGE": 0}, {}),
+    ("persistent connections", {"CONN_MAX_AGE": 60}, {}),
+]
+
+
+def setup_django(telemetry_dir: str):
+    # only the database is measured, everything else is kept in memory
+    settings.ALLOWED_HOSTS = ["*"]
+    settings.DEBUG = False
+    settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    settings.PUBLISH_COALESCE_WINDOW = 0
+    settings.TELEMETRY_DIR = telemetry_dir
+    django.setup()
+    logging.getLogger("django.request").setLevel(logging.CRITICAL)
+
+
+def build_gpu_update(device_name: str, num_gpus: int, update: int) -> bytes:
+    gpu_data = [
+        {
+            "name": "NVIDIA A100-SXM4-40GB",
+            "uuid": f"GPU-{device_name}-{i}",
+            "index": i,
+            "gpu_util": f"{(update * 7 + i) % 100} %",
+            "in_use": "no",
+            "processes": [],
+            "memory": {"total": "40536 MiB", "used": f"{update % 40536} MiB", "free": "0 MiB"},
+        }
+        for i in range(num_gpus)
+    ]
+    return json.dumps({"device_name": device_name, "gpu_data": gpu_data}).encode("utf-8")
+
+
+def post(handler, request_factory, path: str, body: bytes, token: str) -> int:
+    request = request_factory.post(path, body, content_type="application/json", HTTP_AUTHORIZATION=f"Token {token}")
+    status = []
+    response = handler(request.environ, lambda status_line, headers: status.append(int(status_line.split()[0])))
+    # closing the response sends request_finished, which closes connections that are older than CONN_MAX_AGE
+    response.close()
+    return status[0]
+
+
+def run_configuration(args: argparse.Namespace, database_settings: dict, sqlite_pragmas: dict):
+    from django.contrib.auth.models import User
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.db import connection, connections
+    from django.test import RequestFactory
+    from rest_framework.authtoken.models import Token
+
+    from labshare import gpu_cache
+    from labshare.models import Device
+
+    connections.databases["default"].update(database_settings)
+    settings.SQLITE_PRAGMAS = sqlite_pragmas
+    test_database_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        gpu_cache.clear()
+        tokens = {}
+        for i in range(args.num_devices):
+            device = Device.objects.create(name=f"benchmark-{i:04}", user=User.objects.create(username=f"device-{i}"))
+            tokens[device.name] = Token.objects.get(user=device.user).key
+        allocation_token = Token.objects.get(user__username=settings.ALLOCATION_UPDATE_USERNAME).key
+        connection.close()
+
+        handler = WSGIHandler()
+        request_factory = RequestFactory()
+        status_codes = Counter()
+        lock = threading.Lock()
+        device_names = sorted(tokens.keys())
+
+        def send_gpu_updates(worker: int):
+            for update in range(args.num_updates):
+                for device_name in device_names[worker::args.num_threads]:
+                    body = build_gpu_update(device_name, args.num_gpus, update)
+                    status_code = post(handler, request_factory, "/gpu/update", body, tokens[device_name])
+                    with lock:
+                        status_codes[status_code] += 1
+            connections.close_all()
+
+        def send_allocation_updates(stop: threading.Event):
+            update = 0
+            while not stop.is_set():
+                update += 1
+                allocations = {device_name: [update % args.num_gpus] for device_name in device_names}
+                body = json.dumps(allocations).encode("utf-8")
+                status_code = post(handler, request_factory, "/gpu/allocations", body, allocation_token)
+                with lock:
+                    status_codes[f"allocations {status_code}"] += 1
+                stop.wait(args.allocation_interval)
+            connections.close_all()
+
+        stop = threading.Event()
+        allocation_thread = threading.Thread(target=send_allocation_updates, args=(stop,))
+        threads = [threading.Thread(target=send_gpu_updates, args=(worker,)) for worker in range(args.num_threads)]
+        start = time.perf_counter()
+        allocation_thread.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+        stop.set()
+        allocation_thread.join()
+        return duration, status_codes
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(test_database_name, verbosity=0)
+
+
+def main(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        setup_django(os.path.join(directory, "telemetry"))
+        from django.db import connection
+        from labshare import telemetry
+
+        if connection.vendor == "sqlite":
+            configurations = SQLITE_CONFIGURATIONS
+        else:
+            configurations = SERVER_CONFIGURATIONS
+
+        num_requests = args.num_devices * args.num_updates
+        print(f"{args.num_threads} threads send {num_requests} updates of {args.num_devices} devices "
+              f"with {args.num_gpus} GPUs each to {connection.vendor}")
+        for i, (name, database_settings, sqlite_pragmas) in enumerate(configurations):
+            if connection.vendor == "sqlite":
+                database_settings = dict(database_settings, TEST={"NAME": os.path.join(directory, f"db-{i}.sqlite3")})
+            duration, status_codes = run_configuration(args, database_settings, sqlite_pragmas)
+            failed = num_requests - status_codes[200]
+            print(f"{name:>28}: {num_requests / duration:>8.1f} updates/s, {failed} failed updates, "
+                  f"{dict(status_codes)}")
+        telemetry.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how many GPU updates the server can ingest while many "
+                                                 "agents and the slurm updater write to the database at the same "
+                                                 "time. Uses the database configured in the settings (a temporary "
+                                                 "test database is created)")
+    parser.add_argument("-d", "--num-devices", type=int, default=64, help="number of devices sending updates")
+    parser.add_argument("-g", "--num-gpus", type=int, default=8, help="number of gpus per device")
+    parser.add_argument("-u", "--num-updates", type=int, default=20, help="number of updates per device")
+    parser.add_argument("-t", "--num-threads", type=int, default=16, help="number of concurrent requests")
+    parser.add_argument("-a", "--allocation-interval", type=float, default=0.05,
+                        help="seconds between two allocation updates")
+    main(parser.parse_args())
@@ -0,0 +1,62 @@
+import argparse
+import os
+import random
+import sys
+import timeit
+
+DEVICE_QUERY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "device_query")
+sys.path.insert(0, DEVICE_QUERY_DIR)
+
+from slurm_updater import parse_sinfo_output
+
+
+def build_hostlist(prefix: str, node_ids: list, width: int) -> str:
+    # compresses the node ids into ranges like sinfo does, e.g. node[0001-0004,0007]
+    ranges = []
+    first = last = node_ids[0]
+    for node_id in node_ids[1:] + [None]:
+        if node_id is not None and node_id == last + 1:
+            last = node_id
+            continue
+        ranges.append(f"{first:0{width}}" if first == last else f"{first:0{width}}-{last:0{width}}")
+        if node_id is not None:
+            first = last = node_id
+    if len(node_ids) == 1:
+        return f"{prefix}{node_ids[0]:0{width}}"
+    return f"{prefix}[{','.join(ranges)}]"
+
+
+def build_sinfo_output(num_nodes: int, nodes_per_line: int = 50, width: int = 4) -> str:
+    """
+    Builds a synthetic "sinfo -O NodeList,GresUsed -h" dump. Nodes with the same allocation are grouped in one line,
+    every line covers a few interleaved ranges of nodes.
+    """
+    node_ids = list(range(num_nodes))
+    random.shuffle(node_ids)
+    lines = []
+    for i in range(0, num_nodes, nodes_per_line):
+        hostlist = build_hostlist("node", sorted(node_ids[i:i + nodes_per_line]), width)
+        num_allocated = random.randint(0, 8)
+        gpu_ids = "N/A" if num_allocated == 0 else f"0-{num_allocated - 1}"
+        lines.append(f"{hostlist:<60}gpu:a100:{num_allocated}(IDX:{gpu_ids})")
+    return "\n".join(lines)
+
+
+def main(args: argparse.Namespace):
+    sinfo_output = build_sinfo_output(args.num_nodes, args.nodes_per_line)
+    node_info = parse_sinfo_output(sinfo_output)
+    assert len(node_info) == args.num_nodes
+
+    duration = min(timeit.repeat(lambda: parse_sinfo_output(sinfo_output), number=args.iterations, repeat=3))
+    print(f"{args.num_nodes} nodes in {len(sinfo_output.splitlines())} lines ({len(sinfo_output)} bytes): "
+          f"{duration / args.iterations * 1e3:.2f}ms per parse")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how long the slurm updater needs to parse the sinfo "
+                                                 "output of a large cluster")
+    parser.add_argument("-n", "--num-nodes", type=int, default=5000, help="number of nodes in the cluster")
+    parser.add_argument("-l", "--nodes-per-line", type=int, default=50,
+                        help="number of nodes that share one line of the sinfo output")
+    parser.add_argument("-i", "--iterations", type=int, default=20, help="number of parses per measurement")
+    main(parser.parse_args())
@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "device_query"))
+
+from device_query import encode_post_data
+from labshare.payloads import decode_payload
+
+WIRE_FORMATS = [
+    ("json (indent=4)", None, None),
+    ("json", "json", "none"),
+    ("json+gzip", "json", "gzip"),
+    ("json+deflate", "json", "deflate"),
+    ("msgpack", "msgpack", "none"),
+    ("msgpack+gzip", "msgpack", "gzip"),
+]
+
+
+def build_post_data(num_gpus: int, processes_per_gpu: int = 2) -> dict:
+    gpu_data = []
+    for i in range(num_gpus):
+        processes = [
+            {
+                "pid": str(random.randint(1000, 100000)),
+                "username": f"user{random.randint(0, 50)}",
+                "name": "/usr/bin/python3",
+                "used_memory": f"{random.randint(100, 20000)} MiB",
+            }
+            for _ in range(processes_per_gpu)
+        ]
+        gpu_data.append({
+            "name": "NVIDIA A100-SXM4-40GB",
+            "uuid": f"GPU-{random.getrandbits(128):032x}",
+            "gpu_util": f"{random.randint(0, 100)} %",
+            "in_use": "yes",
+            "processes": processes,
+            "memory": {
+                "total": "40536 MiB",
+                "used": f"{random.randint(0, 40536)} MiB",
+                "free": f"{random.randint(0, 40536)} MiB",
+            },
+        })
+    return {"gpu_data": gpu_data, "device_name": "benchmark-node"}
+
+
+def encode(post_data: dict, encoding: str, compression: str):
+    if encoding is None:
+        # the format the agent used before compact encodings were introduced
+        return json.dumps(post_data, indent=4).encode("utf-8"), {"Content-Type": "application/json"}
+    return encode_post_data(post_data, encoding, compression)
+
+
+def main(args: argparse.Namespace):
+    print(f"{'gpus':>6} {'format':>16} {'bytes':>10} {'decode time':>12}")
+    for num_gpus in args.num_gpus:
+        post_data = build_post_data(num_gpus)
+        for format_name, encoding, compression in WIRE_FORMATS:
+            body, headers = encode(post_data, encoding, compression)
+            content_type = headers["Content-Type"]
+            content_encoding = headers.get("Content-Encoding", "")
+            assert decode_payload(body, content_type, content_encoding) == post_data
+
+            duration = min(timeit.repeat(
+                lambda: decode_payload(body, content_type, content_encoding), number=args.iterations, repeat=3
+            ))
+            print(f"{num_gpus:>6} {format_name:>16} {len(body):>10} {duration / args.iterations * 1e6:>10.1f}us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares payload size and server side decode time of the wire "
+                                                 "formats supported for GPU updates")
+    parser.add_argument("-n", "--num-gpus", type=int, nargs="+", default=[8, 16, 64],
+                        help="number of gpus in the simulated update")
+    parser.add_argument("-i", "--iterations", type=int, default=1000, help="number of decodes per measurement")
+    main(parser.parse_args())
@@ -0,0 +1,63 @@
+import argparse
+import os
+import re
+import sys
+import timeit
+import tracemalloc
+
+DEVICE_QUERY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "device_query")
+sys.path.insert(0, DEVICE_QUERY_DIR)
+
+from device_query import parse_nvidia_xml, parse_nvidia_xml_streaming
+
+GPU_BLOCK_REGEX = re.compile(r"\s*<gpu id=.*?</gpu>\n", re.DOTALL)
+UUID_REGEX = re.compile(r"<uuid>.*?</uuid>")
+
+
+def scale_nvidia_xml(xml: str, num_gpus: int) -> str:
+    gpu_blocks = GPU_BLOCK_REGEX.findall(xml)
+    if len(gpu_blocks) == 0:
+        raise ValueError("The given xml does not contain any gpu")
+
+    start = xml.index(gpu_blocks[0])
+    end = xml.index(gpu_blocks[-1]) + len(gpu_blocks[-1])
+
+    scaled_blocks = []
+    for i in range(num_gpus):
+        block = gpu_blocks[i % len(gpu_blocks)]
+        scaled_blocks.append(UUID_REGEX.sub(f"<uuid>GPU-benchmark-{i:04}</uuid>", block))
+    return xml[:start] + "".join(scaled_blocks) + xml[end:]
+
+
+def peak_memory(parse_function, xml: str) -> int:
+    tracemalloc.start()
+    parse_function(xml)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main(args: argparse.Namespace):
+    with open(args.xml_file) as f:
+        xml = f.read()
+
+    parsers = [("tree", parse_nvidia_xml), ("streaming", parse_nvidia_xml_streaming)]
+    print(f"{'gpus':>6} {'xml size':>10} {'parser':>10} {'time/parse':>12} {'peak memory':>12}")
+    for num_gpus in args.num_gpus:
+        scaled_xml = scale_nvidia_xml(xml, num_gpus)
+        expected = parse_nvidia_xml(scaled_xml)
+        for parser_name, parse_function in parsers:
+            assert parse_function(scaled_xml) == expected, f"{parser_name} parser produced different gpu data"
+            duration = min(timeit.repeat(lambda: parse_function(scaled_xml), number=args.iterations, repeat=3))
+            print(f"{num_gpus:>6} {len(scaled_xml) // 1024:>8}KB {parser_name:>10} "
+                  f"{duration / args.iterations * 1000:>10.3f}ms {peak_memory(parse_function, scaled_xml) // 1024:>10}KB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the tree based and the streaming nvidia-smi xml parser")
+    parser.add_argument("--xml-file", default=os.path.join(DEVICE_QUERY_DIR, "nvidia-smi-output.xml"),
+                        help="nvidia-smi -x -q output that is used as template for the scaled up xml")
+    parser.add_argument("-n", "--num-gpus", type=int, nargs="+", default=[2, 8, 16, 64],
+                        help="number of gpus the template xml should be scaled up to")
+    parser.add_argument("-i", "--iterations", type=int, default=100, help="number of parses per measurement")
+    main(parser.parse_args())
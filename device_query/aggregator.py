@@ -0,0 +1,151 @@
+import argparse
+import configparser
+import logging
+import os
+import subprocess
+import sys
+import time
+import urllib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from device_query import COMPUTE_APPS_QUERY_FIELDS, DEVICE_MINOR_REGEX, GPU_QUERY_FIELDS, NVIDIA_PROC_GPUS_DIR, \
+    GPUChangeTracker, build_gpu_data_from_query, encode_post_data, normalize_pci_bus_id, parse_nvidia_csv
+
+OUTPUT_SEPARATOR = "--labshare-aggregator--"
+# keeps one ssh connection per host open, so that a poll does not have to do a full ssh handshake
+DEFAULT_SSH_OPTIONS = "-o BatchMode=yes -o ControlMaster=auto -o ControlPath=~/.ssh/labshare-%r@%h:%p -o ControlPersist=600"
+
+REMOTE_COMMAND = " ; ".join([
+    f"nvidia-smi --query-gpu={','.join(GPU_QUERY_FIELDS)} --format=csv,noheader,nounits",
+    f"echo {OUTPUT_SEPARATOR}",
+    f"nvidia-smi --query-compute-apps={','.join(COMPUTE_APPS_QUERY_FIELDS)} --format=csv,noheader,nounits",
+    f"echo {OUTPUT_SEPARATOR}",
+    "ps -eo pid=,user:64=",
+    f"echo {OUTPUT_SEPARATOR}",
+    f"grep -H '^Device Minor' {NVIDIA_PROC_GPUS_DIR}/*/information",
+])
+
+
+class Host:
+
+    def __init__(self, config_section, ssh_options, timeout, change_tracker):
+        self.device_name = config_section["device_name"]
+        self.token = config_section["token"]
+        self.ssh_host = config_section.get("ssh_host", self.device_name)
+        self.ssh_options = config_section.get("ssh_options", ssh_options).split()
+        self.timeout = timeout
+        self.change_tracker = change_tracker
+
+    def collect(self):
+        output = subprocess.run(
+            ["ssh", *self.ssh_options, self.ssh_host, REMOTE_COMMAND],
+            stdout=subprocess.PIPE, check=True, timeout=self.timeout,
+        ).stdout.decode("utf-8")
+        return parse_remote_output(output)
+
+
+def parse_minor_numbers(grep_output):
+    # every line looks like /proc/driver/nvidia/gpus/<pci bus id>/information:Device Minor: 0
+    minor_numbers = {}
+    for line in grep_output.splitlines():
+        gpu_dir, _, information = line.rpartition("/information:")
+        match = DEVICE_MINOR_REGEX.match(information)
+        if match is not None:
+            minor_numbers[normalize_pci_bus_id(os.path.basename(gpu_dir))] = int(match.group(1))
+    return minor_numbers
+
+
+def parse_remote_output(output):
+    gpu_output, compute_apps_output, ps_output, minor_number_output = output.split(OUTPUT_SEPARATOR)
+    owners = dict(line.split(maxsplit=1) for line in ps_output.splitlines() if len(line.split()) == 2)
+    return build_gpu_data_from_query(
+        parse_nvidia_csv(gpu_output, len(GPU_QUERY_FIELDS)),
+        parse_nvidia_csv(compute_apps_output, len(COMPUTE_APPS_QUERY_FIELDS)),
+        parse_minor_numbers(minor_number_output),
+        get_owner=lambda pid: owners.get(pid, "Unknown"),
+    )
+
+
+def collect_all(executor, hosts):
+    updates = []
+    futures = [(host, executor.submit(host.collect)) for host in hosts]
+    for host, future in futures:
+        try:
+            gpu_data = future.result()
+        except Exception as e:
+            logging.error(f"Could not collect gpu data of {host.device_name}: {e}")
+            host.change_tracker.reset()
+            continue
+        update = host.change_tracker.build_post_data(host.device_name, gpu_data)
+        update["token"] = host.token
+        updates.append(update)
+    return updates
+
+
+def main(args: argparse.Namespace):
+    # no interpolation, because ssh options may contain % tokens
+    config = configparser.ConfigParser(interpolation=None)
+    config.read("aggregator.ini")
+
+    server_base_url = config["MAIN"]["server_url"]
+    server_url = urllib.parse.urljoin(server_base_url, "/gpu/update/bulk")
+    update_interval = float(config["MAIN"]["update_interval"])
+    encoding = config["MAIN"].get("encoding", "json")
+    compression = config["MAIN"].get("compression", "gzip")
+    ssh_options = config["MAIN"].get("ssh_options", DEFAULT_SSH_OPTIONS)
+    host_timeout = float(config["MAIN"].get("host_timeout", update_interval))
+
+    hosts = []
+    for section_name in config.sections():
+        if section_name == "MAIN":
+            continue
+        change_tracker = GPUChangeTracker(
+            memory_threshold=float(config["MAIN"].get("memory_change_threshold", 50)),
+            utilization_threshold=float(config["MAIN"].get("utilization_change_threshold", 5)),
+            full_update_interval=int(config["MAIN"].get("full_update_interval", 60)),
+        )
+        hosts.append(Host(config[section_name], ssh_options, host_timeout, change_tracker))
+    if len(hosts) == 0:
+        print("At least one host section must be set in aggregator.ini file.")
+        sys.exit(1)
+    hosts_by_name = {host.device_name: host for host in hosts}
+
+    session = requests.Session()
+    session.verify = args.verify
+    with ThreadPoolExecutor(max_workers=int(config["MAIN"].get("max_workers", 32))) as executor:
+        while True:
+            start = time.monotonic()
+            updates = collect_all(executor, hosts)
+            try:
+                encoded_post_data, headers = encode_post_data({"devices": updates}, encoding, compression)
+                logging.info(f"Sending updates of {len(updates)} devices...")
+                r = session.post(server_url, headers=headers, data=encoded_post_data, timeout=update_interval)
+                logging.info(f"Request returned {r.status_code} {r.reason}")
+                r.raise_for_status()
+                for device_name, status_code in r.json()["devices"].items():
+                    if status_code != 200:
+                        logging.error(f"Server did not accept the update of {device_name}: {status_code}")
+                        hosts_by_name[device_name].change_tracker.reset()
+            except Exception as e:
+                logging.error(f"Error: {e}")
+                for host in hosts:
+                    host.change_tracker.reset()
+            time.sleep(max(update_interval - (time.monotonic() - start), 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collects the gpu data of many hosts via ssh and sends it to "
+                                                 "LabShare in one request per interval")
+    parser.add_argument("--verify", default=False,
+                        help="path to the certificate file that should be used to verify requests")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Shows additional log messages")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(format="[%(asctime)s] %(message)s", level=logging.DEBUG)
+    else:
+        logging.basicConfig(format="[%(asctime)s] %(message)s")
+
+    main(args)
@@ -1,66 +1,728 @@
 import argparse
 import configparser
+import functools
+import gzip
 import json
 import logging
+import os
 import pwd
+import queue
+import re
 import subprocess
 import sys
+import threading
+import time
 import urllib
 import xml.etree.ElementTree as ET
+import zlib
+from collections import defaultdict
 from datetime import datetime
 from time import sleep
 
 import requests
 
 
+MEBIBYTE = 1024 ** 2
+USERNAME_CACHE_SIZE = 1024
+PROC_DIR = "/proc"
+# index of the start time in /proc/<pid>/stat, counted from the field after the process name
+PROC_STAT_START_TIME_INDEX = 19
+# index of the real uid in the Uid: line of /proc/<pid>/status, which lists the real, effective, saved and fs uid
+PROC_STATUS_REAL_UID_INDEX = 1
+
+# nvidia-smi can not be queried for the minor number of a gpu, it is looked up by the pci bus id instead
+GPU_QUERY_FIELDS = ["uuid", "memory.total", "memory.used", "memory.free", "utilization.gpu", "name", "pci.bus_id"]
+COMPUTE_APPS_QUERY_FIELDS = ["gpu_uuid", "pid", "used_memory", "process_name"]
+
+# the driver describes every gpu in /proc/driver/nvidia/gpus/<pci bus id>/information
+NVIDIA_PROC_GPUS_DIR = "/proc/driver/nvidia/gpus"
+DEVICE_MINOR_REGEX = re.compile(r"^Device Minor:\s*(\d+)", re.MULTILINE)
+
+GPU_START_TAG_REGEX = re.compile(r"<gpu[\s>]")
+GPU_END_TAG = "</gpu>"
+# only these children of a <gpu> element are needed to build the gpu data
+NVIDIA_XML_GPU_FIELD_TAGS = [
+    (f"<{field}>", f"</{field}>")
+    for field in ("product_name", "uuid", "minor_number", "fb_memory_usage", "utilization", "processes")
+]
+# the MIG devices of a gpu have their own fb_memory_usage, etc., which must not be mistaken for the ones of the gpu
+MIG_DEVICES_START_TAG = "<mig_devices>"
+MIG_DEVICES_END_TAG = "</mig_devices>"
+
+
+def parse_index(value):
+    # the index of a gpu is always its minor number (/dev/nvidia<index>), which Slurm uses to refer to a gpu, and never
+    # the enumeration index of nvidia-smi or CUDA, which may differ from the minor number
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_pci_bus_id(bus_id):
+    # nvidia-smi reports 00000000:17:00.0, the driver names its /proc entries 0000:17:00.0
+    domain, _, rest = bus_id.strip().lower().partition(":")
+    try:
+        return f"{int(domain, 16):04x}:{rest}"
+    except ValueError:
+        return None
+
+
+def read_minor_numbers(proc_dir=NVIDIA_PROC_GPUS_DIR):
+    """
+    Returns a dict that maps the normalized pci bus id of every gpu to the minor number the driver assigned to it.
+    """
+    minor_numbers = {}
+    try:
+        bus_ids = os.listdir(proc_dir)
+    except OSError:
+        return minor_numbers
+    for bus_id in bus_ids:
+        try:
+            with open(os.path.join(proc_dir, bus_id, "information")) as f:
+                match = DEVICE_MINOR_REGEX.search(f.read())
+        except OSError:
+            continue
+        if match is not None:
+            minor_numbers[normalize_pci_bus_id(bus_id)] = int(match.group(1))
+    return minor_numbers
+
+
+def parse_gpu_element(gpu):
+    current_gpu_data = {
+        "name": gpu.find("product_name").text,
+        "uuid": gpu.find("uuid").text,
+    }
+    minor_number = gpu.find("minor_number")
+    if minor_number is not None and parse_index(minor_number.text) is not None:
+        current_gpu_data["index"] = parse_index(minor_number.text)
+
+    memory_usage = gpu.find("fb_memory_usage")
+    memory = {
+        "total": memory_usage.find("total").text,
+        "used": memory_usage.find("used").text,
+        "free": memory_usage.find("free").text,
+    }
+
+    gpu_util= gpu.find("utilization").find("gpu_util").text
+    current_gpu_data["gpu_util"] = gpu_util
+
+    process_block = gpu.find("processes")
+    if process_block.text == "N/A":
+        current_gpu_data["in_use"] = "na"
+    else:
+        current_gpu_data["in_use"] = "no"
+        current_gpu_data["processes"] = []
+        for process in process_block.iter("process_info"):
+            if process.find("type").text.lower() == "c":
+                current_gpu_data["in_use"] = "yes"
+                pid = process.find("pid").text
+                process_info = {
+                    "pid": pid,
+                    "username": get_owner_for_pid(pid),
+                    "name": process.find("process_name").text,
+                    "used_memory": process.find("used_memory").text,
+                }
+                current_gpu_data["processes"].append(process_info)
+    current_gpu_data["memory"] = memory
+    return current_gpu_data
+
+
 def parse_nvidia_xml(xml):
-    gpu_data = []
     root = ET.fromstring(xml)
+    return [parse_gpu_element(gpu) for gpu in root.iter("gpu")]
+
+
+def extract_gpu_fields(xml, start, end):
+    mig_devices_start = xml.find(MIG_DEVICES_START_TAG, start, end)
+    if mig_devices_start != -1:
+        mig_devices_end = xml.find(MIG_DEVICES_END_TAG, mig_devices_start, end)
+        if mig_devices_end == -1:
+            return xml[start:end]
+        # only direct children of <gpu> are searched from here on
+        xml = xml[start:mig_devices_start] + xml[mig_devices_end + len(MIG_DEVICES_END_TAG):end]
+        start, end = 0, len(xml)
+
+    fragments = ["<gpu>"]
+    for start_tag, end_tag in NVIDIA_XML_GPU_FIELD_TAGS:
+        field_start = xml.find(start_tag, start, end)
+        field_end = xml.find(end_tag, field_start, end)
+        if field_start == -1 or field_end == -1:
+            # unexpected layout of the gpu block, hand the whole block to the xml parser
+            return xml[start:end]
+        fragments.append(xml[field_start:field_end + len(end_tag)])
+    fragments.append(GPU_END_TAG)
+    return "".join(fragments)
+
+
+def parse_nvidia_xml_streaming(xml):
+    """
+    Produces the same result as parse_nvidia_xml, but never builds the element tree of the whole dump.
+    The <gpu> blocks and the few fields we need from each of them are located with plain string search and only
+    these small fragments are handed to the xml parser, one gpu at a time.
+    """
+    gpu_data = []
+    position = 0
+    while True:
+        match = GPU_START_TAG_REGEX.search(xml, position)
+        if match is None:
+            break
+        end = xml.index(GPU_END_TAG, match.start()) + len(GPU_END_TAG)
+        gpu_data.append(parse_gpu_element(ET.fromstring(extract_gpu_fields(xml, match.start(), end))))
+        position = end
+    return gpu_data
+
+
+@functools.lru_cache(maxsize=USERNAME_CACHE_SIZE)
+def get_username_for_uid(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        # uid without passwd entry, e.g. a process running inside of a container
+        return str(uid)
+
+
+def get_process_start_time(pid):
+    with open(os.path.join(PROC_DIR, str(pid), "stat")) as f:
+        stat = f.read()
+    # the process name may contain spaces and parentheses, so we split after the last closing parenthesis
+    return int(stat.rsplit(")", 1)[1].split()[PROC_STAT_START_TIME_INDEX])
+
+
+def get_process_uid(pid):
+    # the owner of /proc/<pid> is root for non-dumpable or setuid processes, only the real uid names the user who
+    # started the process
+    with open(os.path.join(PROC_DIR, str(pid), "status")) as f:
+        for line in f:
+            if line.startswith("Uid:"):
+                return int(line.split()[PROC_STATUS_REAL_UID_INDEX])
+    raise OSError(f"No uid in the status of process {pid}")
+
+
+class ProcessOwnerCache:
+    """
+    Caches the owner of each process keyed by pid and process start time, so that a pid that is reused by a new
+    process is never attributed to the owner of the old process.
+    """
 
-    for gpu in root.iter("gpu"):
+    def __init__(self):
+        self.owners = {}
+
+    def get_owner(self, pid):
+        pid = int(pid)
+        try:
+            start_time = get_process_start_time(pid)
+            cached_owner = self.owners.get(pid)
+            if cached_owner is not None and cached_owner[0] == start_time:
+                return cached_owner[1]
+            username = get_username_for_uid(get_process_uid(pid))
+        except OSError:
+            # the process exited while we were looking at it
+            self.owners.pop(pid, None)
+            return "Unknown"
+        self.owners[pid] = (start_time, username)
+        return username
+
+    def prune(self, active_pids):
+        active_pids = {int(pid) for pid in active_pids}
+        for pid in [pid for pid in self.owners if pid not in active_pids]:
+            del self.owners[pid]
+
+
+process_owners = ProcessOwnerCache()
+
+
+def get_owner_for_pid(pid):
+    return process_owners.get_owner(pid)
+
+
+def parse_nvidia_csv(csv_output, num_fields):
+    # the last field is allowed to contain commas (e.g. process names), nvidia-smi does not quote values
+    return [
+        [value.strip() for value in line.split(",", num_fields - 1)]
+        for line in csv_output.splitlines() if len(line.strip()) > 0
+    ]
+
+
+def format_query_value(value, unit):
+    # nvidia-smi reports values that can not be determined as "[N/A]", "[Not Supported]", etc.
+    if value.startswith("["):
+        return "N/A"
+    return f"{value} {unit}"
+
+
+def build_gpu_data_from_query(gpu_rows, compute_app_rows, minor_numbers, get_owner=None):
+    get_owner = get_owner or get_owner_for_pid
+    processes = defaultdict(list)
+    for gpu_uuid, pid, used_memory, process_name in compute_app_rows:
+        processes[gpu_uuid].append({
+            "pid": pid,
+            "username": get_owner(pid),
+            "name": process_name,
+            "used_memory": format_query_value(used_memory, "MiB"),
+        })
+
+    gpu_data = []
+    for uuid, total_memory, used_memory, free_memory, gpu_util, name, pci_bus_id in gpu_rows:
+        gpu_processes = processes.get(uuid, [])
         current_gpu_data = {
-            "name": gpu.find("product_name").text,
-            "uuid": gpu.find("uuid").text,
+            "name": name,
+            "uuid": uuid,
+            "gpu_util": format_query_value(gpu_util, "%"),
+            "in_use": "yes" if len(gpu_processes) > 0 else "no",
+            "processes": gpu_processes,
+            "memory": {
+                "total": format_query_value(total_memory, "MiB"),
+                "used": format_query_value(used_memory, "MiB"),
+                "free": format_query_value(free_memory, "MiB"),
+            },
         }
+        index = minor_numbers.get(normalize_pci_bus_id(pci_bus_id))
+        if index is not None:
+            current_gpu_data["index"] = index
+        gpu_data.append(current_gpu_data)
+    return gpu_data
 
-        memory_usage = gpu.find("fb_memory_usage")
-        memory = {
-            "total": memory_usage.find("total").text,
-            "used": memory_usage.find("used").text,
-            "free": memory_usage.find("free").text,
-        }
 
-        gpu_util= gpu.find("utilization").find("gpu_util").text
-        current_gpu_data["gpu_util"] = gpu_util
-
-        process_block = gpu.find("processes")
-        if process_block.text == "N/A":
-            current_gpu_data["in_use"] = "na"
-        else:
-            current_gpu_data["in_use"] = "no"
-            current_gpu_data["processes"] = []
-            for process in process_block.iter("process_info"):
-                if process.find("type").text.lower() == "c":
-                    current_gpu_data["in_use"] = "yes"
-                    pid = process.find("pid").text
-                    process_info = {
-                        "pid": pid,
-                        "username": get_owner_for_pid(pid),
-                        "name": process.find("process_name").text,
-                        "used_memory": process.find("used_memory").text,
+class GPUCollector:
+    """
+    Base class of all backends that gather the gpu_data list sent to the server.
+    Every gpu in this list looks like the output of parse_nvidia_xml.
+    """
+
+    def collect(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class XMLCollector(GPUCollector):
+
+    def __init__(self, parse_function):
+        self.parse_function = parse_function
+
+    def collect(self):
+        raw_gpu_data = subprocess.check_output(["nvidia-smi", "-x", "-q"]).decode("utf-8")
+        return self.parse_function(raw_gpu_data)
+
+
+class QueryCollector(GPUCollector):
+    """
+    Only asks nvidia-smi for the fields LabShare needs, instead of querying every property of every GPU.
+    """
+
+    def query(self, query_option, fields):
+        csv_output = subprocess.check_output([
+            "nvidia-smi", f"--{query_option}={','.join(fields)}", "--format=csv,noheader,nounits"
+        ]).decode("utf-8")
+        return parse_nvidia_csv(csv_output, len(fields))
+
+    def collect(self):
+        gpu_rows = self.query("query-gpu", GPU_QUERY_FIELDS)
+        compute_app_rows = self.query("query-compute-apps", COMPUTE_APPS_QUERY_FIELDS)
+        return build_gpu_data_from_query(gpu_rows, compute_app_rows, read_minor_numbers())
+
+
+class FallbackCollector(GPUCollector):
+    """
+    Uses the primary collector until it fails with one of the given errors (e.g. because the installed nvidia-smi
+    does not support a query) and permanently switches to the fallback collector afterwards.
+    """
+
+    def __init__(self, primary, fallback, errors=(subprocess.CalledProcessError,)):
+        self.primary = primary
+        self.fallback = fallback
+        self.errors = errors
+        self.use_fallback = False
+
+    def collect(self):
+        if not self.use_fallback:
+            try:
+                return self.primary.collect()
+            except self.errors as e:
+                logging.error(f"{type(self.primary).__name__} failed ({e}), falling back to {type(self.fallback).__name__}")
+                self.use_fallback = True
+                self.primary.close()
+        return self.fallback.collect()
+
+    def close(self):
+        self.primary.close()
+        self.fallback.close()
+
+
+class NvidiaSmiLoop(threading.Thread):
+    """
+    Keeps a single `nvidia-smi --query-gpu=count,... -lms <interval>` child running and parses its output line by
+    line. Every line starts with the number of GPUs, i.e. the number of lines that form one sample, a sample is
+    published as soon as this many lines have been received. The child is restarted whenever it dies.
+    """
+
+    def __init__(self, fields, interval, restart_delay=1.0):
+        super().__init__(daemon=True)
+        self.fields = ["count"] + fields
+        self.command = [
+            "nvidia-smi", f"--query-gpu={','.join(self.fields)}", "--format=csv,noheader,nounits",
+            "-lms", str(max(int(interval * 1000), 1)),
+        ]
+        self.restart_delay = restart_delay
+        self.process = None
+        self.stopped = threading.Event()
+        self.sample_available = threading.Event()
+        self.lock = threading.Lock()
+        self.current_count = None
+        self.current_rows = []
+        self.sample = []
+        self.sample_received_at = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            # a sample that was cut off by the death of the last child must not be completed by the new one
+            self.current_rows = []
+            try:
+                self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, universal_newlines=True)
+                for line in self.process.stdout:
+                    self.handle_line(line)
+                return_code = self.process.wait()
+                if not self.stopped.is_set():
+                    logging.error(f"nvidia-smi loop exited with return code {return_code}, restarting it")
+            except OSError as e:
+                logging.error(f"Could not start nvidia-smi loop: {e}")
+            self.stopped.wait(self.restart_delay)
+
+    def handle_line(self, line):
+        rows = parse_nvidia_csv(line, len(self.fields))
+        if len(rows) == 0:
+            return
+        count, *row = rows[0]
+        try:
+            count = int(count)
+        except ValueError:
+            logging.error(f"Ignoring unexpected line of nvidia-smi loop: {line.strip()}")
+            return
+
+        if count != self.current_count:
+            # the number of GPUs changed (e.g. a GPU fell off the bus), the rows received so far are incomplete
+            self.current_count = count
+            self.current_rows = []
+        self.current_rows.append(row)
+        if len(self.current_rows) < count:
+            return
+
+        with self.lock:
+            self.sample = self.current_rows
+            self.sample_received_at = time.monotonic()
+        self.current_rows = []
+        self.sample_available.set()
+
+    def latest_sample(self, max_age):
+        with self.lock:
+            if self.sample_received_at is None or time.monotonic() - self.sample_received_at > max_age:
+                return None
+            return self.sample
+
+    def stop(self):
+        self.stopped.set()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+class LoopCollector(QueryCollector):
+    """
+    Same data as QueryCollector, but the GPUs are read from a long-lived nvidia-smi process running in loop mode
+    instead of starting nvidia-smi on every poll. The output of `--query-compute-apps` has no count column that would
+    tell where the output of one iteration ends, so compute apps are still queried on every poll.
+    """
+
+    def __init__(self, interval):
+        self.max_sample_age = max(2 * interval, interval + 2)
+        self.gpu_loop = NvidiaSmiLoop(GPU_QUERY_FIELDS, interval)
+        self.gpu_loop.start()
+
+    def collect(self):
+        self.gpu_loop.sample_available.wait(self.max_sample_age)
+        gpu_rows = self.gpu_loop.latest_sample(self.max_sample_age)
+        if gpu_rows is None:
+            raise RuntimeError("nvidia-smi loop did not deliver a recent sample")
+        compute_app_rows = self.query("query-compute-apps", COMPUTE_APPS_QUERY_FIELDS)
+        return build_gpu_data_from_query(gpu_rows, compute_app_rows, read_minor_numbers())
+
+    def close(self):
+        self.gpu_loop.stop()
+
+
+def decode_nvml_string(value):
+    # depending on the version of the NVML bindings strings are returned as bytes or str
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def format_nvml_memory(num_bytes):
+    if num_bytes is None:
+        return "N/A"
+    return f"{num_bytes // MEBIBYTE} MiB"
+
+
+class NVMLCollector(GPUCollector):
+    """
+    Reads memory, utilization and compute processes directly through the NVML bindings (pynvml) of the process.
+    NVML is initialized once and the device handles are kept open across polls.
+    Any module that provides the used pynvml functions can be passed as nvml, e.g. fake_nvml for testing.
+    """
+
+    def __init__(self, nvml=None):
+        if nvml is None:
+            import pynvml as nvml
+        self.nvml = nvml
+        self.nvml.nvmlInit()
+        self.devices = []
+        for index in range(self.nvml.nvmlDeviceGetCount()):
+            handle = self.nvml.nvmlDeviceGetHandleByIndex(index)
+            try:
+                minor_number = self.nvml.nvmlDeviceGetMinorNumber(handle)
+            except self.nvml.NVMLError:
+                # not supported on every platform
+                minor_number = None
+            self.devices.append((
+                handle,
+                decode_nvml_string(self.nvml.nvmlDeviceGetName(handle)),
+                decode_nvml_string(self.nvml.nvmlDeviceGetUUID(handle)),
+                minor_number,
+            ))
+
+    def get_process_name(self, pid):
+        try:
+            return decode_nvml_string(self.nvml.nvmlSystemGetProcessName(pid))
+        except self.nvml.NVMLError:
+            # the process exited in the meantime
+            return "Unknown"
+
+    def collect(self):
+        gpu_data = []
+        for handle, name, uuid, minor_number in self.devices:
+            memory = self.nvml.nvmlDeviceGetMemoryInfo(handle)
+            try:
+                gpu_util = f"{self.nvml.nvmlDeviceGetUtilizationRates(handle).gpu} %"
+            except self.nvml.NVMLError:
+                gpu_util = "N/A"
+
+            current_gpu_data = {
+                "name": name,
+                "uuid": uuid,
+                "gpu_util": gpu_util,
+            }
+            if minor_number is not None:
+                current_gpu_data["index"] = minor_number
+            try:
+                compute_processes = self.nvml.nvmlDeviceGetComputeRunningProcesses(handle)
+            except self.nvml.NVMLError:
+                current_gpu_data["in_use"] = "na"
+            else:
+                current_gpu_data["in_use"] = "yes" if len(compute_processes) > 0 else "no"
+                current_gpu_data["processes"] = [
+                    {
+                        "pid": str(process.pid),
+                        "username": get_owner_for_pid(process.pid),
+                        "name": self.get_process_name(process.pid),
+                        "used_memory": format_nvml_memory(process.usedGpuMemory),
                     }
-                    current_gpu_data["processes"].append(process_info)
-        current_gpu_data["memory"] = memory
-        gpu_data.append(current_gpu_data)
-    return gpu_data
+                    for process in compute_processes
+                ]
+            current_gpu_data["memory"] = {
+                "total": format_nvml_memory(memory.total),
+                "used": format_nvml_memory(memory.used),
+                "free": format_nvml_memory(memory.free),
+            }
+            gpu_data.append(current_gpu_data)
+        return gpu_data
 
+    def close(self):
+        self.nvml.nvmlShutdown()
 
-def get_owner_for_pid(pid):
-    UID = 1
-    for line in open("/proc/{}/status".format(pid)):
-        if line.startswith("Uid:"):
-            uid = int(line.split()[UID])
-            return pwd.getpwuid(uid).pw_name
+
+def build_collector(config):
+    if config.get("xml_parser", "streaming") == "streaming":
+        xml_collector = XMLCollector(parse_nvidia_xml_streaming)
+    else:
+        xml_collector = XMLCollector(parse_nvidia_xml)
+
+    collector_name = config.get("collector", "xml")
+    if collector_name == "xml":
+        return xml_collector
+    if collector_name == "query":
+        return FallbackCollector(QueryCollector(), xml_collector)
+    if collector_name == "loop":
+        return LoopCollector(float(config["update_interval"]))
+    if collector_name == "nvml":
+        try:
+            return NVMLCollector()
+        except Exception as e:
+            logging.error(f"Could not initialize NVML ({e}), falling back to XMLCollector")
+            return xml_collector
+    raise ValueError(f"Unknown collector: {collector_name}")
+
+
+def parse_quantity(value):
+    # turns values like "1234 MiB" or "25 %" into numbers, returns None for "N/A" and the like
+    try:
+        return float(value.split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def exceeds_threshold(old_value, new_value, threshold):
+    old_quantity = parse_quantity(old_value)
+    new_quantity = parse_quantity(new_value)
+    if old_quantity is None or new_quantity is None:
+        return old_value != new_value
+    difference = abs(new_quantity - old_quantity)
+    return difference > 0 and difference >= threshold
+
+
+class GPUChangeTracker:
+    """
+    Decides which GPUs have to be reported to the server. After the first (full) update, only GPUs whose processes
+    changed, or whose memory usage or utilization changed by at least the configured threshold since they were last
+    reported, are sent as a delta. A delta without any GPU is a heartbeat. Every full_update_interval polls, after
+    reset() (i.e. whenever an update did not reach the server) and whenever the set of GPUs changes, a full update
+    is sent again.
+    """
+
+    def __init__(self, memory_threshold=0, utilization_threshold=0, full_update_interval=60):
+        self.memory_threshold = memory_threshold
+        self.utilization_threshold = utilization_threshold
+        self.full_update_interval = full_update_interval
+        self.last_reported = {}
+        self.polls_since_full_update = 0
+        self.full_update_requested = True
+
+    def reset(self):
+        # may be called from the sender thread, the next update built by the main thread will be a full update
+        self.full_update_requested = True
+
+    def has_changed(self, gpu, last_reported_gpu):
+        if gpu.get("in_use") != last_reported_gpu.get("in_use"):
+            return True
+        pids = [process["pid"] for process in gpu.get("processes", [])]
+        if pids != [process["pid"] for process in last_reported_gpu.get("processes", [])]:
+            return True
+        if exceeds_threshold(last_reported_gpu["memory"]["used"], gpu["memory"]["used"], self.memory_threshold):
+            return True
+        return exceeds_threshold(last_reported_gpu["gpu_util"], gpu["gpu_util"], self.utilization_threshold)
+
+    def build_post_data(self, device_name, gpu_data):
+        self.polls_since_full_update += 1
+        uuids = {gpu["uuid"] for gpu in gpu_data}
+        if self.full_update_requested or uuids != self.last_reported.keys() \
+                or self.polls_since_full_update >= self.full_update_interval:
+            self.full_update_requested = False
+            self.last_reported = {gpu["uuid"]: gpu for gpu in gpu_data}
+            self.polls_since_full_update = 0
+            return {
+                "gpu_data": gpu_data,
+                "device_name": device_name,
+            }
+
+        changed_gpus = [gpu for gpu in gpu_data if self.has_changed(gpu, self.last_reported[gpu["uuid"]])]
+        self.last_reported.update((gpu["uuid"], gpu) for gpu in changed_gpus)
+        return {
+            "gpu_data": changed_gpus,
+            "device_name": device_name,
+            "delta": True,
+        }
+
+
+def encode_post_data(post_data, encoding="json", compression="gzip"):
+    if encoding == "msgpack":
+        import msgpack
+        body = msgpack.packb(post_data, use_bin_type=True)
+        headers = {"Content-Type": "application/msgpack"}
+    elif encoding == "json":
+        body = json.dumps(post_data, separators=(",", ":")).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+    else:
+        raise ValueError(f"Unknown encoding: {encoding}")
+
+    if compression == "gzip":
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    elif compression == "deflate":
+        body = zlib.compress(body)
+        headers["Content-Encoding"] = "deflate"
+    elif compression != "none":
+        raise ValueError(f"Unknown compression: {compression}")
+    return body, headers
+
+
+class UpdateSender(threading.Thread):
+    """
+    Sends updates to the server from a background thread, so that a slow server never delays the next sample.
+    All requests go through one persistent session, i.e. the connection to the server is kept alive between updates.
+    At most queue_size updates wait to be sent, if a new update arrives while the queue is full, the oldest waiting
+    update is dropped. on_failure is called whenever an update is dropped or does not reach the server.
+    close() sends the updates that are still waiting and stops the thread.
+    """
+
+    def __init__(self, server_url, headers, verify, on_failure, encoding="json", compression="gzip",
+                 request_timeout=30, queue_size=1):
+        super().__init__(daemon=True)
+        self.server_url = server_url
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.verify = verify
+        self.on_failure = on_failure
+        self.encoding = encoding
+        self.compression = compression
+        self.request_timeout = request_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+
+    def submit(self, post_data):
+        while True:
+            try:
+                self.queue.put_nowait(post_data)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    logging.warning("Server is too slow, dropping the oldest pending update")
+                    self.on_failure()
+                except queue.Empty:
+                    pass
+
+    def send(self, post_data):
+        encoded_post_data, encoding_headers = encode_post_data(post_data, self.encoding, self.compression)
+
+        logging.info(f"Sending request...")
+        r = self.session.post(self.server_url, headers=encoding_headers, data=encoded_post_data,
+                              timeout=self.request_timeout)
+        logging.info(f"Request returned {r.status_code} {r.reason}")
+        if r.status_code == 415 and (self.encoding, self.compression) != ("json", "none"):
+            logging.error(f"Server does not accept {self.encoding} with {self.compression} compression, "
+                          f"using plain json")
+            self.encoding, self.compression = "json", "none"
+        if not r.ok:
+            # the server did not take our update (e.g. 409 if it does not know the state to apply a delta to)
+            self.on_failure()
+
+    def run(self):
+        while True:
+            post_data = self.queue.get()
+            if post_data is None:
+                break
+            try:
+                self.send(post_data)
+            except Exception as e:
+                logging.error(f"Error while sending update: {e}")
+                self.on_failure()
+        self.session.close()
+
+    def close(self, timeout=None):
+        try:
+            # waits until the sender took the waiting updates, so that none of them is dropped
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            logging.error("Could not send the remaining updates before shutting down")
+            return
+        self.join(timeout)
 
 
 def main(args):
@@ -71,31 +733,47 @@ def main(args):
     server_url = urllib.parse.urljoin(server_base_url, "/gpu/update")
     update_interval = float(config["MAIN"]["update_interval"])
     device_name = config["MAIN"]["device_name"]
+    collector = build_collector(config["MAIN"])
+    if config["MAIN"].getboolean("delta_updates", True):
+        change_tracker = GPUChangeTracker(
+            memory_threshold=float(config["MAIN"].get("memory_change_threshold", 50)),
+            utilization_threshold=float(config["MAIN"].get("utilization_change_threshold", 5)),
+            full_update_interval=int(config["MAIN"].get("full_update_interval", 60)),
+        )
+    else:
+        # every poll is a full update
+        change_tracker = GPUChangeTracker(full_update_interval=1)
 
     auth_token = config["MAIN"]["token"]
     if auth_token == "":
         print("Authentication token must be manually set in config.ini file.")
         sys.exit(1)
     headers = {"Authorization": f"Token {auth_token}"}
+    sender = UpdateSender(
+        server_url,
+        headers,
+        args.verify,
+        on_failure=change_tracker.reset,
+        encoding=config["MAIN"].get("encoding", "json"),
+        compression=config["MAIN"].get("compression", "gzip"),
+        request_timeout=float(config["MAIN"].get("request_timeout", 30)),
+    )
+    sender.start()
 
-    while True:
-        try:
-            raw_gpu_data = subprocess.check_output(["nvidia-smi", "-x", "-q"]).decode("utf-8")
-            gpu_data = parse_nvidia_xml(raw_gpu_data)
-
-            post_data = {
-                "gpu_data": gpu_data,
-                "device_name": device_name
-            }
-            encoded_post_data = bytes(json.dumps(post_data, indent=4), "utf-8")
-
-            logging.info(f"Sending request...")
-            r = requests.post(server_url, headers=headers, data=encoded_post_data, verify=args.verify)
-            logging.info(f"Request returned {r.status_code} {r.reason}")
-        except Exception as e:
-            logging.error(f"Error: {e}")
-        finally:
-            sleep(update_interval)
+    try:
+        while True:
+            try:
+                gpu_data = collector.collect()
+                process_owners.prune(process["pid"] for gpu in gpu_data for process in gpu.get("processes", []))
+                sender.submit(change_tracker.build_post_data(device_name, gpu_data))
+            except Exception as e:
+                logging.error(f"Error: {e}")
+                change_tracker.reset()
+            finally:
+                sleep(update_interval)
+    finally:
+        sender.close(timeout=sender.request_timeout)
+        collector.close()
 
 
 if __name__ == "__main__":
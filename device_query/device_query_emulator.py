@@ -1,8 +1,10 @@
 import argparse
 import logging
 import random
+import sys
 from unittest.mock import patch
 
+import fake_nvml
 from device_query import main
 
 
@@ -27,6 +29,7 @@ def parse_nvidia_xml(xml):
     gpu_data = [{
         "name": "NVIDIA Super Ultra",
         "uuid": "test123",
+        "index": 0,
         "memory": memory,
         "gpu_util": f"{random.randint(0, 100)} %",
         "processes": processes,
@@ -51,5 +54,8 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(format="[%(asctime)s] %(message)s")
 
-    with patch('device_query.parse_nvidia_xml', parse_nvidia_xml), patch('subprocess.check_output', mocked_subprocess_run):
+    with patch('device_query.parse_nvidia_xml', parse_nvidia_xml), \
+            patch('device_query.parse_nvidia_xml_streaming', parse_nvidia_xml), \
+            patch('subprocess.check_output', mocked_subprocess_run), \
+            patch.dict(sys.modules, {'pynvml': fake_nvml}):
         main(args)
@@ -0,0 +1,120 @@
+"""
+Minimal stand-in for the pynvml module (nvidia-ml-py) that covers the functions used by the NVMLCollector.
+It can be passed to the NVMLCollector or put into sys.modules as pynvml to run device_query on machines without GPUs.
+The simulated GPUs can be changed by assigning a new list of FakeGPU objects to `gpus`.
+"""
+from collections import namedtuple
+from dataclasses import dataclass, field
+from typing import List
+
+MEBIBYTE = 1024 ** 2
+
+Memory = namedtuple("Memory", ["total", "free", "used"])
+Utilization = namedtuple("Utilization", ["gpu", "memory"])
+ProcessInfo = namedtuple("ProcessInfo", ["pid", "usedGpuMemory"])
+
+
+class NVMLError(Exception):
+    pass
+
+
+class NVMLError_NotSupported(NVMLError):
+    pass
+
+
+class NVMLError_Uninitialized(NVMLError):
+    pass
+
+
+class NVMLError_NotFound(NVMLError):
+    pass
+
+
+@dataclass
+class FakeProcess:
+    pid: int
+    name: str = "python"
+    used_memory: int = 1000 * MEBIBYTE
+
+
+@dataclass
+class FakeGPU:
+    uuid: str
+    name: str = "NVIDIA Super Ultra"
+    minor_number: int = 0
+    total_memory: int = 12000 * MEBIBYTE
+    used_memory: int = 0
+    utilization: int = 0
+    processes: List[FakeProcess] = field(default_factory=list)
+    utilization_supported: bool = True
+    processes_supported: bool = True
+
+
+gpus = [FakeGPU(uuid="GPU-fake-0", minor_number=0), FakeGPU(uuid="GPU-fake-1", minor_number=1)]
+initialized = False
+
+
+def _check_initialized():
+    if not initialized:
+        raise NVMLError_Uninitialized("NVML is not initialized")
+
+
+def nvmlInit():
+    global initialized
+    initialized = True
+
+
+def nvmlShutdown():
+    global initialized
+    _check_initialized()
+    initialized = False
+
+
+def nvmlDeviceGetCount():
+    _check_initialized()
+    return len(gpus)
+
+
+def nvmlDeviceGetHandleByIndex(index):
+    _check_initialized()
+    return gpus[index]
+
+
+def nvmlDeviceGetName(handle):
+    return handle.name
+
+
+def nvmlDeviceGetUUID(handle):
+    return handle.uuid
+
+
+def nvmlDeviceGetMinorNumber(handle):
+    return handle.minor_number
+
+
+def nvmlDeviceGetMemoryInfo(handle):
+    _check_initialized()
+    return Memory(total=handle.total_memory, free=handle.total_memory - handle.used_memory, used=handle.used_memory)
+
+
+def nvmlDeviceGetUtilizationRates(handle):
+    _check_initialized()
+    if not handle.utilization_supported:
+        raise NVMLError_NotSupported("Not Supported")
+    return Utilization(gpu=handle.utilization, memory=int(100 * handle.used_memory / handle.total_memory))
+
+
+def nvmlDeviceGetComputeRunningProcesses(handle):
+    _check_initialized()
+    if not handle.processes_supported:
+        raise NVMLError_NotSupported("Not Supported")
+    return [ProcessInfo(pid=process.pid, usedGpuMemory=process.used_memory) for process in handle.processes]
+
+
+def nvmlSystemGetProcessName(pid):
+    _check_initialized()
+    for gpu in gpus:
+        for process in gpu.processes:
+            if process.pid == pid:
+                return process.name
+    raise NVMLError_NotFound("Not Found")
@@ -0,0 +1,28 @@
+import argparse
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET_PATH = "/run/labshare/slurm_updater.sock"
+
+
+def notify(socket_path: str, hostlist: str):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+        notify_socket.sendto(hostlist.encode("utf-8"), socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tells the slurm updater that the allocations of some nodes changed. "
+                                                 "Meant to be called from PrologSlurmctld and EpilogSlurmctld")
+    parser.add_argument("hostlist", nargs="?", default=os.environ.get("SLURM_JOB_NODELIST", ""),
+                        help="nodes whose allocations changed (default: $SLURM_JOB_NODELIST)")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="notify_socket of the slurm updater")
+    args = parser.parse_args()
+
+    if args.hostlist == "":
+        sys.exit(0)
+    try:
+        notify(args.socket, args.hostlist)
+    except OSError as e:
+        # a failing prolog would drain the node, the slurm updater picks the change up with its next poll anyway
+        print(f"Could not notify the slurm updater: {e}", file=sys.stderr)
@@ -1,85 +1,305 @@
 import argparse
 import configparser
+import itertools
 import json
 import logging
+import os
+import queue
 import re
-
+import socket
 import subprocess
 import sys
+import threading
 import time
 import urllib
 
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import requests
 
-NODES_REGEX = re.compile(r"^(?P<prefix>.+)\[(?P<suffix>.*)]$")
-MULTIPLE_NODES_REGEX = re.compile(r"^(?P<first>.*)-(?P<last>.*)$")
-TWO_NODES_REGEX = re.compile(r"^(?P<first>.*),(?P<last>.*)$")
-COMMA_NODES_REGEX = re.compile(r"(?P<gpu_id>\d+),*")
+# a hostlist is scanned in one pass: bracket expressions, top level commas and the text in between
+HOSTLIST_TOKEN_REGEX = re.compile(r"\[(?P<ranges>[^\[\]]*)]|(?P<separator>,)|(?P<text>[^\[\],]+)")
+RANGES_REGEX = re.compile(r"\d+(?:-\d+)?(?:,\d+(?:-\d+)?)*")
+RANGE_REGEX = re.compile(r"(\d+)(?:-(\d+))?")
 GPU_ID_REGEX = re.compile(r"\(IDX:(?P<gpu_ids>[-,\d]+|N/A)\)")
 
+# (first, last, width) of each range inside of a bracket expression
+Ranges = List[Tuple[int, int, int]]
+
+
+def parse_ranges(ranges: str) -> Ranges:
+    """
+    Parses the content of a bracket expression like "01-04,07,10-12". Numbers are zero padded to the width of the
+    first number of their range, like Slurm does it.
+    """
+    ranges = ranges.replace(" ", "")
+    if RANGES_REGEX.fullmatch(ranges) is None:
+        raise ValueError(f"Invalid ranges: {ranges}")
+    parsed_ranges = []
+    for first, last in RANGE_REGEX.findall(ranges):
+        if last == "":
+            parsed_ranges.append((int(first), int(first), len(first)))
+        elif int(last) < int(first):
+            raise ValueError(f"Invalid range: {first}-{last}")
+        else:
+            parsed_ranges.append((int(first), int(last), len(first)))
+    return parsed_ranges
 
-def extract_multi_match(match: re.Match, prefix: str = '') -> List[str]:
-    matches = []
-    first = int(match.group('first'))
-    last = int(match.group('last'))
-    num = last - first
-    for i in range(num + 1):
-        node_name = prefix + f"{first + i:02}"
-        matches.append(node_name)
-    return matches
 
+def expand_ranges(ranges: Ranges) -> Iterator[str]:
+    for first, last, width in ranges:
+        for number in range(first, last + 1):
+            yield f"{number:0{width}}"
+
+
+def tokenize_hostlist(hostlist: str) -> Iterator[List]:
+    """
+    Splits a hostlist like "node[01-04,07],gpu[1-2]x[1-2],login" into one pattern per host expression. A pattern is
+    a list of strings and parsed bracket expressions.
+    """
+    pattern = []
+    position = 0
+    for match in HOSTLIST_TOKEN_REGEX.finditer(hostlist):
+        if match.start() != position:
+            raise ValueError(f"Invalid hostlist: {hostlist}")
+        position = match.end()
+        if match.group("separator") is not None:
+            if len(pattern) > 0:
+                yield pattern
+            pattern = []
+        elif match.group("ranges") is not None:
+            pattern.append(parse_ranges(match.group("ranges")))
+        else:
+            pattern.append(match.group("text"))
+    if position != len(hostlist):
+        raise ValueError(f"Invalid hostlist: {hostlist}")
+    if len(pattern) > 0:
+        yield pattern
 
-def extract_comma_match(matched_items: List[str], prefix: str = '') -> List[str]:
-    return [prefix + matched_item for matched_item in matched_items]
+
+def expand_pattern(pattern: List) -> Iterator[str]:
+    # only the numbers of each bracket expression are built up front, the host names are built while iterating
+    parts = [(part,) if isinstance(part, str) else tuple(expand_ranges(part)) for part in pattern]
+    if len(parts) == 1:
+        return iter(parts[0])
+    return map("".join, itertools.product(*parts))
+
+
+def expand_hostlist(hostlist: str) -> Iterator[str]:
+    """
+    Lazily yields the names of all hosts in a Slurm hostlist. Supports mixed ranges ("node[01-04,07,10-12]"),
+    zero padding of any width and several bracket expressions per host ("rack[1-2]-node[01-16]").
+    """
+    if "[" not in hostlist and "," not in hostlist:
+        # a single host, which is the most common case
+        yield hostlist
+        return
+    for pattern in tokenize_hostlist(hostlist):
+        yield from expand_pattern(pattern)
+
+
+def parse_gpu_ids(gpu_info: str) -> List[int]:
+    # the indices of all gres types of a node are counted together, e.g. gpu:a:1(IDX:0),gpu:b:2(IDX:1-2)
+    gpu_ids = []
+    for ids in GPU_ID_REGEX.findall(gpu_info):
+        if ids != "N/A":
+            gpu_ids.extend(int(gpu_id) for gpu_id in expand_ranges(parse_ranges(ids)))
+    return gpu_ids
 
 
 def parse_sinfo_output(sinfo_output: str) -> Dict[str, list]:
-    lines = [stripped for line in sinfo_output.split('\n') if len(stripped := line.strip()) > 0]
     node_info = {}
+    # most lines of a large cluster share one of a few gres strings
+    gpu_ids_by_gpu_info = {}
+    for line in sinfo_output.splitlines():
+        columns = line.split()
+        if len(columns) == 0:
+            continue
+        nodes, gpu_info = columns[0], "".join(columns[1:])
+        try:
+            if gpu_info not in gpu_ids_by_gpu_info:
+                gpu_ids_by_gpu_info[gpu_info] = parse_gpu_ids(gpu_info)
+            gpu_ids = gpu_ids_by_gpu_info[gpu_info]
+            for node_name in expand_hostlist(nodes):
+                node_info[node_name] = gpu_ids
+        except ValueError as e:
+            logging.error(f"Could not parse sinfo line {line.strip()}: {e}")
 
-    for item in lines:
-        nodes, gpu_info = item.split()
-        node_names = []
-        match = NODES_REGEX.match(nodes)
-        if match is None:
-            # we have only one node
-            node_names.append(nodes)
-        else:
-            node_prefix = match.group('prefix')
-            nodes_match = MULTIPLE_NODES_REGEX.match(match.group('suffix'))
-            if nodes_match is not None:
-                # we have to handle multiple nodes
-                node_names.extend(extract_multi_match(nodes_match, prefix=node_prefix))
-            elif (comma_nodes_match := COMMA_NODES_REGEX.findall(match.group('suffix'))) is not None:
-                node_names.extend(extract_comma_match(comma_nodes_match, prefix=node_prefix))
-            else:
-                logging.error(f"Could not determine node names from suffix: {match.group('suffix')}, full string: {nodes}")
-                continue
+    return node_info
 
-        gpu_types = GPU_ID_REGEX.findall(gpu_info)
-        all_gpu_ids = []
-        for idx, gpu_id in enumerate(gpu_types):
-            gpu_id_match = MULTIPLE_NODES_REGEX.match(gpu_id)
-            gpu_ids = []
-            if gpu_id_match is not None:
-                # there are multiple gpus
-                gpu_ids.extend(extract_multi_match(gpu_id_match))
-            elif len((gpu_id_match := COMMA_NODES_REGEX.findall(gpu_id))) > 0:
-                # there are comma separated GPUS
-                gpu_ids.extend(extract_comma_match(gpu_id_match))
-            else:
-                if gpu_id != "N/A":
-                    gpu_ids.append(gpu_id)
-            all_gpu_ids.extend([idx + int(i) for i in gpu_ids])
 
-        for node_name in node_names:
-            node_info[node_name] = all_gpu_ids
+class AllocationTracker:
+    """
+    Decides which allocations have to be sent to the server. Only nodes whose allocated GPUs changed since the last
+    successful update are sent, a node that disappeared from the Slurm output is sent without allocations. All
+    allocations are sent again every heartbeat_interval seconds and after reset() (i.e. whenever an update did not
+    reach the server).
+    """
+
+    def __init__(self, heartbeat_interval: float = 300):
+        self.heartbeat_interval = heartbeat_interval
+        self.last_sent = {}
+        self.last_full_update = None
+
+    def reset(self):
+        self.last_full_update = None
 
+    def build_post_data(self, node_info: Dict[str, list], now: float) -> Optional[Dict[str, list]]:
+        if self.last_full_update is None or now - self.last_full_update >= self.heartbeat_interval:
+            self.last_full_update = now
+            self.last_sent = dict(node_info)
+            return node_info
+
+        changed_nodes = {
+            node_name: gpu_ids for node_name, gpu_ids in node_info.items() if self.last_sent.get(node_name) != gpu_ids
+        }
+        changed_nodes.update((node_name, []) for node_name in self.last_sent.keys() - node_info.keys())
+        self.last_sent = dict(node_info)
+        if len(changed_nodes) == 0:
+            return None
+        return changed_nodes
+
+    def build_node_post_data(self, node_info: Dict[str, list]) -> Optional[Dict[str, list]]:
+        # node_info only contains some nodes of the cluster (e.g. the nodes of a job that just started)
+        changed_nodes = {
+            node_name: gpu_ids for node_name, gpu_ids in node_info.items() if self.last_sent.get(node_name) != gpu_ids
+        }
+        self.last_sent.update(changed_nodes)
+        if len(changed_nodes) == 0:
+            return None
+        return changed_nodes
+
+
+def parse_scontrol_json(scontrol_output: str) -> Dict[str, list]:
+    node_info = {}
+    gpu_ids_by_gpu_info = {}
+    for node in json.loads(scontrol_output)["nodes"]:
+        gpu_info = node.get("gres_used") or ""
+        try:
+            if gpu_info not in gpu_ids_by_gpu_info:
+                gpu_ids_by_gpu_info[gpu_info] = parse_gpu_ids(gpu_info)
+            node_info[node["name"]] = gpu_ids_by_gpu_info[gpu_info]
+        except ValueError as e:
+            logging.error(f"Could not parse gres of node {node['name']}: {e}")
     return node_info
 
 
+def parse_squeue_json(squeue_output: str) -> Dict[Tuple[str, int], dict]:
+    """
+    Returns the running job that holds each allocated GPU, identified by node name and GPU index.
+    """
+    jobs = {}
+    for job in json.loads(squeue_output)["jobs"]:
+        # the job state is a string in Slurm < 23.02 and a list of states afterwards
+        job_state = job.get("job_state")
+        if "RUNNING" not in (job_state if isinstance(job_state, list) else [job_state]):
+            continue
+        start_time = job.get("start_time")
+        if isinstance(start_time, dict):
+            start_time = start_time.get("number") if start_time.get("set", True) else None
+        job_data = {"job_id": job["job_id"], "user": job.get("user_name", ""), "start_time": start_time}
+        # gres_detail contains the allocated gres of every node of the job in the order of the hostlist
+        for node_name, gres in zip(expand_hostlist(job.get("nodes") or ""), job.get("gres_detail") or []):
+            for gpu_id in parse_gpu_ids(gres):
+                jobs[(node_name, gpu_id)] = job_data
+    return jobs
+
+
+def attach_jobs(node_info: Dict[str, list], jobs: Dict[Tuple[str, int], dict]) -> Dict[str, list]:
+    return {
+        node_name: [dict(jobs.get((node_name, gpu_id), {}), index=gpu_id) for gpu_id in gpu_ids]
+        for node_name, gpu_ids in node_info.items()
+    }
+
+
+class SlurmQuery:
+    """
+    Reads the allocations of all nodes or of the given nodes from Slurm. With the backend "auto", the json output of
+    scontrol is used and sinfo is used instead as soon as scontrol does not support json output.
+    """
+
+    def __init__(self, backend: str = "auto"):
+        self.backend = backend
+
+    def query_json(self, node_names: Optional[List[str]] = None) -> Dict[str, list]:
+        command = ["scontrol", "--json", "show", "nodes"]
+        if node_names is not None:
+            command.append(",".join(node_names))
+        output = subprocess.check_output(command, stderr=subprocess.DEVNULL)
+        return parse_scontrol_json(output.decode("utf-8"))
+
+    def query_sinfo(self, node_names: Optional[List[str]] = None) -> Dict[str, list]:
+        command = ['sinfo', '-O', "NodeList,GresUsed:60", '-h']
+        if node_names is not None:
+            command.extend(["-n", ",".join(node_names)])
+        return parse_sinfo_output(subprocess.check_output(command).decode("utf-8"))
+
+    def query_jobs(self, node_names: Optional[List[str]] = None) -> Dict[Tuple[str, int], dict]:
+        command = ["squeue", "--json"]
+        if node_names is not None:
+            command.extend(["-w", ",".join(node_names)])
+        try:
+            output = subprocess.check_output(command, stderr=subprocess.DEVNULL)
+            return parse_squeue_json(output.decode("utf-8"))
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+            # the allocations are sent without the jobs that hold them
+            logging.error(f"Could not read the jobs from squeue: {e}")
+            return {}
+
+    def query(self, node_names: Optional[List[str]] = None) -> Dict[str, list]:
+        """
+        Returns the allocated GPUs of every node. Each GPU is a dict with its index and, if known, the id, user and
+        start time of the job that holds it (only available with json output).
+        """
+        if self.backend == "sinfo":
+            return attach_jobs(self.query_sinfo(node_names), {})
+        try:
+            node_info = self.query_json(node_names)
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+            if self.backend == "json":
+                raise
+            # Slurm versions before 21.08 do not support json output
+            logging.warning(f"Could not read the json output of scontrol, falling back to sinfo: {e}")
+            self.backend = "sinfo"
+            return attach_jobs(self.query_sinfo(node_names), {})
+        return attach_jobs(node_info, self.query_jobs(node_names))
+
+
+class NotificationReceiver(threading.Thread):
+    """
+    Receives the hostlists sent by slurm_notify.py (e.g. from PrologSlurmctld/EpilogSlurmctld) on a UNIX datagram
+    socket and puts them into a queue, so that the allocations of these nodes can be updated right away.
+    """
+
+    def __init__(self, socket_path: str, notifications: queue.Queue):
+        super().__init__(daemon=True)
+        self.notifications = notifications
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(socket_path)
+
+    def run(self):
+        while True:
+            hostlist = self.socket.recv(65536).decode("utf-8").strip()
+            if len(hostlist) > 0:
+                self.notifications.put(hostlist)
+
+
+def get_notified_nodes(notifications: queue.Queue, hostlist: str) -> List[str]:
+    # jobs that start or end at the same time are handled in one update
+    hostlists = [hostlist]
+    while not notifications.empty():
+        hostlists.append(notifications.get_nowait())
+    node_names = set()
+    for hostlist in hostlists:
+        try:
+            node_names.update(expand_hostlist(hostlist))
+        except ValueError as e:
+            logging.error(f"Received invalid hostlist {hostlist}: {e}")
+    return sorted(node_names)
+
+
 def main(args: argparse.Namespace):
     config = configparser.ConfigParser()
     config.read("slurm_update.ini")
@@ -87,6 +307,8 @@ def main(args: argparse.Namespace):
     server_base_url = config["MAIN"]["server_url"]
     server_url = urllib.parse.urljoin(server_base_url, "/gpu/allocations")
     update_interval = float(config["MAIN"]["update_interval"])
+    slurm_query = SlurmQuery(config["MAIN"].get("backend", "auto"))
+    tracker = AllocationTracker(heartbeat_interval=float(config["MAIN"].get("heartbeat_interval", 300)))
 
     auth_token = config["MAIN"]["token"]
     if auth_token == "":
@@ -94,19 +316,43 @@ def main(args: argparse.Namespace):
         sys.exit(1)
     headers = {"Authorization": f"Token {auth_token}"}
 
+    notifications = queue.Queue()
+    notify_socket = config["MAIN"].get("notify_socket", "")
+    if notify_socket != "":
+        NotificationReceiver(notify_socket, notifications).start()
+
+    next_update = time.monotonic()
     while True:
         try:
-            sinfo_output = subprocess.check_output(['sinfo', '-O', "NodeList,GresUsed:60", '-h']).decode("utf-8")
-            node_info = parse_sinfo_output(sinfo_output)
+            hostlist = notifications.get(timeout=max(next_update - time.monotonic(), 0))
+        except queue.Empty:
+            hostlist = None
+
+        try:
+            if hostlist is None:
+                # polling all nodes reconciles allocations we were not notified about
+                next_update = time.monotonic() + update_interval
+                post_data = tracker.build_post_data(slurm_query.query(), time.monotonic())
+            else:
+                node_names = get_notified_nodes(notifications, hostlist)
+                if len(node_names) == 0:
+                    continue
+                node_info = slurm_query.query(node_names)
+                post_data = tracker.build_node_post_data(
+                    {node_name: node_info[node_name] for node_name in node_names if node_name in node_info}
+                )
 
-            post_data = json.dumps(node_info).encode("utf-8")
-            logging.info("posting reservation data to server")
-            response = requests.post(server_url, headers=headers, data=post_data, verify=args.verify)
+            if post_data is None:
+                logging.debug("allocations did not change")
+                continue
+            logging.info(f"posting reservation data of {len(post_data)} nodes to server")
+            response = requests.post(server_url, headers=headers, data=json.dumps(post_data).encode("utf-8"),
+                                     verify=args.verify)
             logging.info(f"Response from Server: {response.status_code} {response.reason}")
+            response.raise_for_status()
         except Exception as e:
             logging.error(f"Error: {e}")
-        finally:
-            time.sleep(update_interval)
+            tracker.reset()
 
 
 if __name__ == "__main__":
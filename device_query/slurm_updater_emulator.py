@@ -1,10 +1,15 @@
 import argparse
+import json
 import logging
 import random
+import subprocess
+from typing import Optional
 from unittest.mock import patch
 
 from slurm_updater import main
 
+# set by --sinfo
+use_sinfo = False
 
 SINFO_OUTPUT = """
 fb10dl[03,06,11]    gpu:1080ti:1(IDX:{gpu_ids})                                         
@@ -38,7 +43,27 @@ def build_random_ids(add_padding: bool = True) -> str:
     return ids
 
 
-def mocked_subprocess_run(*args, **kwargs):
+def build_scontrol_output(node_names: Optional[str] = None) -> str:
+    with open("scontrol-show-nodes.json") as f:
+        scontrol_output = json.load(f)
+    if node_names is not None:
+        scontrol_output["nodes"] = [node for node in scontrol_output["nodes"] if node["name"] in node_names.split(",")]
+    # allocations only change from time to time, so that most polls are not sent to the server
+    if random.random() < 0.2 and len(scontrol_output["nodes"]) > 0:
+        node = random.choice(scontrol_output["nodes"])
+        gpu_ids = build_random_ids(add_padding=False)
+        node["gres_used"] = f"gpu:emulated:1(IDX:{gpu_ids})"
+    return json.dumps(scontrol_output)
+
+
+def mocked_subprocess_run(command, *args, **kwargs):
+    if command[0] in ("scontrol", "squeue") and use_sinfo:
+        raise subprocess.CalledProcessError(1, command)
+    if command[0] == "scontrol":
+        return build_scontrol_output(command[4] if len(command) > 4 else None).encode("utf-8")
+    if command[0] == "squeue":
+        with open("squeue-jobs.json", "rb") as f:
+            return f.read()
     gpu_ids = build_random_ids(add_padding=False)
     node_ids = build_random_ids()
     return SINFO_OUTPUT.format(gpu_ids=gpu_ids, node_ids=node_ids, test_ids=random.choice(["0", "N/A"])).encode("utf-8")
@@ -49,7 +74,10 @@ if __name__ == "__main__":
     parser.add_argument("--verify", default=False,
                         help="path to the certificate file that should be used to verify requests")
     parser.add_argument("-v", "--verbose", action="store_true", help="Shows additional log messages")
+    parser.add_argument("--sinfo", action="store_true",
+                        help="emulate a Slurm version without json output, i.e. the sinfo fallback")
     args = parser.parse_args()
+    use_sinfo = args.sinfo
 
     if args.verbose:
         logging.basicConfig(format="[%(asctime)s] %(message)s", level=logging.DEBUG)
@@ -6,11 +6,23 @@ from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from guardian.admin import GuardedModelAdmin
 
+from . import permissions
 from .models import Device, EmailAddress
 
 
 class DeviceAdmin(GuardedModelAdmin):
-    pass
+
+    def obj_perms_manage_user_view(self, request, object_pk, user_id):
+        response = super(DeviceAdmin, self).obj_perms_manage_user_view(request, object_pk, user_id)
+        if request.method == 'POST':
+            permissions.invalidate()
+        return response
+
+    def obj_perms_manage_group_view(self, request, object_pk, group_id):
+        response = super(DeviceAdmin, self).obj_perms_manage_group_view(request, object_pk, group_id)
+        if request.method == 'POST':
+            permissions.invalidate()
+        return response
 
 admin.site.register(Device, DeviceAdmin)
 admin.site.register(EmailAddress)
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class LabshareConfig(AppConfig):
+    name = 'labshare'
+
+    def ready(self):
+        # connects the signal receivers that keep the permission index up to date and configure new connections
+        from labshare import database, permissions  # noqa: F401
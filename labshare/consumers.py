@@ -1,33 +1,88 @@
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+import asyncio
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 
 from labshare.models import Device
-from labshare.utils import publish_device_state
+from labshare.permissions import can_use_device, get_visible_devices
+from labshare.utils import build_update_message, get_device_state, get_device_states
+
+
+@database_sync_to_async
+def get_device_state_for_user(user, device_name):
+    """
+    Returns the last known state of the given device or None, if the device does not exist or the user may not use it.
+    """
+    try:
+        device = Device.objects.get(name=device_name)
+    except Device.DoesNotExist:
+        return None
+    if not can_use_device(user, device):
+        return None
+    return get_device_state(device_name) or device.serialize()
+
 
+@database_sync_to_async
+def get_device_states_for_user(user):
+    """
+    Returns the last known states of all devices the user may use.
+    """
+    devices = list(get_visible_devices(user))
+    device_states = get_device_states([device.name for device in devices])
+    return [device_states.get(device.name) or device.serialize() for device in devices]
 
-class GPUInfoUpdater(WebsocketConsumer):
-    def connect(self):
+
+class GPUInfoUpdater(AsyncWebsocketConsumer):
+    async def connect(self):
         self.user = self.scope['user']
         self.device_name = self.scope['url_route']['kwargs']['device_name']
 
-        device = Device.objects.get(name=self.device_name)
-        if device.can_be_used_by(self.user):
-            async_to_sync(self.channel_layer.group_add)(
+        device_state = await get_device_state_for_user(self.user, self.device_name)
+        if device_state is not None:
+            await self.channel_layer.group_add(
                 self.device_name,
                 self.channel_name,
             )
+            await self.accept()
 
-            publish_device_state(device.serialize(), self.channel_name)
-
-            self.accept()
+            # send the last known state right away, so that the client does not have to wait for the next update
+            await self.send(text_data=build_update_message(device_state)['message'])
         else:
-            self.close()
+            await self.close()
 
-    def disconnect(self, message, **kwargs):
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, message, **kwargs):
+        await self.channel_layer.group_discard(
             self.device_name,
             self.channel_name,
         )
 
-    def update_info(self, event):
-        self.send(text_data=event['message'])
+    async def update_info(self, event):
+        await self.send(text_data=event['message'])
+
+
+class DevicesInfoUpdater(AsyncWebsocketConsumer):
+    """
+    Sends the updates of all devices the user may use over one socket. Every message is the state of one device and
+    contains the name of that device.
+    """
+    device_names = []
+
+    async def connect(self):
+        self.user = self.scope['user']
+        device_states = await get_device_states_for_user(self.user)
+        self.device_names = [device_state['name'] for device_state in device_states]
+        await asyncio.gather(*(
+            self.channel_layer.group_add(device_name, self.channel_name) for device_name in self.device_names
+        ))
+        await self.accept()
+
+        for device_state in device_states:
+            await self.send(text_data=build_update_message(device_state)['message'])
+
+    async def disconnect(self, message, **kwargs):
+        await asyncio.gather(*(
+            self.channel_layer.group_discard(device_name, self.channel_name) for device_name in self.device_names
+        ))
+
+    async def update_info(self, event):
+        await self.send(text_data=event['message'])
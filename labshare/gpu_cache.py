@@ -0,0 +1,79 @@
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import GPU
+
+# device id -> (version, {gpu uuid -> GPU}), only valid in this process as long as version matches the shared version
+_gpus_by_device = {}
+_lock = threading.Lock()
+
+
+def get_version_cache_key(device_id):
+    return f"gpu_cache_version:{device_id}"
+
+
+def invalidate(device_id):
+    """
+    Marks the cached GPUs of the given device as outdated in every process that shares the Django cache.
+    Has to be called after every change to GPUs that does not send post_save/post_delete (e.g. bulk_update).
+    """
+    cache.set(get_version_cache_key(device_id), uuid.uuid4().hex, None)
+    with _lock:
+        _gpus_by_device.pop(device_id, None)
+
+
+def clear():
+    with _lock:
+        _gpus_by_device.clear()
+
+
+def _load(device, version):
+    gpus = {gpu.uuid: gpu for gpu in GPU.objects.filter(device=device).select_related('reservation')}
+    with _lock:
+        _gpus_by_device[device.pk] = (version, gpus)
+    return gpus
+
+
+def get_gpus(device, gpu_data):
+    """
+    Returns a dict that maps the uuid of every GPU in gpu_data to its GPU object. The GPUs of a device are loaded with
+    one query and kept in memory afterwards, GPUs that do not exist yet are created with a single bulk_create and
+    GPUs whose index changed are updated with a single bulk_update.
+    """
+    version = cache.get(get_version_cache_key(device.pk))
+    with _lock:
+        cached_version, gpus = _gpus_by_device.get(device.pk, (None, None))
+    if gpus is None or cached_version != version:
+        gpus = _load(device, version)
+
+    missing_gpus = [data for data in gpu_data if data['uuid'] not in gpus]
+    if len(missing_gpus) > 0:
+        GPU.objects.bulk_create([
+            GPU(uuid=data['uuid'], model_name=data['name'], index=data.get('index'), device=device)
+            for data in {data['uuid']: data for data in missing_gpus}.values()
+        ])
+        invalidate(device.pk)
+        gpus = _load(device, cache.get(get_version_cache_key(device.pk)))
+
+    changed_gpus = []
+    for data in gpu_data:
+        gpu = gpus[data['uuid']]
+        # deltas of older agents do not contain an index, we keep the one we know in this case
+        if data.get('index') is not None and gpu.index != data['index']:
+            gpu.index = data['index']
+            changed_gpus.append(gpu)
+    if len(changed_gpus) > 0:
+        GPU.objects.bulk_update(changed_gpus, ['index'])
+        invalidate(device.pk)
+        gpus = _load(device, cache.get(get_version_cache_key(device.pk)))
+    return gpus
+
+
+@receiver(post_save, sender=GPU)
+@receiver(post_delete, sender=GPU)
+def invalidate_on_gpu_change(sender, instance, **kwargs):
+    invalidate(instance.device_id)
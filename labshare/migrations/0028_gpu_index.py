@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-16 22:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labshare', '0027_auto_20210811_1139'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gpu',
+            name='index',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='gpu',
+            index=models.Index(fields=['device', 'index'], name='labshare_gp_device__7b2303_idx'),
+        ),
+    ]
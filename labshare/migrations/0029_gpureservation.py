@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-16 23:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labshare', '0028_gpu_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GPUReservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=64)),
+                ('username', models.CharField(max_length=255)),
+                ('start_time', models.DateTimeField(blank=True, null=True)),
+                ('gpu', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reservation', to='labshare.GPU')),
+            ],
+        ),
+    ]
@@ -40,12 +40,45 @@ class GPU(models.Model):
     model_name = models.CharField(max_length=255)
     reserved = models.BooleanField(default=False)
     device = models.ForeignKey(Device, related_name='gpus', on_delete=models.CASCADE)
+    # minor number reported by nvidia-smi, this is the index Slurm uses in its GRES allocations
+    index = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['device', 'index']),
+        ]
 
     def serialize(self):
         return {
             'uuid': self.uuid,
             'model_name': self.model_name,
-            'reserved': self.reserved
+            'reserved': self.reserved,
+            'index': self.index,
+            'reservation': self.get_reservation_data(),
+        }
+
+    def get_reservation_data(self):
+        # load GPUs with select_related('reservation'), otherwise this needs one query per GPU
+        reservation = getattr(self, 'reservation', None)
+        if reservation is None:
+            return None
+        return reservation.serialize()
+
+
+class GPUReservation(models.Model):
+    """
+    The Slurm job that holds a GPU, as reported by the slurm updater.
+    """
+    gpu = models.OneToOneField(GPU, related_name='reservation', on_delete=models.CASCADE)
+    job_id = models.CharField(max_length=64)
+    username = models.CharField(max_length=255)
+    start_time = models.DateTimeField(null=True, blank=True)
+
+    def serialize(self):
+        return {
+            'job_id': self.job_id,
+            'user': self.username,
+            'start_time': int(self.start_time.timestamp()) if self.start_time is not None else None,
         }
 
 
@@ -0,0 +1,64 @@
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+
+# wbits that make zlib accept a gzip or a zlib (deflate) stream
+ZLIB_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+class UnsupportedPayload(ValueError):
+    pass
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+def decompress(body: bytes, content_encoding: str, max_size: int = None) -> bytes:
+    """
+    Decompresses the body, but never produces more than max_size bytes, i.e. a small body that would expand to
+    gigabytes (a decompression bomb) is rejected after max_size bytes have been decompressed.
+    """
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding in ("", "identity"):
+        data = body
+    elif content_encoding in ZLIB_WBITS:
+        decompressor = zlib.decompressobj(ZLIB_WBITS[content_encoding])
+        data = decompressor.decompress(body, 0 if max_size is None else max_size + 1)
+        if (max_size is None or len(data) <= max_size) and not decompressor.eof:
+            raise ValueError("Compressed body is incomplete")
+    else:
+        raise UnsupportedPayload(f"Unsupported content encoding: {content_encoding}")
+
+    if max_size is not None and len(data) > max_size:
+        raise PayloadTooLarge(f"Body is larger than {max_size} bytes")
+    return data
+
+
+def decode_payload(body: bytes, content_type: str = JSON_CONTENT_TYPE, content_encoding: str = "",
+                   max_size: int = None):
+    """
+    Decodes the body of a request sent by one of our agents. Bodies may be compressed with gzip or deflate
+    (Content-Encoding) and may be encoded as JSON or msgpack (Content-Type). Bodies without content type are JSON.
+    Raises PayloadTooLarge if the body is larger than max_size bytes after decompression.
+    """
+    body = decompress(body, content_encoding, max_size)
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type == MSGPACK_CONTENT_TYPE:
+        if msgpack is None:
+            raise UnsupportedPayload("msgpack payloads are not supported, because msgpack is not installed")
+        return msgpack.unpackb(body, raw=False)
+    if content_type in (JSON_CONTENT_TYPE, "text/plain", ""):
+        return json.loads(body.decode("utf-8"))
+    raise UnsupportedPayload(f"Unsupported content type: {content_type}")
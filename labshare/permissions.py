@@ -0,0 +1,96 @@
+import datetime
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from guardian.models import GroupObjectPermission, UserObjectPermission
+from guardian.shortcuts import get_objects_for_user
+
+from .models import Device
+
+VERSION_CACHE_KEY = "visible_devices_version"
+
+
+def create_version():
+    # the version starts with the time it was created, so that it can be used as last modification time
+    return f"{int(time.time())}-{uuid.uuid4().hex}"
+
+
+def get_version():
+    """
+    Returns the current version of the permission index. The version changes whenever a permission, a group
+    membership or a device changes, which invalidates the visible devices of all users at once. Not every change
+    sends a signal (e.g. guardian assigns permissions for querysets with bulk_create), so a version also expires
+    after PERMISSION_CACHE_TIMEOUT seconds.
+    """
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        # another process may set the version at the same time, add makes sure that all of them use the same
+        cache.add(VERSION_CACHE_KEY, create_version(), settings.PERMISSION_CACHE_TIMEOUT)
+        version = cache.get(VERSION_CACHE_KEY)
+    return version
+
+
+def get_version_time(version):
+    return datetime.datetime.fromtimestamp(int(version.split("-")[0]), tz=datetime.timezone.utc)
+
+
+def invalidate():
+    cache.set(VERSION_CACHE_KEY, create_version(), settings.PERMISSION_CACHE_TIMEOUT)
+
+
+def get_visible_device_ids(user):
+    """
+    Returns the ids of all devices the user may use (see Device.can_be_used_by). They are resolved with a single
+    query and cached per user until the next change of permissions.
+    """
+    if user.is_authenticated and not user.is_active:
+        return frozenset()
+
+    cache_key = f"visible_devices:{get_version()}:{user.pk if user.is_authenticated else 'anonymous'}"
+    device_ids = cache.get(cache_key)
+    if device_ids is None:
+        devices = get_objects_for_user(user, 'labshare.use_device', klass=Device, accept_global_perms=True)
+        device_ids = frozenset(devices.values_list('id', flat=True))
+        cache.set(cache_key, device_ids, settings.PERMISSION_CACHE_TIMEOUT)
+    return device_ids
+
+
+def get_visible_devices(user):
+    return Device.objects.filter(id__in=get_visible_device_ids(user))
+
+
+def can_use_device(user, device):
+    return device.pk in get_visible_device_ids(user)
+
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=User)
+def invalidate_on_change(sender, **kwargs):
+    invalidate()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_on_m2m_change(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate()
+
+
+@receiver(post_save, sender=User)
+def invalidate_on_user_change(sender, update_fields=None, **kwargs):
+    # a user is saved on every login, which does not change any permission
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    invalidate()
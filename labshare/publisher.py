@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import threading
+import time
+
+import channels.layers
+from asgiref.sync import async_to_sync
+from django.conf import settings
+
+from labshare.utils import build_update_message, publish_device_state
+
+
+async def send_device_states(device_states):
+    channel_layer = channels.layers.get_channel_layer()
+    await asyncio.gather(*(
+        channel_layer.group_send(device_data['name'], build_update_message(device_data))
+        for device_data in device_states
+    ))
+
+
+class CoalescingPublisher(threading.Thread):
+    """
+    Publishes device states from a background thread. All states queued within one window are collected and only
+    the latest state of every device is sent, so that each device group gets at most one message per window.
+    """
+
+    def __init__(self, window):
+        super().__init__(daemon=True)
+        self.window = window
+        self.pending = {}
+        self.condition = threading.Condition()
+
+    def queue(self, device_data):
+        with self.condition:
+            self.pending[device_data['name']] = device_data
+            self.condition.notify()
+
+    def flush(self):
+        with self.condition:
+            pending, self.pending = self.pending, {}
+        if len(pending) > 0:
+            async_to_sync(send_device_states)(list(pending.values()))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+            # wait for further updates of the devices that changed, only their latest state is published
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Could not publish device states: {e}")
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = CoalescingPublisher(settings.PUBLISH_COALESCE_WINDOW)
+            _publisher.start()
+        return _publisher
+
+
+def queue_device_state(device_data):
+    """
+    Publishes the given device state to all clients of the device without blocking the caller. A window of 0 in
+    PUBLISH_COALESCE_WINDOW disables coalescing, the state is then published right away.
+    """
+    if settings.PUBLISH_COALESCE_WINDOW <= 0:
+        publish_device_state(device_data)
+    else:
+        get_publisher().queue(device_data)
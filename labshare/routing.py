@@ -2,11 +2,12 @@ from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.urls import path
 
-from labshare.consumers import GPUInfoUpdater
+from labshare.consumers import DevicesInfoUpdater, GPUInfoUpdater
 
 
 websocket_urlpatterns = [
     path('ws/device/<device_name>/', GPUInfoUpdater),
+    path('ws/devices/', DevicesInfoUpdater),
 ]
 
 
@@ -54,27 +54,91 @@ CHANNEL_LAYERS = {
     },
 }
 
+# the cache is shared by all server processes, it holds e.g. the last known state of every device
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+}
+
+# the tests run with an in-memory cache, see labshare/test_runner.py
+TEST_RUNNER = 'labshare.test_runner.LabShareTestRunner'
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 # Database
 # https://docs.djangoproject.com/en/1.8/ref/settings/#databases
 
+# The default configuration only tunes SQLite, which writes one update at a time. For concurrent writers, install
+# the driver of a database server (e.g. pip install psycopg2) and override DATABASES in localsettings.py, e.g.:
+# DATABASES = {
+#     'default': {
+#         'ENGINE': 'django.db.backends.postgresql',
+#         'NAME': 'labshare',
+#         'USER': 'labshare',
+#         'PASSWORD': '',
+#         'HOST': '127.0.0.1',
+#         'PORT': '5432',
+#         'CONN_MAX_AGE': 60,
+#     }
+# }
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # keep connections open between requests instead of connecting for every GPU update
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {
+            # seconds a write waits for the lock of another connection before "database is locked" is raised
+            'timeout': 20,
+        },
         'TEST': {
             'NAME': os.path.join(BASE_DIR, 'db-test.sqlite3'),
         }
     }
 }
 
+# pragmas that are set on every new SQLite connection, in WAL mode readers do not block the writer and vice versa
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+}
+
 DATETIME_FORMAT = 'P d.n.'
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 DEFAULT_FROM_EMAIL = "admin@labshare.labshare"
 
+# seconds the last reported state of a device is kept, devices that send delta updates have to report before it expires
+DEVICE_STATE_TIMEOUT = 5 * 60
+# seconds after which the devices visible to each user are resolved again, even if no change of permissions was noticed
+PERMISSION_CACHE_TIMEOUT = 5 * 60
+# seconds a rendered overview page is cached per user, it is rendered again as soon as permissions or devices change
+OVERVIEW_CACHE_TIMEOUT = 60 * 60
+# updates of a device that arrive within this many seconds are coalesced and only the latest one is sent to the
+# clients, 0 publishes every update right away in the request
+PUBLISH_COALESCE_WINDOW = 0.5
+# maximum size in bytes of the body of an update sent by an agent, before and after decompression
+MAX_UPDATE_PAYLOAD_SIZE = 10 * 1024 * 1024
+
+# GPU telemetry is stored in segment files in this directory, retention is given in seconds per resolution
+TELEMETRY_DIR = os.path.join(BASE_DIR, 'telemetry')
+TELEMETRY_RETENTION = {
+    'raw': 2 * 24 * 60 * 60,
+    '1m': 30 * 24 * 60 * 60,
+    '1h': 2 * 365 * 24 * 60 * 60,
+}
+TELEMETRY_FLUSH_INTERVAL = 60
+# number of steps a history request returns per GPU if no step is given and the maximum number of steps per GPU
+HISTORY_DEFAULT_STEPS = 500
+HISTORY_MAX_STEPS = 2000
+
 EMAIL_BACKEND = 'labshare.backends.mail.open_smtp.OpenSMTPBackend'
 EMAIL_HOST = "localhost"
 EMAIL_PORT = "25"
@@ -0,0 +1,378 @@
+import atexit
+import hashlib
+import math
+import os
+import re
+import threading
+
+import numpy as np
+from django.conf import settings
+
+RAW = "raw"
+ONE_MINUTE = "1m"
+ONE_HOUR = "1h"
+
+BUCKET_LENGTHS = {
+    ONE_MINUTE: 60,
+    ONE_HOUR: 60 * 60,
+}
+# every resolution is stored in append-only segment files covering this many seconds, retention deletes whole segments
+SEGMENT_LENGTHS = {
+    RAW: 60 * 60,
+    ONE_MINUTE: 7 * 24 * 60 * 60,
+    ONE_HOUR: 30 * 24 * 60 * 60,
+}
+
+SAMPLE_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("used_memory", "<f4"),
+    ("total_memory", "<f4"),
+    ("utilization", "<f4"),
+])
+# rolled up buckets store sums and counts instead of means, so that buckets written by different processes for the
+# same GPU and time can be merged exactly when reading them. Samples that are NaN (e.g. utilization "N/A") are not
+# counted, a field without any valid sample has a maximum of NaN.
+BUCKET_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("used_memory_count", "<u4"),
+    ("used_memory_sum", "<f8"),
+    ("used_memory_max", "<f4"),
+    ("total_memory", "<f4"),
+    ("utilization_count", "<u4"),
+    ("utilization_sum", "<f8"),
+    ("utilization_max", "<f4"),
+])
+
+PERCENTILES = (50, 90, 99)
+# resolutions from coarse to fine, a history uses the coarsest resolution whose buckets fit into one step
+HISTORY_RESOLUTIONS = ((ONE_HOUR, BUCKET_LENGTHS[ONE_HOUR]), (ONE_MINUTE, BUCKET_LENGTHS[ONE_MINUTE]), (RAW, 0))
+
+SEGMENT_FILE_REGEX = re.compile(r"^(?P<resolution>\w+)-(?P<segment>\d+)\.bin$")
+
+
+def parse_quantity(value):
+    # turns values like "1234 MiB" or "25 %" into numbers, "N/A" and the like become NaN
+    try:
+        return float(str(value).split()[0])
+    except (ValueError, IndexError):
+        return math.nan
+
+
+def get_segment_path(directory, resolution, timestamp):
+    return os.path.join(directory, f"{resolution}-{int(timestamp // SEGMENT_LENGTHS[resolution])}.bin")
+
+
+def append_records(directory, resolution, records):
+    segments = (records["timestamp"] // SEGMENT_LENGTHS[resolution]).astype(np.int64)
+    for segment in np.unique(segments):
+        with open(get_segment_path(directory, resolution, segment * SEGMENT_LENGTHS[resolution]), "ab") as f:
+            f.write(records[segments == segment].tobytes())
+
+
+class Bucket:
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.total_memory = math.nan
+        # field -> [count, sum, max] of the valid samples
+        self.fields = {"used_memory": [0, 0.0, math.nan], "utilization": [0, 0.0, math.nan]}
+
+    def add(self, used_memory, total_memory, utilization):
+        if not math.isnan(total_memory):
+            self.total_memory = total_memory
+        for value, field in ((used_memory, self.fields["used_memory"]), (utilization, self.fields["utilization"])):
+            if math.isnan(value):
+                continue
+            field[0] += 1
+            field[1] += value
+            field[2] = value if math.isnan(field[2]) else max(field[2], value)
+
+    def to_record(self):
+        used_memory_count, used_memory_sum, used_memory_max = self.fields["used_memory"]
+        utilization_count, utilization_sum, utilization_max = self.fields["utilization"]
+        return np.array([(
+            self.timestamp, used_memory_count, used_memory_sum, used_memory_max, self.total_memory,
+            utilization_count, utilization_sum, utilization_max,
+        )], dtype=BUCKET_DTYPE)
+
+
+class GPUSeries:
+    """
+    Telemetry of one GPU. Raw samples are written into a preallocated numpy buffer and flushed to the raw segment
+    files once flush_size samples are pending or flush_interval seconds have passed. At the same time they are added
+    to the currently open 1 minute and 1 hour buckets, a bucket is appended to its segment file as soon as a sample of
+    a later bucket arrives. Whenever a new segment file is started, segments older than the retention are deleted.
+    """
+
+    def __init__(self, directory, retention, flush_size=64, flush_interval=60):
+        self.directory = directory
+        self.retention = retention
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = np.zeros(flush_size, dtype=SAMPLE_DTYPE)
+        self.num_pending = 0
+        self.first_pending_timestamp = None
+        self.buckets = {resolution: None for resolution in BUCKET_LENGTHS}
+        self.current_segments = {resolution: None for resolution in SEGMENT_LENGTHS}
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, timestamp, used_memory, total_memory, utilization):
+        self.buffer[self.num_pending] = (timestamp, used_memory, total_memory, utilization)
+        self.num_pending += 1
+        if self.first_pending_timestamp is None:
+            self.first_pending_timestamp = timestamp
+        if self.num_pending == self.flush_size or timestamp - self.first_pending_timestamp >= self.flush_interval:
+            self.flush_samples()
+
+        for resolution, bucket_length in BUCKET_LENGTHS.items():
+            bucket_timestamp = timestamp - timestamp % bucket_length
+            bucket = self.buckets[resolution]
+            if bucket is None or bucket.timestamp != bucket_timestamp:
+                if bucket is not None:
+                    self.write(resolution, bucket.to_record())
+                bucket = self.buckets[resolution] = Bucket(bucket_timestamp)
+            bucket.add(used_memory, total_memory, utilization)
+
+    def flush_samples(self):
+        if self.num_pending == 0:
+            return
+        self.write(RAW, self.buffer[:self.num_pending])
+        self.num_pending = 0
+        self.first_pending_timestamp = None
+
+    def flush(self):
+        # also writes the open buckets, only used on shutdown, because a bucket must only be written once
+        self.flush_samples()
+        for resolution, bucket in self.buckets.items():
+            if bucket is not None:
+                self.write(resolution, bucket.to_record())
+                self.buckets[resolution] = None
+
+    def write(self, resolution, records):
+        append_records(self.directory, resolution, records)
+        segment = int(records["timestamp"][-1] // SEGMENT_LENGTHS[resolution])
+        if segment != self.current_segments[resolution]:
+            self.current_segments[resolution] = segment
+            self.apply_retention(resolution, records["timestamp"][-1])
+
+    def apply_retention(self, resolution, now):
+        oldest_segment = int((now - self.retention[resolution]) // SEGMENT_LENGTHS[resolution])
+        for file_name in os.listdir(self.directory):
+            match = SEGMENT_FILE_REGEX.match(file_name)
+            if match is not None and match.group("resolution") == resolution \
+                    and int(match.group("segment")) < oldest_segment:
+                os.remove(os.path.join(self.directory, file_name))
+
+
+class TelemetryStore:
+    """
+    Compact time-series store for the GPU telemetry reported by the devices. Every GPU gets its own directory with
+    append-only segment files for raw samples and 1 minute/1 hour rollups, nothing is written to the database.
+    """
+
+    def __init__(self, directory, retention, flush_size=64, flush_interval=60):
+        self.directory = directory
+        self.retention = retention
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def get_gpu_directory(self, gpu_uuid):
+        # uuids are sent by the devices, the directory is named after a hash of the uuid, so that no uuid can point
+        # outside of the store and no two uuids share a directory
+        directory = os.path.join(self.directory, hashlib.sha256(gpu_uuid.encode("utf-8")).hexdigest())
+        store_directory = os.path.realpath(self.directory)
+        if os.path.commonpath([os.path.realpath(directory), store_directory]) != store_directory:
+            raise ValueError(f"Telemetry directory of GPU {gpu_uuid} is outside of {self.directory}")
+        return directory
+
+    def append(self, gpu_uuid, timestamp, used_memory, total_memory, utilization):
+        with self.lock:
+            series = self.series.get(gpu_uuid)
+            if series is None:
+                series = self.series[gpu_uuid] = GPUSeries(
+                    self.get_gpu_directory(gpu_uuid), self.retention, self.flush_size, self.flush_interval
+                )
+            series.append(timestamp, used_memory, total_memory, utilization)
+
+    def record_device_state(self, device_data, timestamp):
+        for gpu in device_data["gpus"]:
+            self.append(
+                gpu["uuid"],
+                timestamp,
+                parse_quantity(gpu["used_memory"]),
+                parse_quantity(gpu["total_memory"]),
+                parse_quantity(gpu["utilization"]),
+            )
+
+    def flush(self):
+        with self.lock:
+            for series in self.series.values():
+                series.flush()
+
+    def read(self, gpu_uuid, resolution, start, end):
+        """
+        Returns all records of the given resolution with start <= timestamp < end sorted by timestamp.
+        Only the segment files overlapping the requested range are read.
+        """
+        dtype = SAMPLE_DTYPE if resolution == RAW else BUCKET_DTYPE
+        segment_length = SEGMENT_LENGTHS[resolution]
+        directory = self.get_gpu_directory(gpu_uuid)
+
+        paths = [
+            get_segment_path(directory, resolution, segment * segment_length)
+            for segment in range(int(start // segment_length), int(end // segment_length) + 1)
+        ]
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in paths]
+        # read all segments into one preallocated array instead of concatenating them
+        records = np.empty(sum(size // dtype.itemsize for size in sizes), dtype=dtype)
+        position = 0
+        for path, size in zip(paths, sizes):
+            num_records = size // dtype.itemsize
+            if num_records == 0:
+                continue
+            try:
+                with open(path, "rb") as f:
+                    position += f.readinto(records[position:position + num_records].view(np.uint8)) // dtype.itemsize
+            except FileNotFoundError:
+                # removed by the retention of another process in the meantime
+                continue
+        records = records[:position]
+
+        timestamps = records["timestamp"]
+        if np.any(timestamps[1:] < timestamps[:-1]):
+            # only happens if several processes wrote into the same segment
+            records = records[np.argsort(timestamps, kind="stable")]
+            timestamps = records["timestamp"]
+        records = records[np.searchsorted(timestamps, start):np.searchsorted(timestamps, end)]
+        if resolution != RAW and np.any(records["timestamp"][1:] == records["timestamp"][:-1]):
+            records = merge_buckets(records)
+        return records
+
+
+def merge_buckets(records):
+    # several processes (or restarts of one process) may have written a bucket for the same time
+    timestamps, starts = np.unique(records["timestamp"], return_index=True)
+    merged = np.zeros(len(timestamps), dtype=BUCKET_DTYPE)
+    merged["timestamp"] = timestamps
+    for field in ("used_memory_count", "used_memory_sum", "utilization_count", "utilization_sum"):
+        merged[field] = np.add.reduceat(records[field], starts)
+    for field in ("used_memory_max", "utilization_max"):
+        merged[field] = np.fmax.reduceat(records[field], starts)
+    merged["total_memory"] = records["total_memory"][np.append(starts[1:], len(records)) - 1]
+    return merged
+
+
+def get_history_resolution(step):
+    for resolution, bucket_length in HISTORY_RESOLUTIONS:
+        if bucket_length <= step:
+            return resolution
+
+
+def to_json_list(values):
+    # NaN and infinity are not valid JSON, rounding keeps the response small and fast to encode
+    values = np.round(values, 2)
+    missing = ~np.isfinite(values)
+    if missing.any():
+        return np.where(missing, None, values).tolist()
+    return values.tolist()
+
+
+def build_history(records, resolution, start, step):
+    """
+    Downsamples the given records (sorted by timestamp) into steps of step seconds starting at start and computes
+    percentiles of memory and utilization over all records. Steps without records are left out.
+    """
+    history = {
+        "resolution": resolution,
+        "timestamps": [],
+        "total_memory": [],
+        "used_memory": {"mean": [], "max": []},
+        "utilization": {"mean": [], "max": []},
+        "percentiles": {"used_memory": {}, "utilization": {}},
+    }
+    if len(records) == 0:
+        return history
+
+    steps = ((records["timestamp"] - start) // step).astype(np.int64)
+    step_starts = np.concatenate(([0], np.flatnonzero(steps[1:] != steps[:-1]) + 1))
+    step_indices = steps[step_starts]
+    step_ends = np.append(step_starts[1:], len(records)) - 1
+    history["timestamps"] = (start + step_indices * step).tolist()
+    history["total_memory"] = to_json_list(records["total_memory"][step_ends])
+
+    for name in ("used_memory", "utilization"):
+        # the fields of a structured array are strided views, all computations are a lot faster on contiguous copies
+        if resolution == RAW:
+            maxima = np.ascontiguousarray(records[name], dtype=np.float64)
+            valid = ~np.isnan(maxima)
+            counts = valid.astype(np.float64)
+            # NaN values (e.g. utilization not supported) must not spoil the whole step
+            sums = np.where(valid, maxima, 0) if not valid.all() else maxima
+        else:
+            counts = np.ascontiguousarray(records[f"{name}_count"], dtype=np.float64)
+            sums = np.ascontiguousarray(records[f"{name}_sum"])
+            maxima = np.ascontiguousarray(records[f"{name}_max"])
+            valid = counts > 0
+
+        step_counts = np.add.reduceat(counts, step_starts)
+        step_sums = np.add.reduceat(sums, step_starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            history[name]["mean"] = to_json_list(step_sums / step_counts)
+        history[name]["max"] = to_json_list(np.fmax.reduceat(maxima, step_starts))
+
+        # percentiles of the stored values, for rollups these are the means of the buckets
+        values = sums[valid] / counts[valid]
+        if len(values) > 0:
+            percentiles = compute_percentiles(values, PERCENTILES)
+            history["percentiles"][name] = {str(p): float(v) for p, v in zip(PERCENTILES, percentiles)}
+    return history
+
+
+def compute_percentiles(values, percentiles):
+    # same result as np.percentile (linear interpolation), but sorting once is a lot faster than np.percentile's
+    # partitioning for the array sizes of a history
+    values = np.sort(values)
+    positions = np.asarray(percentiles) / 100 * (len(values) - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    return values[lower] + (values[upper] - values[lower]) * (positions - lower)
+
+
+def get_history(gpu_uuid, start, end, step):
+    resolution = get_history_resolution(step)
+    records = get_store().read(gpu_uuid, resolution, start, end)
+    history = build_history(records, resolution, start, step)
+    history["uuid"] = gpu_uuid
+    return history
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None or _store.directory != settings.TELEMETRY_DIR:
+            if _store is not None:
+                _store.flush()
+            _store = TelemetryStore(
+                settings.TELEMETRY_DIR,
+                settings.TELEMETRY_RETENTION,
+                flush_interval=settings.TELEMETRY_FLUSH_INTERVAL,
+            )
+        return _store
+
+
+@atexit.register
+def close():
+    """
+    Writes all pending samples and open buckets of the current store and discards it.
+    """
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.flush()
+            _store = None
@@ -0,0 +1,648 @@
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+import requests
+
+DEVICE_QUERY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "device_query")
+sys.path.insert(0, DEVICE_QUERY_DIR)
+
+import aggregator  # noqa: E402
+import device_query  # noqa: E402
+import fake_nvml  # noqa: E402
+import slurm_updater  # noqa: E402
+
+
+class HostlistTests(TestCase):
+
+    def expand(self, hostlist):
+        return list(slurm_updater.expand_hostlist(hostlist))
+
+    def test_single_host(self):
+        self.assertEqual(self.expand("fb10dl07"), ["fb10dl07"])
+
+    def test_mixed_ranges(self):
+        self.assertEqual(
+            self.expand("node[01-04,07,10-12]"),
+            ["node01", "node02", "node03", "node04", "node07", "node10", "node11", "node12"],
+        )
+
+    def test_zero_padding(self):
+        self.assertEqual(self.expand("node[0098-0101]"), ["node0098", "node0099", "node0100", "node0101"])
+        self.assertEqual(self.expand("node[8-10]"), ["node8", "node9", "node10"])
+
+    def test_several_bracket_groups_per_host(self):
+        self.assertEqual(
+            self.expand("rack[1-2]-node[01-02]"),
+            ["rack1-node01", "rack1-node02", "rack2-node01", "rack2-node02"],
+        )
+
+    def test_suffix(self):
+        self.assertEqual(self.expand("gpu[1-2].cluster"), ["gpu1.cluster", "gpu2.cluster"])
+
+    def test_several_hostlists(self):
+        self.assertEqual(self.expand("node[1-2],login,gpu[3]"), ["node1", "node2", "login", "gpu3"])
+
+    def test_invalid_hostlist(self):
+        for hostlist in ("node[1-", "node[2-1]", "node[1,,2]", "node[a-b]", "node]1["):
+            with self.assertRaises(ValueError, msg=hostlist):
+                self.expand(hostlist)
+
+
+class GresTests(TestCase):
+
+    def test_gpu_ids(self):
+        self.assertEqual(slurm_updater.parse_gpu_ids("gpu:1080ti:4(IDX:0-3)"), [0, 1, 2, 3])
+        self.assertEqual(slurm_updater.parse_gpu_ids("gpu:4090:3(IDX:0,2,4)"), [0, 2, 4])
+        self.assertEqual(slurm_updater.parse_gpu_ids("gpu:a100:3(IDX:0-1,5)"), [0, 1, 5])
+
+    def test_no_gpus_allocated(self):
+        self.assertEqual(slurm_updater.parse_gpu_ids("gpu:3090:0(IDX:N/A)"), [])
+        self.assertEqual(slurm_updater.parse_gpu_ids("(null)"), [])
+
+    def test_several_gres_types(self):
+        # Slurm numbers the gpus of a node across all types, the indices must not be shifted per type
+        self.assertEqual(slurm_updater.parse_gpu_ids("gpu:1080ti:1(IDX:0),gpu:980gtx:0(IDX:N/A)"), [0])
+        self.assertEqual(slurm_updater.parse_gpu_ids("gpu:a:1(IDX:0),gpu:b:2(IDX:1-2)"), [0, 1, 2])
+        self.assertEqual(slurm_updater.parse_gpu_ids("gpu:a:0(IDX:N/A),gpu:b:1(IDX:3),mps:0"), [3])
+
+    def test_sinfo_output(self):
+        sinfo_output = """
+fb10dl[03,06-07]    gpu:1080ti:1(IDX:2)
+fb10dl10            gpu:4090:3(IDX:0,2,4)
+resterampe          gpu:1080ti:1(IDX:0),gpu:980gtx:1(IDX:1)
+broken[1-           gpu:1080ti:1(IDX:0)
+login               (null)
+"""
+        self.assertEqual(slurm_updater.parse_sinfo_output(sinfo_output), {
+            "fb10dl03": [2],
+            "fb10dl06": [2],
+            "fb10dl07": [2],
+            "fb10dl10": [0, 2, 4],
+            "resterampe": [0, 1],
+            "login": [],
+        })
+
+
+class ProcessOwnerCacheTests(TestCase):
+
+    def setUp(self):
+        proc_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(proc_dir.cleanup)
+        self.proc_dir = proc_dir.name
+        proc_dir_patcher = mock.patch("device_query.PROC_DIR", self.proc_dir)
+        proc_dir_patcher.start()
+        self.addCleanup(proc_dir_patcher.stop)
+        self.owners = device_query.ProcessOwnerCache()
+
+    def start_process(self, pid, start_time, real_uid, effective_uid=None):
+        process_dir = os.path.join(self.proc_dir, str(pid))
+        os.makedirs(process_dir, exist_ok=True)
+        with open(os.path.join(process_dir, "stat"), "w") as f:
+            f.write(f"{pid} (python (train).py) S {' '.join(['0'] * 18)} {start_time} 0 0\n")
+        effective_uid = real_uid if effective_uid is None else effective_uid
+        with open(os.path.join(process_dir, "status"), "w") as f:
+            f.write(f"Name:\tpython\nUmask:\t0022\nState:\tS (sleeping)\nPid:\t{pid}\n"
+                    f"Uid:\t{real_uid}\t{effective_uid}\t{effective_uid}\t{effective_uid}\nGid:\t0\t0\t0\t0\n")
+
+    def test_real_uid_is_used(self):
+        # uids without passwd entry are reported as numbers
+        self.start_process(4711, start_time=100, real_uid=104711, effective_uid=0)
+        self.assertEqual(self.owners.get_owner("4711"), "104711")
+
+    def test_owner_is_cached(self):
+        self.start_process(4711, start_time=100, real_uid=104711)
+        self.assertEqual(self.owners.get_owner(4711), "104711")
+        with mock.patch("device_query.get_process_uid") as get_process_uid:
+            self.assertEqual(self.owners.get_owner(4711), "104711")
+        get_process_uid.assert_not_called()
+
+    def test_reused_pid_invalidates_owner(self):
+        self.start_process(4711, start_time=100, real_uid=104711)
+        self.assertEqual(self.owners.get_owner(4711), "104711")
+        self.start_process(4711, start_time=250, real_uid=104712)
+        self.assertEqual(self.owners.get_owner(4711), "104712")
+
+    def test_exited_process(self):
+        self.start_process(4711, start_time=100, real_uid=104711)
+        self.owners.get_owner(4711)
+        os.remove(os.path.join(self.proc_dir, "4711", "stat"))
+        self.assertEqual(self.owners.get_owner(4711), "Unknown")
+        self.assertNotIn(4711, self.owners.owners)
+
+    def test_prune(self):
+        self.start_process(4711, start_time=100, real_uid=104711)
+        self.start_process(4712, start_time=100, real_uid=104712)
+        self.owners.get_owner(4711)
+        self.owners.get_owner(4712)
+        self.owners.prune(["4712"])
+        self.assertEqual(list(self.owners.owners.keys()), [4712])
+
+
+# output of nvidia-smi --query-gpu=count,uuid,... -lms 1000, three iterations on a machine with two GPUs
+RECORDED_LOOP_LINES = """2, GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1, 11178, 0, 11178, 0, GeForce GTX 1080 Ti, 00000000:17:00.0
+2, GPU-b668a158-8fa2-00ca-7564-43d52620a570, 11178, 0, 11178, 0, GeForce GTX 1080 Ti, 00000000:65:00.0
+2, GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1, 11178, 3021, 8157, 97, GeForce GTX 1080 Ti, 00000000:17:00.0
+2, GPU-b668a158-8fa2-00ca-7564-43d52620a570, 11178, 0, 11178, 0, GeForce GTX 1080 Ti, 00000000:65:00.0
+2, GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1, 11178, 3021, 8157, 99, GeForce GTX 1080 Ti, 00000000:17:00.0
+""".splitlines(keepends=True)
+
+
+class NvidiaSmiLoopTests(TestCase):
+
+    def setUp(self):
+        # the loop is fed with recorded lines, no nvidia-smi is started
+        self.loop = device_query.NvidiaSmiLoop(device_query.GPU_QUERY_FIELDS, interval=1)
+
+    def sample(self):
+        return self.loop.latest_sample(max_age=60)
+
+    def test_sample_is_published_once_every_gpu_was_received(self):
+        self.loop.handle_line(RECORDED_LOOP_LINES[0])
+        self.assertIsNone(self.sample())
+        self.assertFalse(self.loop.sample_available.is_set())
+
+        self.loop.handle_line(RECORDED_LOOP_LINES[1])
+        self.assertTrue(self.loop.sample_available.is_set())
+        self.assertEqual([row[0] for row in self.sample()], [
+            "GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1", "GPU-b668a158-8fa2-00ca-7564-43d52620a570",
+        ])
+
+    def test_samples_are_neither_split_nor_merged(self):
+        samples = []
+        for line in RECORDED_LOOP_LINES:
+            self.loop.handle_line(line)
+            sample = self.sample()
+            if sample is not None and (len(samples) == 0 or sample is not samples[-1]):
+                samples.append(sample)
+        # the last iteration is incomplete and must not be published
+        self.assertEqual(len(samples), 2)
+        self.assertEqual([len(sample) for sample in samples], [2, 2])
+        self.assertEqual(samples[1][0][4], "97")
+
+    def test_number_of_gpus_changes(self):
+        self.loop.handle_line(RECORDED_LOOP_LINES[0])
+        self.loop.handle_line("1, GPU-b668a158-8fa2-00ca-7564-43d52620a570, 11178, 0, 11178, 0, GeForce GTX 1080 Ti, "
+                              "00000000:65:00.0\n")
+        self.assertEqual([row[0] for row in self.sample()], ["GPU-b668a158-8fa2-00ca-7564-43d52620a570"])
+
+    def test_unexpected_lines_are_ignored(self):
+        for line in ("\n", "[N/A], GPU-4a080c64\n"):
+            self.loop.handle_line(line)
+        self.loop.handle_line(RECORDED_LOOP_LINES[0])
+        self.loop.handle_line(RECORDED_LOOP_LINES[1])
+        self.assertEqual(len(self.sample()), 2)
+
+
+class NVMLCollectorTests(TestCase):
+
+    def setUp(self):
+        self.gpus = fake_nvml.gpus
+        self.addCleanup(setattr, fake_nvml, "gpus", self.gpus)
+        owner_patcher = mock.patch("device_query.get_owner_for_pid", return_value="Mr. Keks")
+        owner_patcher.start()
+        self.addCleanup(owner_patcher.stop)
+
+    def collect(self, gpus):
+        fake_nvml.gpus = gpus
+        collector = device_query.NVMLCollector(fake_nvml)
+        self.addCleanup(collector.close)
+        return collector.collect()
+
+    def test_idle_gpus(self):
+        gpu_data = self.collect([
+            fake_nvml.FakeGPU(uuid="GPU-0", minor_number=0, utilization=10),
+            fake_nvml.FakeGPU(uuid="GPU-1", minor_number=3),
+        ])
+        self.assertEqual(gpu_data[0], {
+            "name": "NVIDIA Super Ultra",
+            "uuid": "GPU-0",
+            "index": 0,
+            "gpu_util": "10 %",
+            "in_use": "no",
+            "processes": [],
+            "memory": {"total": "12000 MiB", "used": "0 MiB", "free": "12000 MiB"},
+        })
+        self.assertEqual(gpu_data[1]["index"], 3)
+
+    def test_processes(self):
+        processes = [
+            fake_nvml.FakeProcess(pid=42, name="train.py", used_memory=2000 * fake_nvml.MEBIBYTE),
+            fake_nvml.FakeProcess(pid=43, used_memory=None),
+        ]
+        gpu_data = self.collect([
+            fake_nvml.FakeGPU(uuid="GPU-0", used_memory=4000 * fake_nvml.MEBIBYTE, processes=processes),
+        ])
+        self.assertEqual(gpu_data[0]["in_use"], "yes")
+        self.assertEqual(gpu_data[0]["memory"]["used"], "4000 MiB")
+        self.assertEqual(gpu_data[0]["processes"], [
+            {"pid": "42", "username": "Mr. Keks", "name": "train.py", "used_memory": "2000 MiB"},
+            {"pid": "43", "username": "Mr. Keks", "name": "python", "used_memory": "N/A"},
+        ])
+
+    def test_unsupported_utilization_and_processes(self):
+        gpu_data = self.collect([
+            fake_nvml.FakeGPU(uuid="GPU-0", utilization_supported=False, processes_supported=False),
+        ])
+        self.assertEqual(gpu_data[0]["gpu_util"], "N/A")
+        self.assertEqual(gpu_data[0]["in_use"], "na")
+        self.assertNotIn("processes", gpu_data[0])
+
+    def test_process_exited_before_its_name_was_read(self):
+        gpu = fake_nvml.FakeGPU(uuid="GPU-0", processes=[fake_nvml.FakeProcess(pid=42)])
+        fake_nvml.gpus = [gpu]
+        collector = device_query.NVMLCollector(fake_nvml)
+        self.addCleanup(collector.close)
+        with mock.patch("fake_nvml.nvmlSystemGetProcessName", side_effect=fake_nvml.NVMLError_NotFound):
+            gpu_data = collector.collect()
+        self.assertEqual(gpu_data[0]["processes"][0]["name"], "Unknown")
+
+
+def read_fixture(filename):
+    with open(os.path.join(DEVICE_QUERY_DIR, filename)) as f:
+        return f.read()
+
+
+class XMLParserTests(TestCase):
+
+    def setUp(self):
+        owner_patcher = mock.patch("device_query.get_owner_for_pid", return_value="Mr. Keks")
+        owner_patcher.start()
+        self.addCleanup(owner_patcher.stop)
+
+    def test_streaming_parser_matches_tree_parser(self):
+        for filename in ("nvidia-smi-output.xml", "nvidia-smi-output-mig.xml"):
+            xml = read_fixture(filename)
+            self.assertEqual(device_query.parse_nvidia_xml_streaming(xml), device_query.parse_nvidia_xml(xml),
+                             msg=filename)
+
+    def test_mig_devices_are_ignored(self):
+        gpu_data = device_query.parse_nvidia_xml_streaming(read_fixture("nvidia-smi-output-mig.xml"))
+        self.assertEqual(gpu_data[0]["memory"], {"total": "40536 MiB", "used": "3024 MiB", "free": "37512 MiB"})
+        self.assertEqual(gpu_data[0]["index"], 2)
+        self.assertEqual(gpu_data[0]["processes"], [
+            {"pid": "4711", "username": "Mr. Keks", "name": "python train.py", "used_memory": "3015 MiB"},
+        ])
+        self.assertEqual(gpu_data[1]["memory"]["total"], "40536 MiB")
+
+
+def build_gpu(uuid, used_memory=0, gpu_util=0, pids=()):
+    return {
+        "name": "GeForce GTX 1080 Ti",
+        "uuid": uuid,
+        "gpu_util": f"{gpu_util} %",
+        "in_use": "yes" if len(pids) > 0 else "no",
+        "processes": [
+            {"pid": str(pid), "username": "Mr. Keks", "name": "python", "used_memory": "100 MiB"} for pid in pids
+        ],
+        "memory": {"total": "11178 MiB", "used": f"{used_memory} MiB", "free": f"{11178 - used_memory} MiB"},
+    }
+
+
+class GPUChangeTrackerTests(TestCase):
+
+    def setUp(self):
+        self.tracker = device_query.GPUChangeTracker(memory_threshold=50, utilization_threshold=5,
+                                                     full_update_interval=10)
+        self.gpus = [build_gpu("GPU-0"), build_gpu("GPU-1")]
+
+    def test_first_update_sends_everything(self):
+        self.assertEqual(self.tracker.build_post_data("keks", self.gpus), {
+            "gpu_data": self.gpus,
+            "device_name": "keks",
+        })
+
+    def test_unchanged_gpus_are_skipped(self):
+        self.tracker.build_post_data("keks", self.gpus)
+        # changes below the thresholds do not count
+        gpus = [build_gpu("GPU-0", used_memory=49, gpu_util=4), build_gpu("GPU-1")]
+        self.assertEqual(self.tracker.build_post_data("keks", gpus), {
+            "gpu_data": [],
+            "device_name": "keks",
+            "delta": True,
+        })
+
+    def test_changed_gpus_are_sent(self):
+        self.tracker.build_post_data("keks", self.gpus)
+        for gpus, changed_uuids in [
+            ([build_gpu("GPU-0", used_memory=50), build_gpu("GPU-1")], ["GPU-0"]),
+            ([build_gpu("GPU-0", used_memory=50), build_gpu("GPU-1", pids=[4711])], ["GPU-1"]),
+            ([build_gpu("GPU-0", used_memory=50, gpu_util=5), build_gpu("GPU-1", pids=[4711])], ["GPU-0"]),
+        ]:
+            post_data = self.tracker.build_post_data("keks", gpus)
+            self.assertTrue(post_data["delta"])
+            self.assertEqual([gpu["uuid"] for gpu in post_data["gpu_data"]], changed_uuids)
+
+    def test_small_changes_add_up(self):
+        # a change is measured against the value that was last reported, not the last poll
+        self.tracker.build_post_data("keks", self.gpus)
+        self.assertEqual(self.tracker.build_post_data("keks", [build_gpu("GPU-0", used_memory=30), self.gpus[1]])
+                         ["gpu_data"], [])
+        post_data = self.tracker.build_post_data("keks", [build_gpu("GPU-0", used_memory=60), self.gpus[1]])
+        self.assertEqual([gpu["uuid"] for gpu in post_data["gpu_data"]], ["GPU-0"])
+
+    def test_unknown_values_are_changes(self):
+        self.tracker.build_post_data("keks", self.gpus)
+        gpu = build_gpu("GPU-0")
+        gpu["gpu_util"] = "N/A"
+        post_data = self.tracker.build_post_data("keks", [gpu, self.gpus[1]])
+        self.assertEqual([gpu["uuid"] for gpu in post_data["gpu_data"]], ["GPU-0"])
+
+    def test_removed_gpus_are_reported(self):
+        self.tracker.build_post_data("keks", self.gpus)
+        post_data = self.tracker.build_post_data("keks", self.gpus[:1])
+        # the server replaces the state of the device with a full update, i.e. the missing GPU is gone
+        self.assertNotIn("delta", post_data)
+        self.assertEqual(post_data["gpu_data"], self.gpus[:1])
+
+    def test_heartbeat_resends_everything(self):
+        self.tracker.full_update_interval = 3
+        self.assertNotIn("delta", self.tracker.build_post_data("keks", self.gpus))
+        self.assertTrue(self.tracker.build_post_data("keks", self.gpus)["delta"])
+        self.assertTrue(self.tracker.build_post_data("keks", self.gpus)["delta"])
+        post_data = self.tracker.build_post_data("keks", self.gpus)
+        self.assertNotIn("delta", post_data)
+        self.assertEqual(post_data["gpu_data"], self.gpus)
+
+    def test_reset_resends_everything(self):
+        self.tracker.build_post_data("keks", self.gpus)
+        self.tracker.reset()
+        self.assertEqual(self.tracker.build_post_data("keks", self.gpus)["gpu_data"], self.gpus)
+
+
+class UpdateSenderTests(TestCase):
+
+    def setUp(self):
+        self.on_failure = mock.Mock()
+        self.sender = device_query.UpdateSender("http://labshare/gpu/update", {"Authorization": "Token keks"}, False,
+                                                on_failure=self.on_failure, queue_size=2)
+        self.sender.session = mock.Mock()
+        self.sender.session.post.return_value = mock.Mock(ok=True, status_code=200, reason="OK")
+
+    def sent_updates(self):
+        updates = []
+        for call in self.sender.session.post.call_args_list:
+            body = call[1]["data"]
+            if call[1]["headers"].get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            updates.append(json.loads(body.decode("utf-8")))
+        return updates
+
+    def test_oldest_update_is_dropped(self):
+        # the sender is not started, i.e. the server is too slow to take any update
+        for i in range(3):
+            self.sender.submit({"update": i})
+        self.on_failure.assert_called_once_with()
+        self.assertEqual([self.sender.queue.get_nowait() for _ in range(2)], [{"update": 1}, {"update": 2}])
+
+    def test_close_sends_waiting_updates(self):
+        self.sender.submit({"update": 0})
+        self.sender.submit({"update": 1})
+        self.sender.start()
+        self.sender.close(timeout=5)
+        self.assertFalse(self.sender.is_alive())
+        self.assertEqual(self.sent_updates(), [{"update": 0}, {"update": 1}])
+        self.sender.session.close.assert_called_once_with()
+        self.on_failure.assert_not_called()
+
+    def test_failed_post(self):
+        posted = threading.Event()
+        self.sender.session.post.side_effect = [
+            requests.ConnectionError("server is gone"),
+            mock.Mock(ok=False, status_code=409, reason="Conflict"),
+            mock.Mock(ok=True, status_code=200, reason="OK"),
+        ]
+        self.on_failure.side_effect = lambda: posted.set()
+        self.sender.start()
+        for i in range(3):
+            posted.clear()
+            self.sender.submit({"update": i})
+            if i < 2:
+                self.assertTrue(posted.wait(5))
+        self.sender.close(timeout=5)
+        # the sender keeps running after a failure, the next update reaches the server
+        self.assertEqual(self.on_failure.call_count, 2)
+        self.assertEqual(self.sent_updates(), [{"update": 0}, {"update": 1}, {"update": 2}])
+
+    def test_unsupported_encoding_falls_back_to_plain_json(self):
+        self.sender.session.post.side_effect = [
+            mock.Mock(ok=False, status_code=415, reason="Unsupported Media Type"),
+            mock.Mock(ok=True, status_code=200, reason="OK"),
+        ]
+        self.sender.submit({"update": 0})
+        self.sender.submit({"update": 1})
+        self.sender.start()
+        self.sender.close(timeout=5)
+        first_call, second_call = self.sender.session.post.call_args_list
+        self.assertEqual(first_call[1]["headers"]["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Encoding", second_call[1]["headers"])
+        self.assertEqual(json.loads(second_call[1]["data"]), {"update": 1})
+        self.on_failure.assert_called_once_with()
+
+
+# the gpus of nvidia-smi-output-mig.xml in the order in which nvidia-smi enumerates them, their minor numbers are 2 and 0
+MIG_GPU_ROWS = [
+    ["GPU-5c89852c-d268-c3f3-1b07-005d5ae1dc3f", "40536", "3024", "37512", "[N/A]", "NVIDIA A100-SXM4-40GB",
+     "00000000:07:00.0"],
+    ["GPU-0d6b7f6e-3c0e-9a5e-63c1-0e3f6f7a1a11", "40536", "0", "40536", "0", "NVIDIA A100-SXM4-40GB",
+     "00000000:0F:00.0"],
+]
+MIG_MINOR_NUMBERS = {"0000:07:00.0": 2, "0000:0f:00.0": 0}
+
+
+# output of nvidia-smi --query-gpu=uuid,memory.total,memory.used,memory.free,utilization.gpu,name,pci.bus_id and
+# --query-compute-apps=gpu_uuid,pid,used_memory,process_name with --format=csv,noheader,nounits
+RECORDED_GPU_QUERY = """GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1, 11178, 3021, 8157, 97, GeForce GTX 1080 Ti, 00000000:17:00.0
+GPU-b668a158-8fa2-00ca-7564-43d52620a570, 11178, 0, 11178, [Not Supported], GeForce GTX 1080 Ti, 00000000:65:00.0
+GPU-5c89852c-d268-c3f3-1b07-005d5ae1dc3f, [N/A], [N/A], [N/A], [N/A], NVIDIA A100-SXM4-40GB, 00000000:07:00.0
+"""
+RECORDED_COMPUTE_APPS_QUERY = """GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1, 4711, 3015, python train.py --lr 0.1,0.01
+GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1, 4712, [N/A], /usr/bin/python3
+GPU-00000000-0000-0000-0000-000000000000, 4713, 100, ghost
+"""
+
+
+class QueryCollectorTests(TestCase):
+
+    def setUp(self):
+        for target, return_value in [
+            ("device_query.get_owner_for_pid", "Mr. Keks"),
+            ("device_query.read_minor_numbers", {"0000:17:00.0": 0, "0000:65:00.0": 1}),
+        ]:
+            patcher = mock.patch(target, return_value=return_value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_parse_nvidia_csv(self):
+        rows = device_query.parse_nvidia_csv(RECORDED_COMPUTE_APPS_QUERY + "\n", 4)
+        self.assertEqual(len(rows), 3)
+        # only the last field may contain commas
+        self.assertEqual(rows[0], ["GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1", "4711", "3015",
+                                   "python train.py --lr 0.1,0.01"])
+        self.assertEqual(rows[1][2], "[N/A]")
+
+    def test_format_query_value(self):
+        self.assertEqual(device_query.format_query_value("3021", "MiB"), "3021 MiB")
+        self.assertEqual(device_query.format_query_value("[N/A]", "MiB"), "N/A")
+        self.assertEqual(device_query.format_query_value("[Not Supported]", "%"), "N/A")
+
+    def test_collect(self):
+        def check_output(command):
+            if command[1].startswith("--query-gpu="):
+                return RECORDED_GPU_QUERY.encode("utf-8")
+            return RECORDED_COMPUTE_APPS_QUERY.encode("utf-8")
+
+        with mock.patch("subprocess.check_output", side_effect=check_output):
+            gpu_data = device_query.QueryCollector().collect()
+
+        self.assertEqual(len(gpu_data), 3)
+        self.assertEqual(gpu_data[0], {
+            "name": "GeForce GTX 1080 Ti",
+            "uuid": "GPU-4a080c64-7bf0-e99d-bfb9-63fe9e76c0c1",
+            "index": 0,
+            "gpu_util": "97 %",
+            "in_use": "yes",
+            "processes": [
+                {"pid": "4711", "username": "Mr. Keks", "name": "python train.py --lr 0.1,0.01",
+                 "used_memory": "3015 MiB"},
+                {"pid": "4712", "username": "Mr. Keks", "name": "/usr/bin/python3", "used_memory": "N/A"},
+            ],
+            "memory": {"total": "11178 MiB", "used": "3021 MiB", "free": "8157 MiB"},
+        })
+        self.assertEqual(gpu_data[1]["gpu_util"], "N/A")
+        self.assertEqual(gpu_data[1]["in_use"], "no")
+        self.assertEqual(gpu_data[1]["processes"], [])
+        self.assertEqual(gpu_data[2]["memory"], {"total": "N/A", "used": "N/A", "free": "N/A"})
+        self.assertNotIn("index", gpu_data[2])
+
+    def test_unsupported_query_falls_back(self):
+        fallback = mock.Mock()
+        collector = device_query.FallbackCollector(device_query.QueryCollector(), fallback)
+        error = subprocess.CalledProcessError(2, ["nvidia-smi"])
+        with mock.patch("subprocess.check_output", side_effect=error) as check_output:
+            collector.collect()
+            collector.collect()
+        # the query is not tried again once it failed
+        check_output.assert_called_once()
+        self.assertEqual(fallback.collect.call_count, 2)
+
+
+class MinorNumberTests(TestCase):
+
+    def test_read_minor_numbers(self):
+        with tempfile.TemporaryDirectory() as proc_dir:
+            for bus_id, minor_number in MIG_MINOR_NUMBERS.items():
+                os.mkdir(os.path.join(proc_dir, bus_id))
+                with open(os.path.join(proc_dir, bus_id, "information"), "w") as f:
+                    f.write(f"Model: \t\t NVIDIA A100-SXM4-40GB\nIRQ:   \t\t 105\n"
+                            f"GPU UUID: \t GPU-{bus_id}\nDevice Minor: \t {minor_number}\nBus Location: \t {bus_id}\n")
+            os.mkdir(os.path.join(proc_dir, "0000:10:00.0"))
+            self.assertEqual(device_query.read_minor_numbers(proc_dir), MIG_MINOR_NUMBERS)
+
+    def test_missing_driver(self):
+        self.assertEqual(device_query.read_minor_numbers("/does/not/exist"), {})
+
+    def test_query_uses_minor_number_not_enumeration_index(self):
+        with mock.patch("device_query.get_owner_for_pid", return_value="Mr. Keks"):
+            xml_gpu_data = device_query.parse_nvidia_xml(read_fixture("nvidia-smi-output-mig.xml"))
+        gpu_data = device_query.build_gpu_data_from_query(MIG_GPU_ROWS, [], MIG_MINOR_NUMBERS)
+        self.assertEqual([gpu["index"] for gpu in gpu_data], [2, 0])
+        self.assertEqual([gpu["index"] for gpu in gpu_data], [gpu["index"] for gpu in xml_gpu_data])
+
+    def test_unknown_minor_number(self):
+        gpu_data = device_query.build_gpu_data_from_query(MIG_GPU_ROWS, [], {})
+        self.assertNotIn("index", gpu_data[0])
+
+    def test_aggregator(self):
+        output = "\n".join([
+            *(", ".join(row) for row in MIG_GPU_ROWS),
+            aggregator.OUTPUT_SEPARATOR,
+            aggregator.OUTPUT_SEPARATOR,
+            "    1 root",
+            aggregator.OUTPUT_SEPARATOR,
+            "/proc/driver/nvidia/gpus/0000:07:00.0/information:Device Minor: \t 2",
+            "/proc/driver/nvidia/gpus/0000:0f:00.0/information:Device Minor: \t 0",
+        ])
+        gpu_data = aggregator.parse_remote_output(output)
+        self.assertEqual([gpu["index"] for gpu in gpu_data], [2, 0])
+
+
+class SlurmJsonTests(TestCase):
+
+    def test_parse_scontrol_json(self):
+        self.assertEqual(slurm_updater.parse_scontrol_json(read_fixture("scontrol-show-nodes.json")), {
+            "fb10dl03": [0, 1],
+            "fb10dl04": [],
+            "fb10dl10": [0, 2, 4],
+            "resterampe": [0],
+            "login": [],
+        })
+
+    def test_parse_squeue_json(self):
+        jobs = slurm_updater.parse_squeue_json(read_fixture("squeue-jobs.json"))
+        first_job = {"job_id": 4711, "user": "mr_keks", "start_time": 1633072800}
+        second_job = {"job_id": 4712, "user": "mrs_kruemel", "start_time": 1633076400}
+        # pending jobs do not hold any gpu, the gres of a job are listed per node
+        self.assertEqual(jobs, {
+            ("fb10dl03", 0): first_job,
+            ("fb10dl03", 1): first_job,
+            ("fb10dl10", 0): second_job,
+            ("fb10dl10", 2): second_job,
+            ("fb10dl10", 4): second_job,
+            ("resterampe", 0): second_job,
+        })
+
+    def test_parse_squeue_json_of_newer_slurm_versions(self):
+        squeue_output = json.loads(read_fixture("squeue-jobs.json"))
+        for job in squeue_output["jobs"]:
+            job["job_state"] = [job["job_state"]]
+            job["start_time"] = {"set": True, "infinite": False, "number": job["start_time"]}
+        jobs = slurm_updater.parse_squeue_json(json.dumps(squeue_output))
+        self.assertEqual(jobs[("fb10dl03", 0)], {"job_id": 4711, "user": "mr_keks", "start_time": 1633072800})
+        self.assertEqual(len(jobs), 6)
+
+    def test_attach_jobs(self):
+        node_info = slurm_updater.parse_scontrol_json(read_fixture("scontrol-show-nodes.json"))
+        jobs = slurm_updater.parse_squeue_json(read_fixture("squeue-jobs.json"))
+        allocations = slurm_updater.attach_jobs(node_info, jobs)
+        self.assertEqual(allocations["fb10dl03"][1], {"index": 1, "job_id": 4711, "user": "mr_keks",
+                                                      "start_time": 1633072800})
+        self.assertEqual(allocations["fb10dl04"], [])
+
+
+class AllocationTrackerTests(TestCase):
+
+    def setUp(self):
+        self.tracker = slurm_updater.AllocationTracker(heartbeat_interval=60)
+        self.node_info = {"node1": [0], "node2": []}
+
+    def test_first_update_is_complete(self):
+        self.assertEqual(self.tracker.build_post_data(self.node_info, 0), self.node_info)
+
+    def test_only_changes_are_sent(self):
+        self.tracker.build_post_data(self.node_info, 0)
+        self.assertIsNone(self.tracker.build_post_data({"node1": [0], "node2": []}, 1))
+        self.assertEqual(self.tracker.build_post_data({"node1": [0], "node2": [1]}, 2), {"node2": [1]})
+        # nodes that are not reported anymore lose their allocations
+        self.assertEqual(self.tracker.build_post_data({"node2": [1]}, 3), {"node1": []})
+
+    def test_heartbeat_sends_everything(self):
+        self.tracker.build_post_data(self.node_info, 0)
+        self.assertIsNone(self.tracker.build_post_data(self.node_info, 59))
+        self.assertEqual(self.tracker.build_post_data(self.node_info, 60), self.node_info)
+
+    def test_reset_sends_everything(self):
+        self.tracker.build_post_data(self.node_info, 0)
+        self.tracker.reset()
+        self.assertEqual(self.tracker.build_post_data(self.node_info, 1), self.node_info)
+
+    def test_node_updates(self):
+        self.tracker.build_post_data(self.node_info, 0)
+        self.assertIsNone(self.tracker.build_node_post_data({"node1": [0]}))
+        self.assertEqual(self.tracker.build_node_post_data({"node2": [0]}), {"node2": [0]})
+        self.assertIsNone(self.tracker.build_post_data({"node1": [0], "node2": [0]}, 1))
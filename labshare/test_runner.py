@@ -0,0 +1,25 @@
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+# the configured cache is shared with the running server (Redis), the tests must neither need nor flush it
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+class LabShareTestRunner(DiscoverRunner):
+    """
+    Runs the tests with an in-memory cache. The cache is replaced before the test databases are created, because
+    the signals sent while migrating the test databases already use it.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_override = override_settings(CACHES=TEST_CACHES)
+        self.cache_override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_override.disable()
+        super().teardown_test_environment(**kwargs)
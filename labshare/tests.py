@@ -1,28 +1,42 @@
+import asyncio
 import copy
 import datetime
+import functools
+import gzip
 import io
 import json
+import math
 import os
 import random
 import string
+import tempfile
 import time
+import unittest
 import unittest.mock as mock
 import uuid
+import zlib
 from datetime import timedelta
 from unittest import skipIf
 from unittest.mock import Mock
 
+import msgpack
+import numpy as np
 import requests
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
 from channels.layers import get_channel_layer
 from channels.testing import ChannelsLiveServerTestCase, WebsocketCommunicator
 from django import template
 from django.conf import settings
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import AnonymousUser, User, Group, Permission
+from django.core.cache import cache
 from django.core import mail
-from django.test import TestCase, override_settings, Client
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings, Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django_webtest import WebTest
-from guardian.shortcuts import assign_perm
+from guardian.shortcuts import assign_perm, remove_perm
 from guardian.utils import get_anonymous_user
 from model_bakery import baker
 from model_bakery.recipe import Recipe
@@ -36,11 +50,15 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 
-from labshare.consumers import GPUInfoUpdater
-from labshare.models import Device, EmailAddress, GPU
+from labshare import gpu_cache, telemetry
+from labshare.consumers import DevicesInfoUpdater, GPUInfoUpdater
+from labshare.models import Device, EmailAddress, GPU, GPUReservation
+from labshare.permissions import can_use_device, get_visible_device_ids
+from labshare.publisher import CoalescingPublisher, queue_device_state
 from labshare.routing import application
 from labshare.templatetags.icon import icon
-from labshare.utils import get_devices, publish_device_state
+from labshare.utils import build_update_message, get_devices, get_device_state, publish_device_state, \
+    store_device_state
 
 device_recipe = Recipe(
     Device,
@@ -310,6 +328,196 @@ class LabSharePermissionTests(WebTest):
             self.assertNotIn(device.name, response.body.decode('utf-8'))
 
 
+@unittest.skipUnless(connection.vendor == 'sqlite', "SQLite pragmas are only set on SQLite connections")
+class SQLiteConnectionTests(TestCase):
+
+    def test_pragmas_are_set_on_new_connections(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['journal_mode'])
+
+
+class PermissionIndexTests(WebTest):
+
+    def setUp(self):
+        cache.clear()
+        self.user = baker.make(User)
+        self.devices = device_recipe.make(_quantity=3)
+        self.group = baker.make(Group)
+
+    def assert_visible_devices(self, user, devices):
+        self.assertEqual(get_visible_device_ids(user), frozenset(device.id for device in devices))
+        for device in self.devices:
+            self.assertEqual(can_use_device(user, device), device in devices)
+            self.assertEqual(can_use_device(user, device), device.can_be_used_by(user))
+
+    def test_object_permissions(self):
+        self.assert_visible_devices(self.user, [])
+
+        assign_perm('use_device', self.user, self.devices[0])
+        self.assert_visible_devices(self.user, self.devices[:1])
+
+        assign_perm('use_device', self.group, self.devices[1])
+        self.user.groups.add(self.group)
+        self.assert_visible_devices(self.user, self.devices[:2])
+
+        self.user.groups.remove(self.group)
+        remove_perm('use_device', self.user, self.devices[0])
+        self.assert_visible_devices(self.user, [])
+
+    def test_group_permissions(self):
+        self.user.groups.add(self.group)
+        assign_perm('use_device', self.group, self.devices[0])
+        self.assert_visible_devices(self.user, self.devices[:1])
+
+        remove_perm('use_device', self.group, self.devices[0])
+        self.assert_visible_devices(self.user, [])
+
+        # guardian removes the permissions of querysets with a delete, which sends signals
+        assign_perm('use_device', self.group, self.devices[1])
+        self.assert_visible_devices(self.user, self.devices[1:2])
+        remove_perm('use_device', self.group, Device.objects.filter(id=self.devices[1].id))
+        self.assert_visible_devices(self.user, [])
+
+    def test_bulk_assigned_permissions_are_visible_after_timeout(self):
+        self.user.groups.add(self.group)
+        self.assert_visible_devices(self.user, [])
+
+        # guardian assigns the permissions of querysets with bulk_create, which does not send any signal
+        assign_perm('use_device', self.group, Device.objects.filter(id__in=[device.id for device in self.devices[:2]]))
+        with mock.patch('time.time', return_value=time.time() + settings.PERMISSION_CACHE_TIMEOUT + 1):
+            self.assert_visible_devices(self.user, self.devices[:2])
+
+    def test_admin_invalidates_visible_devices(self):
+        admin = baker.make(User, is_staff=True, is_superuser=True)
+        self.user.groups.add(self.group)
+        self.assert_visible_devices(self.user, [])
+
+        url = reverse('admin:labshare_device_permissions_manage_group', args=[self.devices[0].pk, self.group.pk])
+        with mock.patch('labshare.admin.permissions') as admin_permissions:
+            form = self.app.get(url, user=admin).form
+            form['permissions'] = ['use_device']
+            form.submit(user=admin)
+        admin_permissions.invalidate.assert_called_once_with()
+        self.assert_visible_devices(self.user, self.devices[:1])
+
+    def test_global_permission(self):
+        self.group.permissions.add(Permission.objects.get(codename='use_device'))
+        self.user.groups.add(self.group)
+        self.assert_visible_devices(self.user, self.devices)
+
+        new_device = device_recipe.make()
+        self.assertIn(new_device.id, get_visible_device_ids(self.user))
+
+    def test_superuser_and_inactive_user(self):
+        self.user.is_superuser = True
+        self.user.save()
+        self.assert_visible_devices(self.user, self.devices)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(get_visible_device_ids(self.user), frozenset())
+
+    def test_anonymous_user(self):
+        self.assert_visible_devices(AnonymousUser(), [])
+        assign_perm('use_device', get_anonymous_user(), self.devices[0])
+        self.assert_visible_devices(AnonymousUser(), self.devices[:1])
+
+    def test_visible_devices_are_cached(self):
+        assign_perm('use_device', self.user, self.devices[0])
+        get_visible_device_ids(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_visible_device_ids(self.user), frozenset([self.devices[0].id]))
+
+        self.user.last_login = utc_now()
+        self.user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            get_visible_device_ids(self.user)
+
+    def test_overview_queries_do_not_depend_on_number_of_devices(self):
+        self.user.user_permissions.add(Permission.objects.get(codename='use_device'))
+
+        def count_overview_queries():
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.app.get(reverse('index'), user=self.user)
+            return len(queries)
+
+        # the first request also logs the user in
+        self.app.get(reverse('index'), user=self.user)
+        num_queries = count_overview_queries()
+        device_recipe.make(_quantity=10)
+        self.assertEqual(count_overview_queries(), num_queries)
+
+
+class OverviewCacheTests(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        cache.clear()
+        self.user = baker.make(User)
+        self.devices = device_recipe.make(_quantity=2)
+        assign_perm('use_device', self.user, self.devices[0])
+
+    def test_overview_is_cached(self):
+        self.app.get(reverse('index'), user=self.user)
+        with mock.patch('labshare.views.render') as render_mock:
+            response = self.app.get(reverse('index'), user=self.user)
+        render_mock.assert_not_called()
+        self.assertIn(self.devices[0].name, response.text)
+        self.assertNotIn(self.devices[1].name, response.text)
+
+    def test_overview_not_modified(self):
+        response = self.app.get(reverse('index'), user=self.user)
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+        response = self.app.get(reverse('index'), user=self.user, headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(response.body, b'')
+
+        assign_perm('use_device', self.user, self.devices[1])
+        response = self.app.get(reverse('index'), user=self.user, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(self.devices[1].name, response.text)
+
+    def test_overview_changes_with_templates(self):
+        etag = self.app.get(reverse('index'), user=self.user).headers['ETag']
+
+        # a deploy with new templates restarts the server, which computes a new fingerprint
+        with mock.patch('labshare.views.get_template_fingerprint', return_value=("new-templates", time.time())):
+            response = self.app.get(reverse('index'), user=self.user, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_overview_is_cached_per_user(self):
+        other_user = baker.make(User)
+        assign_perm('use_device', other_user, self.devices[1])
+        etag = self.app.get(reverse('index'), user=self.user).headers['ETag']
+
+        response = self.app.get(reverse('index'), user=other_user, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(other_user.username, response.text)
+        self.assertIn(self.devices[1].name, response.text)
+        self.assertNotIn(self.devices[0].name, response.text)
+
+    def test_overview_with_messages_is_not_cached(self):
+        etag = self.app.get(reverse('index'), user=self.user).headers['ETag']
+
+        # sending a message redirects to the overview, which has to show the success message
+        self.app.post(reverse('send_message'), {
+            'recipients': [self.user.id], 'subject': "Lorem", 'message': "Ipsum",
+        }, user=self.user)
+        response = self.app.get(reverse('index'), user=self.user, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+        self.assertIn("Message sent!", response.text)
+
+        response = self.app.get(reverse('index'), user=self.user)
+        self.assertNotIn("Message sent!", response.text)
+
+
 class EmailAddressTests(WebTest):
 
     def setUp(self):
@@ -397,6 +605,16 @@ def request_data(device_name, data_function):
     }
 
 
+def use_temporary_telemetry_dir(test_case):
+    telemetry_dir = tempfile.TemporaryDirectory()
+    test_case.addCleanup(telemetry_dir.cleanup)
+    settings_override = override_settings(TELEMETRY_DIR=telemetry_dir.name)
+    settings_override.enable()
+    test_case.addCleanup(settings_override.disable)
+    test_case.addCleanup(telemetry.close)
+    return telemetry_dir.name
+
+
 def return_bytes_io(func):
     def wrapper(*args, **kwargs):
         data = func(*args, **kwargs)
@@ -411,6 +629,9 @@ class UpdateGPUTests(APITestCase):
     def setUp(self):
         self.device = device_recipe.make()
         self.url = reverse("update_gpu_info")
+        cache.clear()
+        gpu_cache.clear()
+        use_temporary_telemetry_dir(self)
         user = self.device.user
         self.client.force_authenticate(user=user)
 
@@ -420,6 +641,474 @@ class UpdateGPUTests(APITestCase):
                                     format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_update_gpu_info_stores_device_state(self):
+        response = self.client.post(self.url,
+                                    request_data(self.device.name, working_gpu_data_with_one_gpu_in_use),
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        device_state = get_device_state(self.device.name)
+        self.assertEqual(device_state['name'], self.device.name)
+        self.assertEqual(len(device_state['gpus']), 1)
+        self.assertTrue(device_state['gpus'][0]['in_use'])
+        self.assertEqual(device_state['gpus'][0]['processes'][0]['username'], "Mr. Keks")
+
+    def test_update_gpu_info_records_telemetry(self):
+        data = request_data(self.device.name, working_gpu_data_with_one_gpu_in_use)
+        self.client.post(self.url, data, format='json')
+        data['delta'] = True
+        data['gpu_data'] = []
+        self.client.post(self.url, data, format='json')
+        telemetry.close()
+
+        samples = telemetry.get_store().read("lorem", telemetry.RAW, 0, time.time() + 1)
+        self.assertEqual(len(samples), 2)
+        self.assertEqual(samples[0]["used_memory"], 20)
+        self.assertEqual(samples[1]["utilization"], 25)
+
+    def test_update_gpu_info_stores_index(self):
+        gpu_data = working_gpu_data_with_one_gpu_not_in_use()
+        gpu_data[0]['index'] = 3
+        self.client.post(self.url, request_data(self.device.name, lambda: gpu_data), format='json')
+        self.assertEqual(GPU.objects.get(uuid="lorem").index, 3)
+        self.assertEqual(get_device_state(self.device.name)['gpus'][0]['index'], 3)
+
+        # the index changes if the gpus of the device are renumbered
+        gpu_data[0]['index'] = 1
+        self.client.post(self.url, request_data(self.device.name, lambda: gpu_data), format='json')
+        self.assertEqual(GPU.objects.get(uuid="lorem").index, 1)
+        self.assertEqual(get_device_state(self.device.name)['gpus'][0]['index'], 1)
+
+    def test_update_gpu_info_contains_reservation(self):
+        gpu = baker.make(GPU, device=self.device, uuid="lorem", reserved=True)
+        GPUReservation.objects.create(gpu=gpu, job_id="42", username="slurm_user")
+        data = request_data(self.device.name, working_gpu_data_with_one_gpu_not_in_use)
+        self.client.post(self.url, data, format='json')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, data, format='json')
+        self.assertFalse(any("labshare_gpureservation" in query["sql"] for query in queries))
+        reservation = get_device_state(self.device.name)['gpus'][0]['reservation']
+        self.assertEqual(reservation, {'job_id': "42", 'user': "slurm_user", 'start_time': None})
+
+    def test_update_gpu_info_delta_without_known_state(self):
+        data = request_data(self.device.name, working_gpu_data_with_one_gpu_not_in_use)
+        data['delta'] = True
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIsNone(get_device_state(self.device.name))
+
+    def test_update_gpu_info_delta_is_merged(self):
+        data = request_data(self.device.name, working_gpu_data_with_one_gpu_not_in_use)
+        second_gpu = get_gpu_template()
+        second_gpu['uuid'] = "ipsum"
+        data['gpu_data'].append(second_gpu)
+        self.client.post(self.url, data, format='json')
+
+        changed_gpu = get_gpu_template()
+        changed_gpu['gpu_util'] = "99 %"
+        delta = {
+            "gpu_data": [changed_gpu],
+            "device_name": self.device.name,
+            "delta": True,
+        }
+        with mock.patch('labshare.views.queue_device_state') as publish_mock:
+            response = self.client.post(self.url, delta, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        published_state = publish_mock.call_args[0][0]
+        self.assertEqual(published_state, get_device_state(self.device.name))
+        utilizations = {gpu['uuid']: gpu['utilization'] for gpu in published_state['gpus']}
+        self.assertEqual(utilizations, {"lorem": "99 %", "ipsum": "25 %"})
+
+    def test_update_gpu_info_heartbeat_is_not_published(self):
+        self.client.post(self.url, request_data(self.device.name, working_gpu_data_with_one_gpu_not_in_use),
+                         format='json')
+        heartbeat = {
+            "gpu_data": [],
+            "device_name": self.device.name,
+            "delta": True,
+        }
+        with mock.patch('labshare.views.queue_device_state') as publish_mock:
+            response = self.client.post(self.url, heartbeat, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        publish_mock.assert_not_called()
+        self.assertEqual(len(get_device_state(self.device.name)['gpus']), 1)
+
+    def test_update_gpu_info_creates_gpus_once(self):
+        data = request_data(self.device.name, working_gpu_data_with_one_gpu_not_in_use)
+        second_gpu = get_gpu_template()
+        second_gpu['uuid'] = "ipsum"
+        data['gpu_data'].append(second_gpu)
+
+        self.client.post(self.url, data, format='json')
+        self.client.post(self.url, data, format='json')
+        self.assertEqual(
+            sorted(GPU.objects.filter(device=self.device).values_list('uuid', flat=True)), ["ipsum", "lorem"]
+        )
+
+    def test_update_gpu_info_steady_state_only_reads_device(self):
+        data = request_data(self.device.name, working_gpu_data_with_one_gpu_not_in_use)
+        self.client.post(self.url, data, format='json')
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_update_gpu_info_sees_changed_gpus(self):
+        data = request_data(self.device.name, working_gpu_data_with_one_gpu_not_in_use)
+        self.client.post(self.url, data, format='json')
+
+        gpu = GPU.objects.get(device=self.device, uuid="lorem")
+        gpu.reserved = True
+        gpu.save()
+
+        self.client.post(self.url, data, format='json')
+        self.assertTrue(get_device_state(self.device.name)['gpus'][0]['reserved'])
+
+    def post_encoded(self, body, content_type="application/json", **extra):
+        return self.client.post(self.url, data=body, content_type=content_type, **extra)
+
+    def test_update_gpu_info_compressed_json(self):
+        body = json.dumps(request_data(self.device.name, working_gpu_data_with_one_gpu_in_use)).encode("utf-8")
+        for content_encoding, compress in [("gzip", gzip.compress), ("deflate", zlib.compress)]:
+            cache.clear()
+            response = self.post_encoded(compress(body), HTTP_CONTENT_ENCODING=content_encoding)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(get_device_state(self.device.name)['gpus']), 1)
+
+    def test_update_gpu_info_msgpack(self):
+        body = msgpack.packb(request_data(self.device.name, working_gpu_data_with_one_gpu_in_use), use_bin_type=True)
+        response = self.post_encoded(gzip.compress(body), content_type="application/msgpack",
+                                     HTTP_CONTENT_ENCODING="gzip")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_device_state(self.device.name)['gpus'][0]['processes'][0]['username'], "Mr. Keks")
+
+    def test_update_gpu_info_unsupported_encoding(self):
+        body = json.dumps(request_data(self.device.name, working_gpu_data_with_one_gpu_in_use)).encode("utf-8")
+        response = self.post_encoded(body, HTTP_CONTENT_ENCODING="br")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+        response = self.post_encoded(body, content_type="application/xml")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_update_gpu_info_broken_payload(self):
+        response = self.post_encoded(b"no gzip", HTTP_CONTENT_ENCODING="gzip")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.post_encoded(json.dumps({"gpu_data": []}).encode("utf-8"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.post_encoded(json.dumps({"device_name": self.device.name}).encode("utf-8"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        body = json.dumps(request_data(self.device.name, working_gpu_data_with_one_gpu_in_use)).encode("utf-8")
+        response = self.post_encoded(gzip.compress(body)[:-10], HTTP_CONTENT_ENCODING="gzip")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_gpu_info_too_large(self):
+        body = json.dumps(request_data(self.device.name, working_gpu_data_with_one_gpu_in_use)).encode("utf-8")
+        with self.settings(MAX_UPDATE_PAYLOAD_SIZE=len(body) - 1):
+            response = self.post_encoded(body)
+            self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            for content_encoding, compress in [("gzip", gzip.compress), ("deflate", zlib.compress)]:
+                response = self.post_encoded(compress(body), HTTP_CONTENT_ENCODING=content_encoding)
+                self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        with self.settings(MAX_UPDATE_PAYLOAD_SIZE=len(body)):
+            response = self.post_encoded(gzip.compress(body), HTTP_CONTENT_ENCODING="gzip")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class BulkUpdateGPUTests(APITestCase):
+
+    def setUp(self):
+        self.devices = device_recipe.make(_quantity=2)
+        self.url = reverse("update_gpu_info_bulk")
+        cache.clear()
+        gpu_cache.clear()
+        use_temporary_telemetry_dir(self)
+
+    def device_update(self, device, token=None):
+        update = request_data(device.name, working_gpu_data_with_one_gpu_not_in_use)
+        update['token'] = token if token is not None else Token.objects.get(user=device.user).key
+        return update
+
+    def test_bulk_update_all_devices(self):
+        updates = [self.device_update(device) for device in self.devices]
+        response = self.client.post(self.url, {"devices": updates}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {"devices": {device.name: 200 for device in self.devices}})
+        for device in self.devices:
+            self.assertEqual(len(get_device_state(device.name)['gpus']), 1)
+
+    def test_bulk_update_checks_token_of_each_device(self):
+        other_token = Token.objects.get(user=self.devices[1].user).key
+        updates = [
+            self.device_update(self.devices[0], token=other_token),
+            self.device_update(self.devices[1]),
+        ]
+        response = self.client.post(self.url, {"devices": updates}, format='json')
+        self.assertEqual(response.json(), {"devices": {self.devices[0].name: 403, self.devices[1].name: 200}})
+        self.assertIsNone(get_device_state(self.devices[0].name))
+
+    def test_bulk_update_malformed_payload(self):
+        update = self.device_update(self.devices[0])
+        del update['device_name']
+        valid_update = self.device_update(self.devices[1])
+        for payload in [{}, {"devices": {}}, {"devices": [update]}, {"devices": ["kekse"]},
+                        {"devices": [valid_update, dict(valid_update, device_name=["kekse"])]}]:
+            response = self.client.post(self.url, payload, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for device in self.devices:
+            self.assertIsNone(get_device_state(device.name))
+
+    def test_bulk_update_malformed_gpu_data(self):
+        updates = [self.device_update(device) for device in self.devices]
+        del updates[0]['gpu_data']
+        updates[1]['token'] = ["kekse"]
+        response = self.client.post(self.url, {"devices": updates}, format='json')
+        self.assertEqual(response.json(), {"devices": {self.devices[0].name: 400, self.devices[1].name: 403}})
+
+        updates = [self.device_update(device) for device in self.devices]
+        updates[0]['gpu_data'][0]['memory'] = "a lot"
+        response = self.client.post(self.url, {"devices": updates}, format='json')
+        self.assertEqual(response.json(), {"devices": {self.devices[0].name: 400, self.devices[1].name: 200}})
+        self.assertIsNone(get_device_state(self.devices[0].name))
+
+    @override_settings(MAX_UPDATE_PAYLOAD_SIZE=1024)
+    def test_bulk_update_decompression_bomb(self):
+        body = gzip.compress(json.dumps({"devices": [], "padding": " " * 1024 * 1024}).encode("utf-8"))
+        self.assertLess(len(body), 1024 * 1024)
+        response = self.client.post(self.url, data=body, content_type="application/json",
+                                    HTTP_CONTENT_ENCODING="gzip")
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_bulk_update_invalid_token(self):
+        response = self.client.post(self.url, {"devices": [self.device_update(self.devices[0], token="kekse")]},
+                                    format='json')
+        self.assertEqual(response.json(), {"devices": {self.devices[0].name: 403}})
+
+    def test_bulk_update_allocation_user_token(self):
+        allocation_user = User.objects.get(username=settings.ALLOCATION_UPDATE_USERNAME)
+        token = Token.objects.get(user=allocation_user).key
+        response = self.client.post(self.url, {"devices": [self.device_update(self.devices[0], token=token)]},
+                                    format='json')
+        self.assertEqual(response.json(), {"devices": {self.devices[0].name: 403}})
+
+    def test_bulk_update_delta_without_known_state(self):
+        update = self.device_update(self.devices[0])
+        update['delta'] = True
+        response = self.client.post(self.url, {"devices": [update]}, format='json')
+        self.assertEqual(response.json(), {"devices": {self.devices[0].name: 409}})
+
+
+class TelemetryStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.telemetry_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.telemetry_dir.cleanup)
+        self.retention = {
+            telemetry.RAW: 2 * 60 * 60,
+            telemetry.ONE_MINUTE: 2 * 24 * 60 * 60,
+            telemetry.ONE_HOUR: 60 * 24 * 60 * 60,
+        }
+        self.store = telemetry.TelemetryStore(self.telemetry_dir.name, self.retention, flush_size=4, flush_interval=60)
+
+    def test_samples_are_buffered_until_flush(self):
+        for i in range(3):
+            self.store.append("gpu", i, 10, 100, 50)
+        self.assertEqual(len(self.store.read("gpu", telemetry.RAW, 0, 100)), 0)
+
+        self.store.append("gpu", 3, 10, 100, 50)
+        self.assertEqual(len(self.store.read("gpu", telemetry.RAW, 0, 100)), 4)
+
+    def test_gpu_directories_stay_in_store(self):
+        store_directory = os.path.join(self.telemetry_dir.name, "store")
+        store = telemetry.TelemetryStore(store_directory, self.retention, flush_size=1)
+        uuids = ["..", ".", "../../evil", "/etc", "GPU/1", "GPU_1", "GPU-1"]
+        for i, gpu_uuid in enumerate(uuids):
+            store.append(gpu_uuid, 0, i, 100, 50)
+        store.flush()
+
+        self.assertEqual(os.listdir(self.telemetry_dir.name), ["store"])
+        self.assertEqual(len(os.listdir(store_directory)), len(uuids))
+        for i, gpu_uuid in enumerate(uuids):
+            self.assertEqual(store.read(gpu_uuid, telemetry.RAW, 0, 100)["used_memory"].tolist(), [i])
+
+    def test_samples_are_flushed_after_flush_interval(self):
+        self.store.append("gpu", 0, 10, 100, 50)
+        self.store.append("gpu", 60, 10, 100, 50)
+        self.assertEqual(len(self.store.read("gpu", telemetry.RAW, 0, 100)), 2)
+
+    def test_read_range(self):
+        for i in range(10):
+            self.store.append("gpu", i * 10, i, 100, 50)
+        self.store.flush()
+
+        samples = self.store.read("gpu", telemetry.RAW, 20, 50)
+        np.testing.assert_array_equal(samples["timestamp"], [20, 30, 40])
+        np.testing.assert_array_equal(samples["used_memory"], [2, 3, 4])
+
+    def test_rollup(self):
+        for i, utilization in enumerate([10, 20, 60, 30]):
+            self.store.append("gpu", 30 * i, 100 * i, 1000, utilization)
+        self.store.flush()
+
+        minutes = self.store.read("gpu", telemetry.ONE_MINUTE, 0, 3600)
+        np.testing.assert_array_equal(minutes["timestamp"], [0, 60])
+        np.testing.assert_array_equal(minutes["utilization_count"], [2, 2])
+        np.testing.assert_array_equal(minutes["utilization_sum"], [30, 90])
+        np.testing.assert_array_equal(minutes["utilization_max"], [20, 60])
+        np.testing.assert_array_equal(minutes["used_memory_max"], [100, 300])
+
+        hours = self.store.read("gpu", telemetry.ONE_HOUR, 0, 3600)
+        self.assertEqual(len(hours), 1)
+        self.assertEqual(hours[0]["utilization_count"], 4)
+        self.assertEqual(hours[0]["utilization_max"], 60)
+
+    def test_rollup_skips_missing_values(self):
+        for i in range(60):
+            self.store.append("gpu", i, 100, 1000, math.nan if i == 0 else 50)
+        for i in range(60, 120):
+            self.store.append("gpu", i, 100, 1000, math.nan)
+        self.store.flush()
+
+        minutes = self.store.read("gpu", telemetry.ONE_MINUTE, 0, 3600)
+        np.testing.assert_array_equal(minutes["utilization_count"], [59, 0])
+        np.testing.assert_array_equal(minutes["utilization_sum"], [59 * 50, 0])
+        np.testing.assert_array_equal(minutes["utilization_max"], [50, np.nan])
+        np.testing.assert_array_equal(minutes["used_memory_count"], [60, 60])
+
+        for resolution, step in ((telemetry.ONE_MINUTE, 60), (telemetry.ONE_HOUR, 3600)):
+            records = self.store.read("gpu", resolution, 0, 3600)
+            history = telemetry.build_history(records, resolution, 0, step)
+            self.assertEqual(history["utilization"]["mean"][0], 50)
+            self.assertEqual(history["utilization"]["max"][0], 50)
+        history = telemetry.build_history(minutes, telemetry.ONE_MINUTE, 0, 60)
+        self.assertEqual(history["utilization"]["mean"], [50, None])
+        self.assertEqual(history["utilization"]["max"], [50, None])
+
+    def test_json_list_contains_only_finite_values(self):
+        values = np.array([1.234, np.nan, -np.inf, np.inf])
+        self.assertEqual(json.dumps(telemetry.to_json_list(values), allow_nan=False), "[1.23, null, null, null]")
+
+    def test_buckets_of_several_writers_are_merged(self):
+        other_store = telemetry.TelemetryStore(self.telemetry_dir.name, self.retention)
+        self.store.append("gpu", 0, 100, 1000, 10)
+        other_store.append("gpu", 30, 300, 1000, 50)
+        self.store.flush()
+        other_store.flush()
+
+        minutes = self.store.read("gpu", telemetry.ONE_MINUTE, 0, 60)
+        self.assertEqual(len(minutes), 1)
+        self.assertEqual(minutes[0]["used_memory_count"], 2)
+        self.assertEqual(minutes[0]["used_memory_sum"], 400)
+        self.assertEqual(minutes[0]["utilization_max"], 50)
+
+    def test_retention_removes_old_segments(self):
+        segment_length = telemetry.SEGMENT_LENGTHS[telemetry.RAW]
+        self.store.append("gpu", 0, 10, 100, 50)
+        self.store.flush()
+        self.assertEqual(len(self.store.read("gpu", telemetry.RAW, 0, 1)), 1)
+
+        self.store.append("gpu", 3 * segment_length, 10, 100, 50)
+        self.store.flush()
+        self.assertEqual(len(self.store.read("gpu", telemetry.RAW, 0, 1)), 0)
+        self.assertEqual(len(self.store.read("gpu", telemetry.RAW, 0, 4 * segment_length)), 1)
+
+    def test_record_device_state(self):
+        device_state = {
+            "name": "device",
+            "gpus": [
+                {"uuid": "GPU-1", "used_memory": "20 MiB", "total_memory": "100 MiB", "utilization": "N/A"},
+            ],
+        }
+        self.store.record_device_state(device_state, 5)
+        self.store.flush()
+
+        samples = self.store.read("GPU-1", telemetry.RAW, 0, 10)
+        self.assertEqual(samples[0]["used_memory"], 20)
+        self.assertEqual(samples[0]["total_memory"], 100)
+        self.assertTrue(np.isnan(samples[0]["utilization"]))
+
+
+class HistoryTests(WebTest):
+
+    def setUp(self):
+        use_temporary_telemetry_dir(self)
+        self.user = baker.make(User)
+        self.device, self.other_device = device_recipe.make(_quantity=2)
+        assign_perm('use_device', self.user, self.device)
+        self.gpus = baker.make(GPU, device=self.device, _quantity=2)
+        self.other_gpu = baker.make(GPU, device=self.other_device)
+
+        store = telemetry.get_store()
+        for i in range(10):
+            utilization = "N/A" if i == 5 else f"{i * 10} %"
+            for gpu in self.gpus:
+                store.record_device_state({"gpus": [{
+                    "uuid": gpu.uuid, "used_memory": f"{i * 100} MiB", "total_memory": "1000 MiB",
+                    "utilization": utilization,
+                }]}, 1000 + i * 10)
+        telemetry.close()
+
+    def test_gpu_history(self):
+        url = reverse("gpu_history", args=[self.gpus[0].uuid])
+        response = self.app.get(url, {"from": 1000, "to": 1100, "step": 50}, user=self.user)
+
+        history = response.json
+        self.assertEqual(history["resolution"], telemetry.RAW)
+        self.assertEqual(history["timestamps"], [1000, 1050])
+        self.assertEqual(history["used_memory"]["mean"], [200, 700])
+        self.assertEqual(history["used_memory"]["max"], [400, 900])
+        self.assertEqual(history["utilization"]["mean"], [20, 75])
+        self.assertEqual(history["total_memory"], [1000, 1000])
+        self.assertEqual(history["percentiles"]["used_memory"]["50"], 450)
+        self.assertEqual(history["percentiles"]["utilization"]["90"], 82)
+
+    def test_gpu_history_rollup(self):
+        url = reverse("gpu_history", args=[self.gpus[0].uuid])
+        response = self.app.get(url, {"from": 0, "to": 3600, "step": 600}, user=self.user)
+
+        history = response.json
+        self.assertEqual(history["resolution"], telemetry.ONE_MINUTE)
+        self.assertEqual(history["timestamps"], [600])
+        self.assertEqual(history["used_memory"]["mean"], [450])
+        self.assertEqual(history["utilization"]["max"], [90])
+
+    def test_device_history(self):
+        url = reverse("device_history", args=[self.device.name])
+        response = self.app.get(url, {"from": 1000, "to": 1100, "step": 50}, user=self.user)
+
+        self.assertEqual(response.json["name"], self.device.name)
+        self.assertEqual(
+            sorted(history["uuid"] for history in response.json["gpus"]), sorted(gpu.uuid for gpu in self.gpus)
+        )
+        for history in response.json["gpus"]:
+            self.assertEqual(history["used_memory"]["mean"], [200, 700])
+
+    def test_history_without_samples(self):
+        url = reverse("gpu_history", args=[self.gpus[0].uuid])
+        response = self.app.get(url, {"from": 5000, "to": 6000}, user=self.user)
+        self.assertEqual(response.json["timestamps"], [])
+        self.assertEqual(response.json["percentiles"], {"used_memory": {}, "utilization": {}})
+
+    def test_history_invalid_range(self):
+        url = reverse("gpu_history", args=[self.gpus[0].uuid])
+        for params in ({"from": 1100, "to": 1000}, {"from": 0, "to": 1000, "step": 0},
+                       {"from": 0, "to": 100000, "step": 1}, {"from": "nan"}, {"from": "-inf"}, {"to": "inf"},
+                       {"from": 0, "to": 1000, "step": "inf"}):
+            self.app.get(url, params, user=self.user, status=400)
+
+    def test_history_permissions(self):
+        self.app.get(reverse("gpu_history", args=[self.other_gpu.uuid]), user=self.user, status=403)
+        self.app.get(reverse("device_history", args=[self.other_device.name]), user=self.user, status=403)
+        self.app.get(reverse("gpu_history", args=["unknown"]), user=self.user, status=404)
+
+        self.app.reset()
+        response = self.app.get(reverse("gpu_history", args=[self.gpus[0].uuid]))
+        self.assertEqual(response.status_code, 302)
+
 
 class GPUAllocationTests(APITestCase):
 
@@ -482,6 +1171,79 @@ class GPUAllocationTests(APITestCase):
             else:
                 self.assertFalse(gpu.reserved)
 
+    def test_update_allocation_queries_do_not_depend_on_number_of_devices(self):
+        def count_queries(allocation_data):
+            with CaptureQueriesContext(connection) as queries:
+                self.post_data(allocation_data)
+            return len(queries)
+
+        devices = device_recipe.make(_quantity=5)
+        for device in devices:
+            baker.make(GPU, device=device, _quantity=2)
+
+        num_queries = count_queries({self.device.name: [0]})
+        self.assertEqual(count_queries({device.name: [0, 1] for device in devices}), num_queries)
+        self.assertEqual(GPU.objects.filter(reserved=True).count(), 11)
+
+        # nothing changed, so nothing is written
+        self.assertLess(count_queries({device.name: [0, 1] for device in devices}), num_queries)
+
+    def test_update_allocation_matches_gpus_by_index(self):
+        device = device_recipe.make()
+        # created in a different order than their index
+        gpus = [baker.make(GPU, device=device, index=index) for index in (2, 0, 1)]
+        gpus[1].reserved = True
+        gpus[1].save()
+
+        self.post_data({device.name: [2, 1]})
+
+        for gpu in gpus:
+            gpu.refresh_from_db()
+        self.assertEqual([gpu.reserved for gpu in gpus], [True, False, True])
+
+    def test_update_allocation_stores_reservation(self):
+        cache.clear()
+        store_device_state({'name': self.device.name, 'gpus': [dict(get_parsed_gpu_template(), uuid=self.gpu.uuid)]})
+        job = {"index": 0, "job_id": 1234, "user": "slurm_user", "start_time": 1600000000}
+
+        with mock.patch('labshare.views.queue_device_state') as publish_mock:
+            self.post_data({self.device.name: [job]})
+
+        reservation = GPUReservation.objects.get(gpu=self.gpu)
+        self.assertEqual(reservation.job_id, "1234")
+        self.assertEqual(reservation.username, "slurm_user")
+        self.assertEqual(reservation.start_time.timestamp(), 1600000000)
+        expected = {'job_id': "1234", 'user': "slurm_user", 'start_time': 1600000000}
+        self.assertEqual(publish_mock.call_args[0][0]['gpus'][0]['reservation'], expected)
+
+        # the same job does not change anything, another job replaces the reservation
+        with mock.patch('labshare.views.queue_device_state') as publish_mock:
+            self.post_data({self.device.name: [job]})
+            publish_mock.assert_not_called()
+            self.post_data({self.device.name: [dict(job, job_id=1235)]})
+        self.assertEqual(GPUReservation.objects.get(gpu=self.gpu).job_id, "1235")
+
+        with mock.patch('labshare.views.queue_device_state') as publish_mock:
+            self.post_data({self.device.name: []})
+        self.assertFalse(GPUReservation.objects.exists())
+        self.assertIsNone(publish_mock.call_args[0][0]['gpus'][0]['reservation'])
+
+    def test_update_allocation_publishes_changed_devices(self):
+        cache.clear()
+        other_device = device_recipe.make()
+        other_gpu = baker.make(GPU, device=other_device, reserved=True)
+        for device, gpu in ((self.device, self.gpu), (other_device, other_gpu)):
+            store_device_state({'name': device.name, 'gpus': [dict(get_parsed_gpu_template(), uuid=gpu.uuid)]})
+
+        with mock.patch('labshare.views.queue_device_state') as publish_mock:
+            self.post_data({self.device.name: [0], other_device.name: [0]})
+
+        publish_mock.assert_called_once()
+        published_state = publish_mock.call_args[0][0]
+        self.assertEqual(published_state['name'], self.device.name)
+        self.assertTrue(published_state['gpus'][0]['reserved'])
+        self.assertEqual(get_device_state(self.device.name), published_state)
+
 
 admin_mail = "test@example.com"
 
@@ -571,8 +1333,75 @@ class PublishMethodTests(TestCase):
 
         send_function_mock.assert_called_with(channel_name, data)
 
+    def test_coalescing_publisher_sends_latest_state(self):
+        channel_layer = get_channel_layer()
+        channel_names = {}
+        for device in (self.device, self.device_2):
+            channel_names[device.name] = async_to_sync(channel_layer.new_channel)()
+            async_to_sync(channel_layer.group_add)(device.name, channel_names[device.name])
+
+        publisher = CoalescingPublisher(window=1)
+        for utilization in ("10 %", "20 %"):
+            publisher.queue({'name': self.device.name, 'gpus': [{'utilization': utilization}]})
+        publisher.queue(self.device_2.serialize())
+        publisher.flush()
+
+        message = async_to_sync(channel_layer.receive)(channel_names[self.device.name])
+        self.assertEqual(json.loads(message['message'])['gpus'], [{'utilization': "20 %"}])
+        message = async_to_sync(channel_layer.receive)(channel_names[self.device_2.name])
+        self.assertEqual(json.loads(message['message']), {'name': self.device_2.name, 'gpus': []})
+        self.assertEqual(publisher.pending, {})
+
+        # every device group only got one message
+        for channel_name in channel_names.values():
+            with self.assertRaises(asyncio.TimeoutError):
+                async_to_sync(asyncio.wait_for)(channel_layer.receive(channel_name), 0.1)
+
+    def test_queue_device_state(self):
+        device = self.device.serialize()
+        with override_settings(PUBLISH_COALESCE_WINDOW=0), \
+                mock.patch('labshare.publisher.publish_device_state') as publish_mock:
+            queue_device_state(device)
+        publish_mock.assert_called_once_with(device)
+
+        with override_settings(PUBLISH_COALESCE_WINDOW=1), \
+                mock.patch('labshare.publisher.publish_device_state') as publish_mock, \
+                mock.patch('labshare.publisher.get_publisher') as get_publisher_mock:
+            queue_device_state(device)
+        publish_mock.assert_not_called()
+        get_publisher_mock.return_value.queue.assert_called_once_with(device)
+
+
+# consumers access the database with database_sync_to_async, which closes the connection afterwards, therefore all
+# consumer tests have to be TransactionTestCases
+def async_test(test_function):
+    @functools.wraps(test_function)
+    def wrapper(*args, **kwargs):
+        return async_to_sync(test_function)(*args, **kwargs)
+    return wrapper
+
+
+def consumer_for_user(consumer_class, user, **url_kwargs):
+    # the consumer as an application that gets the user without going through the auth middleware
+    def application(scope):
+        return consumer_class(dict(scope, user=user, url_route={"kwargs": url_kwargs}))
+    return application
+
+
+async def receive_device_states(communicator, num_messages):
+    device_states = {}
+    for _ in range(num_messages):
+        device_state = await communicator.receive_json_from()
+        device_states[device_state['name']] = device_state
+    return device_states
+
+
+# the assertions inspect the groups of the channel layer, which only the in-memory layer exposes
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
 
-class ConsumerTests(TestCase):
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ConsumerTests(TransactionTestCase):
 
     def setUp(self):
         self.device = device_recipe.make()
@@ -580,44 +1409,152 @@ class ConsumerTests(TestCase):
         self.user = baker.make(User)
         assign_perm('labshare.use_device', self.user, self.device)
 
-        self.scope = {
-            "user": self.user,
-            "url_route": {
-                "kwargs": {
-                    "device_name": None
-                }
-            }
-        }
+        cache.clear()
+
+    def communicator(self, device_name):
+        application = consumer_for_user(GPUInfoUpdater, self.user, device_name=device_name)
+        return WebsocketCommunicator(application, f"/ws/device/{device_name}/")
+
+    @async_test
+    async def test_consumer_no_permission(self):
+        communicator = self.communicator(self.device_2.name)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    @async_test
+    async def test_consumer_unknown_device(self):
+        communicator = self.communicator("unknown")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    @async_test
+    async def test_consumer_permission(self):
+        communicator = self.communicator(self.device.name)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+
+    @async_test
+    async def test_consumer_connect_sends_last_known_state(self):
+        device_state = self.device.serialize()
+        device_state['gpus'] = [get_parsed_gpu_template()]
+        store_device_state(device_state)
+
+        communicator = self.communicator(self.device.name)
+        await communicator.connect()
+        self.assertEqual(await communicator.receive_json_from(), device_state)
+        await communicator.disconnect()
+
+    @async_test
+    async def test_consumer_connect_without_known_state(self):
+        communicator = self.communicator(self.device.name)
+        await communicator.connect()
+        self.assertEqual(await communicator.receive_json_from(), {'name': self.device.name, 'gpus': []})
+        await communicator.disconnect()
+
+    @async_test
+    async def test_consumer_update_info(self):
+        communicator = self.communicator(self.device.name)
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await get_channel_layer().group_send(self.device.name, {'type': 'update_info', 'message': "Lorem Ipsum"})
+        self.assertEqual(await communicator.receive_from(), "Lorem Ipsum")
+
+        await communicator.disconnect()
+        self.assertEqual(get_channel_layer().groups.get(self.device.name, {}), {})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DevicesConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.devices = device_recipe.make(_quantity=3)
+        self.user = baker.make(User)
+        for device in self.devices[:2]:
+            assign_perm('labshare.use_device', self.user, device)
+
+        cache.clear()
+
+    def communicator(self, user=None):
+        application = consumer_for_user(DevicesInfoUpdater, user or self.user)
+        return WebsocketCommunicator(application, "/ws/devices/")
+
+    @async_test
+    async def test_consumer_joins_groups_of_visible_devices(self):
+        communicator = self.communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await receive_device_states(communicator, 2)
 
-        self.consumer = GPUInfoUpdater(self.scope)
-        self.consumer.channel_layer = get_channel_layer()
-        self.consumer.channel_name = "kekse"
-        self.mock_method = mock.MagicMock(return_value=None)
-        self.consumer.accept = self.mock_method
-
-    def test_consumer_no_permission(self):
-        self.consumer.scope['url_route']['kwargs']['device_name'] = self.device_2.name
-        self.consumer.base_send = mock.MagicMock(return_value=None)
-        self.consumer.connect()
-        self.mock_method.assert_not_called()
-
-    def test_consumer_permission(self):
-        self.consumer.scope['url_route']['kwargs']['device_name'] = self.device.name
-        self.consumer.connect()
-        self.mock_method.assert_called()
-
-    @mock.patch('labshare.consumers.async_to_sync', async_to_sync_mock)
-    def test_consumer_disconnect(self):
-        device_name = "Lorem-Device"
-        self.consumer.device_name = device_name
-        self.consumer.disconnect("lorem ipsum")
-        send_function_mock.assert_called_with(device_name, self.consumer.channel_name)
-
-    def test_consumer_update_info(self):
-        message = "Lorem Ipsum"
-        self.consumer.send = mock.MagicMock()
-        self.consumer.update_info({"message": message})
-        self.consumer.send.assert_called_with(text_data=message)
+        channel_layer = get_channel_layer()
+        for device in self.devices:
+            await channel_layer.group_send(device.name, build_update_message(device.serialize()))
+        device_states = await receive_device_states(communicator, 2)
+        self.assertEqual(sorted(device_states.keys()), sorted(device.name for device in self.devices[:2]))
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+        for device in self.devices:
+            self.assertEqual(channel_layer.groups.get(device.name, {}), {})
+
+    @async_test
+    async def test_consumer_global_permission(self):
+        await database_sync_to_async(self.user.user_permissions.add)(Permission.objects.get(codename='use_device'))
+        communicator = self.communicator()
+        await communicator.connect()
+        device_states = await receive_device_states(communicator, 3)
+        self.assertEqual(sorted(device_states.keys()), sorted(device.name for device in self.devices))
+        await communicator.disconnect()
+
+    @async_test
+    async def test_consumer_anonymous_user(self):
+        communicator = self.communicator(AnonymousUser())
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    @async_test
+    async def test_consumer_connect_sends_last_known_states(self):
+        device_state = self.devices[0].serialize()
+        device_state['gpus'] = [get_parsed_gpu_template()]
+        store_device_state(device_state)
+
+        communicator = self.communicator()
+        await communicator.connect()
+        self.assertEqual(await receive_device_states(communicator, 2), {
+            self.devices[0].name: device_state,
+            self.devices[1].name: {'name': self.devices[1].name, 'gpus': []},
+        })
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ConsumerLoadTests(TransactionTestCase):
+    # number of sockets that are open at the same time, all of them are served by the event loop of one worker
+    num_sockets = 500
+
+    def setUp(self):
+        self.device = device_recipe.make()
+        self.user = baker.make(User)
+        assign_perm('labshare.use_device', self.user, self.device)
+        cache.clear()
+
+    @async_test
+    async def test_many_concurrent_sockets(self):
+        application = consumer_for_user(DevicesInfoUpdater, self.user)
+        communicators = [WebsocketCommunicator(application, "/ws/devices/") for _ in range(self.num_sockets)]
+        results = await asyncio.gather(*(communicator.connect(timeout=60) for communicator in communicators))
+        self.assertTrue(all(connected for connected, _ in results))
+        await asyncio.gather(*(communicator.receive_json_from() for communicator in communicators))
+
+        device_state = {'name': self.device.name, 'gpus': [get_parsed_gpu_template()]}
+        await get_channel_layer().group_send(self.device.name, build_update_message(device_state))
+        received_states = await asyncio.gather(*(communicator.receive_json_from() for communicator in communicators))
+        self.assertTrue(all(received_state == device_state for received_state in received_states))
+
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
 
 
 ldap_staff_name = "Staff"
@@ -3,6 +3,7 @@ import json
 import channels.layers
 from asgiref.sync import async_to_sync
 from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import send_mail
 from django.http import HttpResponse
 from django.shortcuts import render
@@ -15,14 +16,39 @@ def get_devices():
     return [(device.name, device.name) for device in Device.objects.all()]
 
 
+def build_update_message(device_data):
+    if 'gpus' not in device_data:
+        device_data['gpus'] = []
+    return {'type': 'update_info', 'message': json.dumps(device_data)}
+
+
 def publish_device_state(device_data, channel_name=None):
     channel_layer = channels.layers.get_channel_layer()
     name = device_data['name']
-    if 'gpus' not in device_data:
-        device_data['gpus'] = []
+    message = build_update_message(device_data)
 
     if channel_name is None:
         send_function = async_to_sync(channel_layer.group_send)
     else:
         send_function = async_to_sync(channel_layer.send)
-    send_function(channel_name if channel_name else name, {'type': 'update_info', 'message': json.dumps(device_data)})
+    send_function(channel_name if channel_name else name, message)
+
+
+def get_device_state_cache_key(device_name):
+    return f"device_state:{device_name}"
+
+
+def get_device_state(device_name):
+    return cache.get(get_device_state_cache_key(device_name))
+
+
+def get_device_states(device_names):
+    """
+    Returns the last known states of the given devices that are still cached, fetched with a single cache lookup.
+    """
+    cache_keys = {get_device_state_cache_key(device_name): device_name for device_name in device_names}
+    return {cache_keys[key]: device_state for key, device_state in cache.get_many(cache_keys.keys()).items()}
+
+
+def store_device_state(device_data):
+    cache.set(get_device_state_cache_key(device_data['name']), device_data, settings.DEVICE_STATE_TIMEOUT)
@@ -1,45 +1,167 @@
-import json
+import functools
+import hashlib
 import logging
+import math
+import os
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.core.exceptions import PermissionDenied, SuspiciousOperation, ObjectDoesNotExist
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied, SuspiciousOperation
 from django.core.mail import EmailMessage
-from django.http import HttpResponseRedirect, HttpResponse
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.urls import reverse
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.http import condition
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError, UnsupportedMediaType
 from rest_framework.permissions import IsAuthenticated
 
+from labshare import gpu_cache, permissions, telemetry
 from labshare.decorators import render_to
-from labshare.utils import publish_device_state
+from labshare.payloads import PayloadTooLarge, UnsupportedPayload, decode_payload
+from labshare.permissions import can_use_device, get_visible_devices
+from labshare.publisher import queue_device_state
+from labshare.utils import get_device_state, store_device_state
 from .forms import MessageForm, ViewAsForm
-from .models import Device, GPU
+from .models import Device, GPU, GPUReservation
+
+
+class RequestEntityTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Request body is too large."
+    default_code = "request_entity_too_large"
+
+
+def read_request_data(request):
+    content_encoding = request.META.get("HTTP_CONTENT_ENCODING", "")
+    max_size = settings.MAX_UPDATE_PAYLOAD_SIZE
+    body = request.read(max_size + 1)
+    if len(body) > max_size:
+        raise RequestEntityTooLarge()
+    try:
+        return decode_payload(body, request.content_type or "", content_encoding, max_size)
+    except UnsupportedPayload as e:
+        raise UnsupportedMediaType(request.content_type, detail=str(e))
+    except PayloadTooLarge as e:
+        raise RequestEntityTooLarge(detail=str(e))
+    except (ValueError, OSError, zlib.error) as e:
+        raise ParseError(f"Could not decode request: {e}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_template_fingerprint():
+    """
+    Returns a hash of all project templates and the time the newest of them was modified. Templates only change with
+    a deploy, which restarts the server, so they are only read once per process.
+    """
+    fingerprint = hashlib.md5()
+    modified = 0
+    for template_dir in settings.TEMPLATES[0]["DIRS"]:
+        for directory, _, filenames in sorted(os.walk(template_dir)):
+            for filename in sorted(filenames):
+                path = os.path.join(directory, filename)
+                fingerprint.update(os.path.relpath(path, template_dir).encode("utf-8"))
+                with open(path, "rb") as f:
+                    fingerprint.update(f.read())
+                modified = max(modified, os.path.getmtime(path))
+    return fingerprint.hexdigest(), modified
+
+
+def get_overview_version(request):
+    """
+    The overview only depends on the templates, the user, the devices the user may use and whether the user is
+    hijacked. Returns None if the overview must not be cached, because it contains messages.
+    """
+    if not hasattr(request, "overview_version"):
+        if len(messages.get_messages(request)) > 0:
+            request.overview_version = None
+        else:
+            user_id = request.user.pk if request.user.is_authenticated else "anonymous"
+            hijacked = request.session.get("is_hijacked_user", False)
+            template_fingerprint, _ = get_template_fingerprint()
+            request.overview_version = f"{permissions.get_version()}:{user_id}:{hijacked}:{template_fingerprint}"
+    return request.overview_version
+
+
+def get_overview_etag(request):
+    version = get_overview_version(request)
+    if version is None:
+        return None
+    return hashlib.md5(version.encode("utf-8")).hexdigest()
+
+
+def get_overview_last_modified(request):
+    version = get_overview_version(request)
+    if version is None:
+        return None
+    _, templates_modified = get_template_fingerprint()
+    return max(
+        permissions.get_version_time(version),
+        datetime.fromtimestamp(int(templates_modified), tz=timezone.utc),
+    )
 
 
 @ensure_csrf_cookie
-@render_to("overview.html")
+@condition(etag_func=get_overview_etag, last_modified_func=get_overview_last_modified)
 def index(request):
-    devices = list(filter(lambda device: device.can_be_used_by(request.user), Device.objects.all()))
-    sorted_devices = sorted(devices, key=lambda x: x.name)
-    return {"devices": sorted_devices}
+    version = get_overview_version(request)
+    cache_key = f"overview:{version}"
+    content = cache.get(cache_key) if version is not None else None
+    if content is None:
+        devices = get_visible_devices(request.user).order_by("name")
+        response = render(request, "overview.html", {"devices": devices})
+        if version is not None:
+            cache.set(cache_key, response.content, settings.OVERVIEW_CACHE_TIMEOUT)
+    else:
+        response = HttpResponse(content)
+    # browsers have to revalidate the page on every reload, which is answered with 304 as long as nothing changed
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
-@api_view(['POST'])
-@authentication_classes((TokenAuthentication,))
-@permission_classes((IsAuthenticated,))
-def update_gpu_info(request):
-    data = json.loads(request.read().decode("utf-8"))
-    device_name = data["device_name"]
-    device = Device.objects.get(name=device_name)  # Device should exist because it's authorized
+def is_valid_gpu_update(data):
+    """
+    Checks that an update has the structure ingest_gpu_update relies on, so that a malformed update is rejected
+    before anything is stored.
+    """
+    if not isinstance(data.get("device_name"), str) or not isinstance(data.get("gpu_data"), list):
+        return False
+    for gpu_data in data["gpu_data"]:
+        if not isinstance(gpu_data, dict) or not isinstance(gpu_data.get("uuid"), str) \
+                or "name" not in gpu_data or "gpu_util" not in gpu_data:
+            return False
+        if not isinstance(gpu_data.get("memory"), dict) or not {"used", "total"} <= gpu_data["memory"].keys():
+            return False
+        processes = gpu_data.get("processes", [])
+        if not isinstance(processes, list) or not all(isinstance(process, dict) for process in processes):
+            return False
+    return True
+
 
+def ingest_gpu_update(device, data):
+    """
+    Applies a GPU update sent by the agent of the given device and publishes the new device state.
+    Returns the HTTP status code that tells the agent whether the update was applied.
+    """
+    known_gpus = gpu_cache.get_gpus(device, data["gpu_data"])
     gpus = []
     for gpu_data in data["gpu_data"]:
-        uuid = gpu_data['uuid']
-        gpu, created = GPU.objects.get_or_create(uuid=uuid, model_name=gpu_data['name'], device=device)
+        gpu = known_gpus[gpu_data['uuid']]
         gpu_in_use = True if gpu_data.get("in_use", "na") == "yes" else False
 
         processes = []
@@ -65,10 +187,71 @@ def update_gpu_info(request):
         gpus.append(gpu)
 
     device_data = device.serialize()
-    device_data["gpus"] = gpus
-    publish_device_state(device_data)
+    is_delta = data.get("delta", False)
+    if is_delta:
+        # the device only sent the GPUs that changed since its last update, an empty delta is a heartbeat
+        device_state = get_device_state(device.name)
+        if device_state is None:
+            # we do not know the last state of this device, it has to send a full update
+            return 409
+        merged_gpus = {gpu["uuid"]: gpu for gpu in device_state["gpus"]}
+        merged_gpus.update((gpu["uuid"], gpu) for gpu in gpus)
+        device_data["gpus"] = list(merged_gpus.values())
+    else:
+        device_data["gpus"] = gpus
 
-    return HttpResponse()
+    store_device_state(device_data)
+    # heartbeats are recorded as well, they tell us that nothing changed
+    telemetry.get_store().record_device_state(device_data, time.time())
+    if len(gpus) > 0 or not is_delta:
+        queue_device_state(device_data)
+    return 200
+
+
+@api_view(['POST'])
+@authentication_classes((TokenAuthentication,))
+@permission_classes((IsAuthenticated,))
+def update_gpu_info(request):
+    data = read_request_data(request)
+    if not isinstance(data, dict) or not is_valid_gpu_update(data):
+        raise ParseError("Malformed GPU update")
+    device_name = data["device_name"]
+    device = Device.objects.get(name=device_name)  # Device should exist because it's authorized
+    return HttpResponse(status=ingest_gpu_update(device, data))
+
+
+@api_view(['POST'])
+@authentication_classes(())
+@permission_classes(())
+def update_gpu_info_bulk(request):
+    """
+    Takes the GPU updates of several devices at once (e.g. collected by the aggregator). Every update carries the
+    token of its device and is only applied if this token belongs to the device. Returns the status of each update.
+    """
+    data = read_request_data(request)
+    updates = data.get("devices") if isinstance(data, dict) else None
+    if not isinstance(updates, list):
+        raise ParseError("The payload has no list of devices")
+    # the status of each update is reported by device name, so nothing is applied unless every update has one
+    if not all(isinstance(update, dict) and isinstance(update.get("device_name"), str) for update in updates):
+        raise ParseError("Every update needs a device_name")
+    keys = [update.get("token") for update in updates if isinstance(update.get("token"), str)]
+    tokens = Token.objects.filter(key__in=keys).select_related("user__device")
+    devices_by_token = {
+        token.key: token.user.device for token in tokens if token.user.is_active and hasattr(token.user, "device")
+    }
+
+    results = {}
+    for update in updates:
+        token = update.get("token")
+        device = devices_by_token.get(token) if isinstance(token, str) else None
+        if device is None or device.name != update["device_name"]:
+            results[update["device_name"]] = 403
+        elif not is_valid_gpu_update(update):
+            results[device.name] = 400
+        else:
+            results[device.name] = ingest_gpu_update(device, update)
+    return JsonResponse({"devices": results})
 
 
 @api_view(['POST'])
@@ -78,20 +261,152 @@ def update_allocations(request):
     if request.user != User.objects.get(username=settings.ALLOCATION_UPDATE_USERNAME):
         raise PermissionDenied
 
-    data = json.loads(request.read().decode("utf-8"))
-    for device_name, allocated_gpus in data.items():
-        try:
-            device = Device.objects.get(name=device_name)
-            allocated_gpus = [int(gpu_id) for gpu_id in allocated_gpus]
-            for idx, gpu in enumerate(device.gpus.all()):
-                gpu.reserved = idx in allocated_gpus
-                gpu.save()
-        except ObjectDoesNotExist:
+    data = read_request_data(request)
+    allocations = {device_name: dict(map(parse_allocation, gpus)) for device_name, gpus in data.items()}
+    devices = {device.name: device for device in Device.objects.filter(name__in=allocations.keys())}
+    allocated_indices = set().union(*allocations.values())
+    # only GPUs whose reservation may change have to be loaded: the allocated ones, the ones that are currently
+    # reserved and the ones that do not know their index yet
+    gpus = GPU.objects.filter(
+        Q(reserved=True) | Q(index__in=allocated_indices) | Q(index__isnull=True),
+        device__in=devices.values(),
+    ).select_related("reservation").order_by("id")
+    gpus_by_device = defaultdict(list)
+    for gpu in gpus:
+        gpus_by_device[gpu.device_id].append(gpu)
+
+    changed_gpus = []
+    deleted_reservations = []
+    created_reservations = []
+    reservations = {}
+    changed_devices = []
+    for device_name, allocated_gpus in allocations.items():
+        device = devices.get(device_name)
+        if device is None:
             logging.error(f"Tried to update gpu allocations of non existing device: {device_name}")
+            continue
+        device_changed = False
+        # GPUs that were not updated by an agent that reports the index are matched in the order they were created in
+        gpus_without_index = (gpu for gpu in gpus_by_device[device.pk] if gpu.index is None)
+        fallback_indices = {gpu.pk: idx for idx, gpu in enumerate(gpus_without_index)}
+        for gpu in gpus_by_device[device.pk]:
+            index = gpu.index if gpu.index is not None else fallback_indices[gpu.pk]
+            reserved = index in allocated_gpus
+            if gpu.reserved != reserved:
+                gpu.reserved = reserved
+                changed_gpus.append(gpu)
+                device_changed = True
+
+            reservation = reservations[gpu.uuid] = allocated_gpus.get(index)
+            if (reservation.serialize() if reservation is not None else None) != gpu.get_reservation_data():
+                if gpu.get_reservation_data() is not None:
+                    deleted_reservations.append(gpu.pk)
+                if reservation is not None:
+                    reservation.gpu = gpu
+                    created_reservations.append(reservation)
+                device_changed = True
+        if device_changed:
+            changed_devices.append(device)
+
+    if len(changed_devices) == 0:
+        return HttpResponse()
+
+    with transaction.atomic():
+        GPU.objects.bulk_update(changed_gpus, ["reserved"])
+        GPUReservation.objects.filter(gpu__in=deleted_reservations).delete()
+        GPUReservation.objects.bulk_create(created_reservations)
+    for device in changed_devices:
+        gpu_cache.invalidate(device.pk)
+        publish_allocations(device, gpus_by_device[device.pk], reservations)
 
     return HttpResponse()
 
 
+def parse_allocation(gpu):
+    """
+    An allocated GPU is either sent as its index or as a dict that contains the index and the Slurm job that holds
+    the GPU. Returns the index and the reservation of the GPU, if the job is known.
+    """
+    if not isinstance(gpu, dict):
+        return int(gpu), None
+    if gpu.get("job_id") is None:
+        return int(gpu["index"]), None
+    start_time = gpu.get("start_time")
+    return int(gpu["index"]), GPUReservation(
+        job_id=str(gpu["job_id"]),
+        username=gpu.get("user", ""),
+        start_time=datetime.fromtimestamp(start_time, tz=timezone.utc) if start_time is not None else None,
+    )
+
+
+def publish_allocations(device, gpus, reservations):
+    # clients only get the new allocations if the last state of the device is known, otherwise they are sent along
+    # with the next GPU update of the device
+    device_state = get_device_state(device.name)
+    if device_state is None:
+        return
+    reserved = {gpu.uuid: gpu.reserved for gpu in gpus}
+    for gpu in device_state["gpus"]:
+        gpu["reserved"] = reserved.get(gpu["uuid"], gpu["reserved"])
+        if gpu["uuid"] in reserved:
+            reservation = reservations.get(gpu["uuid"])
+            gpu["reservation"] = reservation.serialize() if reservation is not None else None
+    store_device_state(device_state)
+    queue_device_state(device_state)
+
+
+def parse_history_range(request):
+    """
+    Reads the range of a history request: from and to are unix timestamps (default: the last 24 hours) and step is
+    the length of one step in seconds (default: the range divided into HISTORY_DEFAULT_STEPS steps).
+    """
+    end = float(request.GET.get("to", time.time()))
+    start = float(request.GET.get("from", end - 24 * 60 * 60))
+    if not (math.isfinite(start) and math.isfinite(end)):
+        raise ValueError("from and to have to be finite numbers")
+    if end <= start:
+        raise ValueError("from has to be before to")
+    step = request.GET.get("step")
+    if step is None:
+        step = max(60, math.ceil((end - start) / settings.HISTORY_DEFAULT_STEPS))
+    step = float(step)
+    if not math.isfinite(step):
+        raise ValueError("step has to be a finite number")
+    if step <= 0 or (end - start) / step > settings.HISTORY_MAX_STEPS:
+        raise ValueError(f"step has to be positive and the range may not contain more than "
+                         f"{settings.HISTORY_MAX_STEPS} steps")
+    return start, end, step
+
+
+@login_required
+def gpu_history(request, uuid):
+    gpu = get_object_or_404(GPU.objects.select_related("device"), uuid=uuid)
+    if not can_use_device(request.user, gpu.device):
+        raise PermissionDenied
+    try:
+        start, end, step = parse_history_range(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    history = telemetry.get_history(gpu.uuid, start, end, step)
+    history.update({"from": start, "to": end, "step": step})
+    return JsonResponse(history)
+
+
+@login_required
+def device_history(request, name):
+    device = get_object_or_404(Device, name=name)
+    if not can_use_device(request.user, device):
+        raise PermissionDenied
+    try:
+        start, end, step = parse_history_range(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    gpus = [telemetry.get_history(gpu.uuid, start, end, step) for gpu in device.gpus.all()]
+    return JsonResponse({"name": device.name, "from": start, "to": end, "step": step, "gpus": gpus})
+
+
 @login_required
 @render_to("send_message.html")
 def send_message(request):
@@ -20,11 +20,18 @@ function createNewGPURow(gpuData, deviceName) {
 }
 
 
-function updateReservationIndicator(gpuRow, gpuIsReserved) {
+function updateReservationIndicator(gpuRow, gpuIsReserved, reservation) {
     let reservationIndicator;
     if (gpuIsReserved) {
         reservationIndicator = $(".gpu-in-use-template").clone();
         reservationIndicator.removeClass("gpu-in-use-template");
+        if (reservation) {
+            let title = `Job ${reservation.job_id} of ${reservation.user}`;
+            if (reservation.start_time) {
+                title += ` since ${new Date(reservation.start_time * 1000).toLocaleString()}`;
+            }
+            reservationIndicator.attr("title", title);
+        }
     } else {
         reservationIndicator = $(".gpu-free-template").clone();
         reservationIndicator.removeClass("gpu-free-template");
@@ -33,6 +40,12 @@ function updateReservationIndicator(gpuRow, gpuIsReserved) {
     const reservationRoot = gpuRow.find(".gpu-reservation");
     reservationRoot.empty();
     reservationIndicator.appendTo(reservationRoot);
+    if (gpuIsReserved && reservation) {
+        const reservationUser = $(".gpu-reservation-user-template").clone();
+        reservationUser.removeClass("gpu-reservation-user-template");
+        reservationUser.text(reservation.user);
+        reservationUser.appendTo(reservationRoot);
+    }
 }
 
 function updateGPUData(data, currentUser) {
@@ -48,7 +61,7 @@ function updateGPUData(data, currentUser) {
         gpuRow.find('.gpu-utilization').html(gpu.utilization);
         gpuRow.find('.gpu-last-update').timeago('init').timeago('update', new Date());
 
-        updateReservationIndicator(gpuRow, gpu.reserved);
+        updateReservationIndicator(gpuRow, gpu.reserved, gpu.reservation);
 
         const numGPUProcesses = gpu.processes.length;
         const processButton = gpuRow.find('.gpu-processes').find('.gpu-process-show');
@@ -135,33 +148,45 @@ function setBorderColor(element, borderColor) {
 }
 
 function setupWebsockets(deviceNames, currentUser) {
+    const deviceTables = {};
     for (const deviceName of deviceNames) {
-        const deviceTable = $(`#${deviceName}-card`);
-        const socket = new ReconnectingWebSocket(webSocketMethod + "://" + window.location.host + '/ws/device/' + deviceName + '/');
-        setBorderColor(deviceTable, "warning");
-        socket.device_name = deviceName;
-        socket.addEventListener('open', function (event) {
-            setBorderColor(deviceTable, "warning");
-            console.log("Opening Socket " + socket.device_name);
-        });
-        socket.addEventListener('close', function (event) {
-            setBorderColor(deviceTable, "danger");
-            console.log("Closing socket " + socket.device_name);
-            delete deviceData[socket.device_name];
-        });
-        socket.addEventListener('error', function (event) {
-            setBorderColor(deviceTable, "danger");
-            console.log("Error while opening Websocket" + event);
-        });
-        socket.addEventListener('message', function (event) {
-            if (!deviceTable.hasClass("border-success")) {
-                setBorderColor(deviceTable, "success");
-            }
-            const data = JSON.parse(event.data);
-            deviceData[data.name] = data;
-            updateGPUData(data, currentUser);
-        });
-     }
+        deviceTables[deviceName] = $(`#${deviceName}-card`);
+        setBorderColor(deviceTables[deviceName], "warning");
+    }
+
+    // one socket for all devices, every message contains the state of one device
+    const socket = new ReconnectingWebSocket(webSocketMethod + "://" + window.location.host + '/ws/devices/');
+    socket.addEventListener('open', function (event) {
+        for (const deviceName of deviceNames) {
+            setBorderColor(deviceTables[deviceName], "warning");
+        }
+        console.log("Opening Socket");
+    });
+    socket.addEventListener('close', function (event) {
+        for (const deviceName of deviceNames) {
+            setBorderColor(deviceTables[deviceName], "danger");
+            delete deviceData[deviceName];
+        }
+        console.log("Closing socket");
+    });
+    socket.addEventListener('error', function (event) {
+        for (const deviceName of deviceNames) {
+            setBorderColor(deviceTables[deviceName], "danger");
+        }
+        console.log("Error while opening Websocket" + event);
+    });
+    socket.addEventListener('message', function (event) {
+        const data = JSON.parse(event.data);
+        const deviceTable = deviceTables[data.name];
+        if (deviceTable === undefined) {
+            return;
+        }
+        if (!deviceTable.hasClass("border-success")) {
+            setBorderColor(deviceTable, "success");
+        }
+        deviceData[data.name] = data;
+        updateGPUData(data, currentUser);
+    });
 }
 
 export default function(deviceNames, currentUser) {
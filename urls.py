@@ -10,7 +10,10 @@ urlpatterns = [
     path('', views.index, name="index"),
     path('message', views.send_message, name="send_message"),
     path('gpu/update', views.update_gpu_info, name="update_gpu_info"),
+    path('gpu/update/bulk', views.update_gpu_info_bulk, name="update_gpu_info_bulk"),
     path('gpu/allocations', views.update_allocations, name="update_gpu_allocations"),
+    path('gpu/<str:uuid>/history', views.gpu_history, name="gpu_history"),
+    path('device/<str:name>/history', views.device_history, name="device_history"),
 
     path('accounts/login', auth_views.LoginView.as_view(template_name='login.html')),
     path('login/', auth_views.LoginView.as_view(template_name='login.html')),